@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of habibi hot paths on synthetic topologies.
+
+Runs against sqlite with in-process fake docker client, so no docker daemon is needed.
+
+    python benchmarks/habibi_bench.py --sizes small,medium --output bench.json
+    python benchmarks/habibi_bench.py --sizes small,medium --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import habibi.api as habibi_api
+import habibi.events as habibi_events
+import habibi.metrics as habibi_metrics
+import habibi.testing as habibi_testing
+
+
+SIZES = {
+    # farms, farm roles per farm, servers per farm role, GVs per scope, rules per event
+    'small': dict(farms=1, farm_roles=2, servers=5, gvs=5, rules=2),
+    'medium': dict(farms=2, farm_roles=4, servers=25, gvs=10, rules=3),
+    'large': dict(farms=4, farm_roles=5, servers=50, gvs=20, rules=3),
+}
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.samples = dict()
+
+    def measure(self, name, fn, *args, **kwargs):
+        start = time.time()
+        result = fn(*args, **kwargs)
+        self.samples.setdefault(name, []).append(time.time() - start)
+        return result
+
+    def summary(self):
+        ret = dict()
+        for name, values in self.samples.items():
+            values = sorted(values)
+            ret[name] = dict(count=len(values), total=sum(values), mean=sum(values) / len(values),
+                             min=values[0], p50=habibi_metrics.percentile(values, 0.5),
+                             p99=habibi_metrics.percentile(values, 0.99))
+        return ret
+
+
+def bench_size(size, repeat, db_url, state_engine=False, gv_cache_size=None):
+    params = SIZES[size]
+    base_dir = tempfile.mkdtemp()
+    try:
+        api = habibi_api.HabibiApi(db_url=db_url, base_dir=base_dir,
+                                   docker_client=habibi_testing.FakeDockerClient(),
+                                   state_engine=state_engine, gv_cache_size=gv_cache_size)
+        timings = Timings()
+
+        # create_server is timed as a part of topology build
+        original_create_server = api.create_server
+        api.create_server = lambda *args, **kwargs: timings.measure(
+            'create_server', original_create_server, *args, **kwargs)
+        topology = habibi_testing.build_topology(api, **params)
+        del api.create_server
+
+        servers = topology['servers']
+        server_ids = [s['id'] for s in servers]
+        for i in range(repeat):
+            server = servers[i % len(servers)]
+            event = api.create_event('HostUp', server['id'])
+            timings.measure('orchestrate_event', api.orchestrate_event, event['id'])
+            timings.measure('orchestrate_event_compact', api.orchestrate_event, event['id'], compact=True)
+            timings.measure('calculate_global_variables', api.calculate_global_variables,
+                            'server', server_ids, event['id'])
+            timings.measure('find_servers', api.find_servers)
+            timings.measure('get_server', api.get_server, server['id'])
+            timings.measure('find_farm_roles', api.find_farm_roles,
+                            farm=topology['farms'][i % len(topology['farms'])]['id'])
+
+        orchestration_bytes = dict(
+            full=len(json.dumps(api.orchestrate_event(event['id']))),
+            compact=len(json.dumps(api.orchestrate_event(event['id'], compact=True))))
+
+        event_mgr = habibi_events.EventMgr()
+        listeners = [(habibi_events.Event(event='HostUp', source='app'), lambda ev: None) for i in range(20)]
+        for event, fn in listeners:
+            event_mgr.add_listener(event, fn)
+        for i in range(repeat * 10):
+            timings.measure('EventMgr.notify', event_mgr.notify,
+                            habibi_events.Event(event='HostUp', source='app.{}'.format(i)))
+        for event, fn in listeners:
+            event_mgr.remove_listener(event, fn)
+
+        for server in servers:
+            api.run_server(server['id'], cmd=['true'])
+        for farm in topology['farms']:
+            timings.measure('farm_terminate', api.farm_terminate, farm['id'])
+
+        result = timings.summary()
+        result['_topology'] = dict(params, total_servers=len(servers))
+        result['_orchestration_bytes'] = orchestration_bytes
+        if api.gv_cache is not None:
+            result['_gv_cache'] = api.gv_cache.stats()
+        return result
+    finally:
+        shutil.rmtree(base_dir)
+
+
+def compare(results, baseline, threshold):
+    """Print relative change of mean time for every operation. Returns number of regressions."""
+    regressions = 0
+    for size, operations in sorted(results['results'].items()):
+        if size not in baseline['results']:
+            continue
+        for name, stats in sorted(operations.items()):
+            old = baseline['results'][size].get(name)
+            if name.startswith('_') or not old:
+                continue
+            change = (stats['mean'] - old['mean']) / old['mean']
+            regressed = change > threshold
+            regressions += regressed
+            print('{:8} {:28} {:10.3f}ms -> {:10.3f}ms {:+7.1%}{}'.format(
+                size, name, old['mean'] * 1000, stats['mean'] * 1000, change,
+                regressed and '  REGRESSION' or ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='small,medium', help='comma-separated: ' + ', '.join(sorted(SIZES)))
+    parser.add_argument('--repeat', type=int, default=20, help='iterations of every read operation')
+    parser.add_argument('--db-url', default='sqlite:///:memory:')
+    parser.add_argument('--state-engine', action='store_true', help='serve reads from in-memory state')
+    parser.add_argument('--gv-cache', type=int, metavar='SIZE', help='cache resolved GVs, see HabibiApi(gv_cache_size=...)')
+    parser.add_argument('--output', help='save results to JSON file')
+    parser.add_argument('--compare', help='JSON file with baseline results')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='mean time increase, reported as regression (default: 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    results = dict(meta=dict(timestamp=time.time(), python=platform.python_version(),
+                             platform=platform.platform(), db_url=args.db_url, repeat=args.repeat,
+                             state_engine=args.state_engine, gv_cache_size=args.gv_cache),
+                   results=dict())
+    for size in args.sizes.split(','):
+        results['results'][size] = bench_size(size, args.repeat, args.db_url, args.state_engine,
+                                               args.gv_cache)
+        for name, stats in sorted(results['results'][size].items()):
+            if not name.startswith('_'):
+                print('{:8} {:28} n={:<5} mean={:8.3f}ms p50={:8.3f}ms p99={:8.3f}ms'.format(
+                    size, name, stats['count'], stats['mean'] * 1000, stats['p50'] * 1000, stats['p99'] * 1000))
+        print('{:8} {:28} full={full}B compact={compact}B'.format(
+            size, 'orchestration response', **results['results'][size]['_orchestration_bytes']))
+        if '_gv_cache' in results['results'][size]:
+            print('{:8} {:28} hit_rate={hit_rate:.1%} size={size} evictions={evictions}'.format(
+                size, 'gv cache', **results['results'][size]['_gv_cache']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Startup time of habibi in fresh interpreter: `import habibi.api; HabibiApi()`
+and the first api call, which connects to DB.
+
+    python benchmarks/startup_bench.py --runs 20
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PROBE = r"""
+import sys, time, json
+sys.path.insert(0, {root!r})
+start = time.time()
+import habibi.api
+imported = time.time()
+api = habibi.api.HabibiApi(db_url={db_url!r}, base_dir={base_dir!r})
+created = time.time()
+api.create_farm('farm-%s' % time.time())
+called = time.time()
+print(json.dumps(dict(import_=imported - start, init=created - imported, first_call=called - created)))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--db-url', help='default: sqlite file, created by the first run and reused by others')
+    args = parser.parse_args(argv)
+
+    base_dir = tempfile.mkdtemp()
+    db_url = args.db_url or 'sqlite:///{}/habibi.db'.format(base_dir)
+    probe = PROBE.format(root=ROOT, db_url=db_url, base_dir=base_dir)
+
+    samples = []
+    try:
+        for _ in range(args.runs):
+            output = subprocess.check_output([sys.executable, '-c', probe])
+            samples.append(json.loads(output.decode().strip().splitlines()[-1]))
+    finally:
+        shutil.rmtree(base_dir)
+
+    for key in ('import_', 'init', 'first_call'):
+        values = [sample[key] * 1000 for sample in samples]
+        print('{:12} median={:8.2f}ms min={:8.2f}ms max={:8.2f}ms'.format(
+            key.rstrip('_'), median(values), min(values), max(values)))
+    totals = [sum(sample.values()) * 1000 for sample in samples]
+    print('{:12} median={:8.2f}ms'.format('total', median(totals)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,16 +11,31 @@ import uuid
 import types
 import socket
 import logging
+import datetime
 import itertools
+import threading
+import contextlib
 import collections
 
 import six
-import docker
-import peewee
-import playhouse.shortcuts as db_shortcuts
 
-import habibi.db as habibi_db
 import habibi.exc as habibi_exc
+import habibi.gvcache as habibi_gvcache
+import habibi.metrics as habibi_metrics
+import habibi.tracing as habibi_tracing
+import habibi.writebehind as habibi_writebehind
+from habibi.utils import crypto
+from habibi.utils.lazy import LazyModule
+
+# Heavy modules are imported on first use, to keep import and startup of habibi cheap
+docker = LazyModule('docker')
+peewee = LazyModule('peewee')
+db_shortcuts = LazyModule('playhouse.shortcuts')
+habibi_db = LazyModule('habibi.db')
+habibi_archive = LazyModule('habibi.archive')
+habibi_state = LazyModule('habibi.state')
+habibi_sharding = LazyModule('habibi.sharding')
+habibi_dockerpool = LazyModule('habibi.dockerpool')
 
 
 if 'DEBUG' == os.environ.get('HABIBI_LOGLEVEL'):
@@ -31,6 +46,45 @@ if 'DEBUG' == os.environ.get('HABIBI_LOGLEVEL'):
 LOG = logging.getLogger(__name__)
 logging.basicConfig()
 
+# Public methods, that manage api object itself, not entities:
+# they are not wrapped by `MetaReturnDicts` and not served by `habibi.service`
+LIFECYCLE_METHODS = frozenset(['close'])
+
+# Server, as seen by orchestration rules
+ServerInfo = collections.namedtuple('ServerInfo', 'id farm_role_id behaviors')
+
+
+def to_dict(entity):
+    """Render peewee.Model or state engine record to dict."""
+    if isinstance(entity, peewee.Model):
+        return db_shortcuts.model_to_dict(entity)
+    return entity.to_dict()
+
+
+def shared_items(dicts):
+    """Return items, that are present in every dict of `dicts`, with the same value."""
+    dicts = iter(dicts)
+    shared = dict(next(dicts, {}))
+    for d in dicts:
+        if not shared:
+            break
+        for key in list(shared):
+            if key not in d or d[key] != shared[key]:
+                del shared[key]
+    return shared
+
+
+def expand_orchestration(orchestration):
+    """Convert result of `orchestrate_event(compact=True)` to the full format."""
+    shared = orchestration.get('shared_global_variables')
+    if shared is None:
+        return orchestration
+    expanded = dict((k, v) for k, v in orchestration.items() if k != 'shared_global_variables')
+    expanded['server_to_rules_mapping'] = [
+        dict(entry, global_variables=shared + entry['global_variables'])
+        for entry in orchestration['server_to_rules_mapping']]
+    return expanded
+
 
 class MetaReturnDicts(type):
     """Renders peewee.Model to dicts in method results."""
@@ -39,14 +93,24 @@ class MetaReturnDicts(type):
         def _wrapper(fn):
             @six.wraps(fn)
             def wrapped(*args, **kwargs):
-                res = fn(*args, **kwargs)
-                if isinstance(res, peewee.Model):
+                if args[0]._database is None:
+                    args[0]._connect()
+                metrics = args[0].metrics
+                tracer = args[0].tracer
+                with tracer.span(fn.__name__, 'api') if tracer is not None else habibi_tracing.NO_SPAN:
+                    if metrics is None:
+                        res = fn(*args, **kwargs)
+                    else:
+                        res = metrics.timed('api', fn.__name__, fn, args, kwargs)
+                entity_types = (peewee.Model, habibi_state.Record)
+                if isinstance(res, entity_types):
                     """Return dict instead of peewee.Model."""
-                    return db_shortcuts.model_to_dict(res)
-                elif isinstance(res, collections.Iterable):
-                    if all(six.moves.map(isinstance, res, itertools.repeat(peewee.Model))):
+                    return to_dict(res)
+                elif isinstance(res, collections.Iterable) and not isinstance(res, collections.Iterator):
+                    # Generators are returned as they are: checking items would consume them
+                    if all(six.moves.map(isinstance, res, itertools.repeat(entity_types))):
                         """Transform list of peewee.Model objects to their JSON value."""
-                        return (db_shortcuts.model_to_dict(x) for x in res)
+                        return (to_dict(x) for x in res)
                 """Return result untouched."""
                 return res
             return wrapped
@@ -55,7 +119,7 @@ class MetaReturnDicts(type):
         for attribute_name, attribute_value in six.iteritems(class_dict):
             """Decorate all public methods."""
             if type(attribute_value) is types.FunctionType:
-                if attribute_name.startswith('_'):
+                if attribute_name.startswith('_') or attribute_name in LIFECYCLE_METHODS:
                     continue
                 new_class_dict[attribute_name] = _wrapper(attribute_value)
         return type.__new__(meta, class_name, bases, new_class_dict)
@@ -63,20 +127,178 @@ class MetaReturnDicts(type):
 
 class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
 
+    metrics = None
+    tracer = None
     _gv_scopes = ('server', 'farm_role', 'farm', 'role')
     _gv_scopes_resolution = {'server': {'farm_role': 1}, 'farm_role': {'farm': 2, 'role': 1}}
 
-    def __init__(self, db_url=None, docker_url=None, base_dir=None):
+    def __init__(self, db_url=None, docker_url=None, base_dir=None,
+                 event_batch_size=None, event_flush_interval=None,
+                 retention_period=None, retention_batch_size=100, metrics=None,
+                 docker_client=None, state_engine=False, state_batch_size=100,
+                 state_flush_interval=1, sharded=False, gv_cache_size=None,
+                 docker_connections=4, docker_timeout=60, docker_retries=3, key_pool_size=1000,
+                 tracing=None, trace_sample_rate=1.0):
+        """
+        :param event_batch_size: if set, `create_event` only queues events in memory,
+            they are written to DB in batches of that size (group commit).
+            Reading events through api flushes the queue first, events, left in it, are saved at exit.
+            If saving fails, events stay queued and are saved by the next flush.
+        :param event_flush_interval: max time (seconds) event may stay queued.
+        :param retention_period: age (seconds) of events and terminated servers,
+            that `archive_old_entities` moves to the archive.
+        :param retention_batch_size: number of rows archived in one transaction.
+        :param metrics: `habibi.metrics.Metrics` object, that records latencies of api methods,
+            SQL statements and docker calls. Pass True to create one without exporters.
+        :param docker_url: url of docker daemon or comma-separated urls of several daemons,
+            containers are spread among them. `fake://<name>` is in-process fake daemon.
+        :param docker_client: object with `docker.Client` interface to use instead of
+            connecting to `docker_url` (e.g. `habibi.testing.FakeDockerClient`).
+        :param docker_connections: max number of keep-alive connections per docker daemon.
+        :param docker_timeout: timeout (seconds) of docker calls.
+        :param docker_retries: number of retries of read-only docker calls after connection errors.
+            See `habibi.dockerpool.DockerPool`.
+        :param key_pool_size: number of crypto keys for new servers, that are generated
+            in advance, in background thread (`habibi.utils.crypto.KeyPool`).
+        :param tracing: if set, spans of api methods, SQL statements, docker calls,
+            event notifications and storage commands are written to `base_dir`/traces
+            (JSON lines and Chrome trace format), `trace_sample_rate` share of api calls
+            is traced. Pass directory path to write them there instead,
+            or `habibi.tracing.Tracer` to use other exporters.
+            Tracer is installed for the whole process, see `habibi.tracing.install`.
+        :param state_engine: if set, all entities are loaded to memory (`habibi.state.StateEngine`)
+            on connect, api reads them from memory, writes are saved to DB asynchronously,
+            in batches of `state_batch_size`, at most `state_flush_interval` seconds later.
+            `event_batch_size` is not used then: events are batched with other writes.
+        :param sharded: if set, servers and events of every farm are kept in separate
+            sqlite file in `base_dir`, so writes to different farms are not serialized.
+            `db_url` must point to sqlite file, that keeps farms, roles, farm roles and GVs.
+            Can't be used with `state_engine` and fixtures.
+        :param gv_cache_size: if set, results of `calculate_global_variables` are cached
+            (at most that many entries, `habibi.gvcache.GlobalVariablesCache`).
+            Cache is invalidated by changes, made through api: if other processes
+            change the same DB, don't use it.
+
+           DB connection, `base_dir` and docker client are created on first use.
+        """
 
         self.base_dir = base_dir or '.habibi'
-        if not os.path.isdir(self.base_dir):
-            os.makedirs(self.base_dir)
-
-        db_url = db_url or os.environ.get('HABIBI_DB_URL') or 'sqlite:///:memory:'
-        self.database = habibi_db.connect_to_db(db_url)
-
-        docker_url = docker_url or 'unix://var/run/docker.sock'
-        self.docker = docker.Client(base_url=docker_url)
+        self.db_url = db_url or os.environ.get('HABIBI_DB_URL') or 'sqlite:///:memory:'
+        self.docker_url = docker_url or 'unix://var/run/docker.sock'
+        self._database = None
+        self._connect_lock = threading.Lock()
+        self._docker = None
+        self._docker_pool = None
+        self._docker_options = dict(connections=docker_connections, timeout=docker_timeout,
+                                    retries=docker_retries)
+        self.state = None
+        self._state_options = state_engine and dict(
+            batch_size=state_batch_size, flush_interval=state_flush_interval)
+        self.shards = None
+        self._sharded = sharded
+        self._key_pool = None
+        self._key_pool_size = key_pool_size
+        self.gv_cache = gv_cache_size and habibi_gvcache.GlobalVariablesCache(gv_cache_size) or None
+        if sharded and state_engine:
+            raise habibi_exc.HabibiApiException('State engine can not be used with sharding')
+
+        if metrics:
+            self.metrics = metrics if isinstance(metrics, habibi_metrics.Metrics) else habibi_metrics.Metrics()
+        if tracing:
+            if isinstance(tracing, habibi_tracing.Tracer):
+                self.tracer = tracing
+            else:
+                trace_dir = isinstance(tracing, six.string_types) and tracing or os.path.join(self.base_dir, 'traces')
+                self.tracer = habibi_tracing.file_tracer(trace_dir, sample_rate=trace_sample_rate)
+            habibi_tracing.install(self.tracer)
+        if docker_client is not None:
+            self.docker = docker_client
+
+        self.retention_period = retention_period
+        self.retention_batch_size = retention_batch_size
+        self._archive_path = os.path.join(self.base_dir, 'archive.db')
+        self._archive = None
+
+        self._event_queue = None
+        if event_batch_size:
+            self._event_queue = habibi_writebehind.WriteBehindQueue(
+                self._insert_events, batch_size=event_batch_size, flush_interval=event_flush_interval)
+            # Queued events are saved at exit in any case
+            self._event_queue.start(background=':memory:' not in self.db_url)
+
+    def _connect(self):
+        """Connect to DB, create tables, if needed. Api does this on first call.
+           Concurrent first calls wait for the one, that connects.
+        """
+        with self._connect_lock:
+            if self._database is not None:
+                return self._database
+            if not os.path.isdir(self.base_dir):
+                os.makedirs(self.base_dir)
+            database = habibi_db.connect_to_db(self.db_url)
+            if self._sharded:
+                catalog_path = getattr(database, 'database', None)
+                if not isinstance(database, peewee.SqliteDatabase) or catalog_path == ':memory:':
+                    raise habibi_exc.HabibiApiException(
+                        'Sharding needs sqlite file database, got {}'.format(self.db_url))
+                self.shards = habibi_sharding.ShardRouter(os.path.join(self.base_dir, 'shards'), catalog_path)
+            if self._state_options:
+                self.state = habibi_state.StateEngine(database=database, **self._state_options)
+                self.state.load()
+                self.state.start(background=':memory:' not in self.db_url)
+            if self.metrics is not None:
+                habibi_db.add_sql_listener(self.metrics.sql_listener)
+            if self.tracer is not None:
+                habibi_db.add_sql_listener(self.tracer.sql_listener)
+            # Set last: other threads check it without the lock
+            self._database = database
+            return database
+
+    @property
+    def database(self):
+        return self._database or self._connect()
+
+    @property
+    def key_pool(self):
+        if self._key_pool is None:
+            self._key_pool = crypto.KeyPool(size=self._key_pool_size)
+            self._key_pool.refill()
+            self._key_pool.start()
+        return self._key_pool
+
+    @property
+    def docker(self):
+        if self._docker is None:
+            self._docker_pool = habibi_dockerpool.DockerPool(self.docker_url, **self._docker_options)
+            self.docker = self._docker_pool
+        return self._docker
+
+    @docker.setter
+    def docker(self, client):
+        if self.metrics is not None:
+            client = habibi_metrics.InstrumentedClient(client, self.metrics)
+        if self.tracer is not None:
+            client = habibi_tracing.TracedClient(client, self.tracer)
+        self._docker = client
+
+    def close(self):
+        """Save queued writes, stop background threads (write-behind queues, key pool)
+           and close connections to docker daemons, that api opened.
+           Docker client, passed as `docker_client`, is left open. Api should not be used after that.
+        """
+        if self._event_queue is not None:
+            self._event_queue.stop()
+        if self.state is not None:
+            self.state.stop()
+        if self._key_pool is not None:
+            self._key_pool.stop()
+        if self._docker_pool is not None:
+            self._docker_pool.close()
+        if self._database is not None:
+            if self.metrics is not None:
+                habibi_db.remove_sql_listener(self.metrics.sql_listener)
+            if self.tracer is not None:
+                habibi_db.remove_sql_listener(self.tracer.sql_listener)
 
     def _find_entities(self, model, *ids, **kwargs):
         """Find entities of `model` kind.
@@ -91,18 +313,115 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
            :rtype: list of habibi_db.HabibiModel
            :raises habibi_exc.HabibiApiNotFound: if no entities were found
         """
+        if self._database is None:
+            self._connect()
+
+        if self.state is not None:
+            objects = self.state.find(model, ids, kwargs)
+        else:
+            if model is habibi_db.Event:
+                self.flush_events()
+            if self.shards is not None and model in habibi_db.SHARDED_ENTITIES:
+                objects = []
+                for farm_id, farm_ids in six.iteritems(self._shards_to_search(model, ids, kwargs)):
+                    with self.shards.using(farm_id):
+                        objects += list(self._select(model, farm_ids, kwargs))
+            else:
+                objects = list(self._select(model, ids, kwargs))
+
+        if not objects:
+            raise habibi_exc.HabibiApiNotFound(model, ids, kwargs)
+
+        return objects
+
+    def _select(self, model, ids, kwargs):
         query = model.select()
+        if model is habibi_db.Event and self.shards is not None:
+            # Server is read now, from shard of the event, not when it's accessed
+            query = model.select(model, habibi_db.Server).join(habibi_db.Server)
         if ids:
             query = query.where(model.id.in_(ids))
         for k, v in six.iteritems(kwargs):
             query = query.where((getattr(model, k) == v))
+        return query
 
-        objects = list(query)
-
-        if not objects:
-            raise habibi_exc.HabibiApiNotFound(model, ids, kwargs)
-
-        return objects
+    def _shards_to_search(self, model, ids, kwargs):
+        """Return {farm_id: ids} for entities of sharded `model`."""
+        if ids:
+            return self.shards.group_by_farm(model, ids)
+        parent_field = model._meta.fields[self.shards.parent_fields[model]]
+        if parent_field.name in kwargs:
+            farm_id = self.shards.farm_of(parent_field.rel_model, kwargs[parent_field.name])
+            return farm_id is not None and {farm_id: ids} or {}
+        return dict((farm_id, ids) for farm_id in self.shards.farm_ids())
+
+    @contextlib.contextmanager
+    def _scope(self, model, pk):
+        """Route queries of sharded models to the database of the farm,
+           that entity of `model` with primary key `pk` belongs to. Does nothing, unless api is sharded.
+        """
+        if self.shards is None:
+            yield
+            return
+        farm_id = self.shards.farm_of(model, pk)
+        if farm_id is None:
+            raise habibi_exc.HabibiApiNotFound(model, [pk], None)
+        with self.shards.using(farm_id):
+            yield
+
+    def _each_shard(self):
+        """Route queries of sharded models to every shard in turn (just once, unless api is sharded)."""
+        if self.shards is None:
+            yield None
+            return
+        for farm_id in self.shards.farm_ids():
+            with self.shards.using(farm_id):
+                yield farm_id
+
+    def _create(self, model, **values):
+        """Create entity in state engine, if it's enabled, in DB otherwise."""
+        if self.state is not None:
+            return self.state.create(model, **values)
+        if self.shards is None or model not in habibi_db.SHARDED_ENTITIES:
+            return model.create(**values)
+
+        parent_field = model._meta.fields[self.shards.parent_fields[model]]
+        parent_model, parent_pk = parent_field.rel_model, values[parent_field.name]
+        with self._scope(parent_model, parent_pk):
+            farm_id = self.shards.farm_of(parent_model, parent_pk)
+            if parent_model in habibi_db.SHARDED_ENTITIES:
+                # Cache parent in entity, it can't be read from the shard later
+                values[parent_field.name] = parent_model.get(parent_model.id == parent_pk)
+            entity = model.create(**values)
+        self.shards.remember(model, entity.id, farm_id)
+        return entity
+
+    def _invalidate_gvs(self, model, ids):
+        """Drop cached GVs, that were calculated from `model` entities with primary keys from `ids`."""
+        if self.gv_cache is not None:
+            scope = habibi_db.get_scope_from_model(model)
+            for pk in ids:
+                self.gv_cache.invalidate(scope, pk)
+
+    def _update(self, model, ids, **values):
+        """Update fields of `model` entities with primary keys from `ids`."""
+        self._invalidate_gvs(model, ids)
+        if self.state is not None:
+            for pk in ids:
+                self.state.update(model, pk, **values)
+        elif self.shards is not None and model in habibi_db.SHARDED_ENTITIES:
+            for farm_id, farm_ids in six.iteritems(self.shards.group_by_farm(model, ids)):
+                with self.shards.using(farm_id):
+                    model.update(**values).where(model._meta.primary_key.in_(farm_ids)).execute()
+        else:
+            model.update(**values).where(model._meta.primary_key.in_(ids)).execute()
+
+    def _delete(self, model, entity):
+        self._invalidate_gvs(model, [entity.id])
+        if self.state is not None:
+            self.state.delete(model, entity.pk)
+        else:
+            entity.delete_instance()
 
     def __getattr__(self, item):
         """Get single habibi entity by id
@@ -139,10 +458,32 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
                 raise habibi_exc.HabibiApiException('Unknown habibi entity "{}"'.format(scope))
 
             def search_fn(*args, **kwargs):
-                ret = self._find_entities(model, *args, **kwargs)
+                with self.tracer.span(item, 'api') if self.tracer is not None else habibi_tracing.NO_SPAN:
+                    if self.metrics is not None:
+                        return self.metrics.timed('api', item, _search, args, kwargs)
+                    return _search(*args, **kwargs)
+
+            def _search(*args, **kwargs):
+                try:
+                    ret = [to_dict(_obj)
+                           for _obj in self._find_entities(model, *args, **kwargs)]
+                except habibi_exc.HabibiApiNotFound:
+                    ret = []
+                    if self._get_archive(model) is None:
+                        raise
+
+                archive = self._get_archive(model)
+                if archive is not None and (not args or len(ret) < len(args)):
+                    found_ids = set(str(_obj['id']) for _obj in ret)
+                    missing_ids = [_id for _id in args if str(_id) not in found_ids]
+                    if not args or missing_ids:
+                        ret += archive.find(model, missing_ids, kwargs)
+                    if not ret:
+                        raise habibi_exc.HabibiApiNotFound(model, args, kwargs)
+
                 if not plural:
-                    return db_shortcuts.model_to_dict(ret[0])
-                return [db_shortcuts.model_to_dict(_obj) for _obj in ret]
+                    return ret[0]
+                return ret
 
             return search_fn
 
@@ -154,7 +495,7 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
            :param string name: Unique name for the new farm.
            :returns: JSON representation of new farm.
         """
-        return habibi_db.Farm.create(name=name)
+        return self._create(habibi_db.Farm, name=name)
 
     def create_role(self, name, image, behaviors=None):
         """Create new habibi role, save to DB.
@@ -163,12 +504,12 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
         :param list behaviors: list of role's behaviors
         """
         behaviors = (behaviors is not None) and behaviors or ["base"]
-        return habibi_db.Role.create(name=name, image=image, behaviors=behaviors)
+        return self._create(habibi_db.Role, name=name, image=image, behaviors=behaviors)
 
     def farm_add_role(self, farm_id, role_id, orchestration=None):
         """Add role to farm, which results in creating new farm_role."""
         orchestration = orchestration or dict()
-        return habibi_db.FarmRole.create(farm=farm_id, role=role_id, orchestration=orchestration)
+        return self._create(habibi_db.FarmRole, farm=farm_id, role=role_id, orchestration=orchestration)
 
     def farm_remove_role(self, farm_id, farm_role_id):
         """
@@ -177,35 +518,44 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
         """
         farm_role = self._find_entities(habibi_db.FarmRole, farm_role_id, farm=farm_id)[0]
 
-        for server in farm_role.servers:
-            self._terminate_server(server)
+        with self._scope(habibi_db.Farm, farm_id):
+            for server in list(farm_role.servers):
+                self._terminate_server(server)
 
-        farm_role.delete_instance()
+        self._delete(habibi_db.FarmRole, farm_role)
 
     def farm_terminate(self, farm_id):
         """Set Farm status to 'terminated', terminate all farm's servers."""
         farm = self._find_entities(habibi_db.Farm, farm_id)[0]
-        servers = itertools.chain([farm_role.servers for farm_role in farm.farm_roles])
+        with self._scope(habibi_db.Farm, farm_id):
+            servers = list(itertools.chain.from_iterable(farm_role.servers for farm_role in farm.farm_roles))
         for server in servers:
             self._terminate_server(server)
 
-        habibi_db.Farm.update(status='terminated').where(id=farm_id).execute()
+        self._update(habibi_db.Farm, [farm_id], status='terminated')
 
-    def create_server(self, farm_role_id, server_id=None, volumes=None):
+    def create_server(self, farm_role_id, server_id=None, volumes=None, status=None):
         """Creates server record in DB.
 
         :param zone:
         :param volumes:
+        :param status: initial status, 'pending launch' by default
 
         :return:
         """
         server_id = server_id or str(uuid.uuid4())
         volumes = volumes or dict()
-        with self.database.atomic():
+        crypto_key = self.key_pool.get()
+        fields = status and dict(status=status) or dict()
+        if self.state is not None:
+            return self.state.create(habibi_db.Server, id=server_id, farm_role=farm_role_id, volumes=volumes,
+                                     crypto_key=crypto_key, **fields)
+        # In sharded mode index is unique within the farm
+        with self._scope(habibi_db.FarmRole, farm_role_id), habibi_db.SHARD_PROXY.atomic():
             latest_index = habibi_db.Server.select(peewee.fn.Max(habibi_db.Server.index)).scalar()
             index_for_new_server = latest_index and (latest_index + 1) or 1
-            return habibi_db.Server.create(index=index_for_new_server, id=server_id,
-                                           farm_role=farm_role_id, volumes=volumes)
+            return self._create(habibi_db.Server, index=index_for_new_server, id=server_id,
+                                farm_role=farm_role_id, volumes=volumes, crypto_key=crypto_key, **fields)
 
     def run_server(self, server_id, cmd, env=None):
         """Run docker container for the server, created earlier using `create_server`.
@@ -224,9 +574,10 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
         container_id = create_result['Id']
         self.docker.start(container=container_id)
 
-        habibi_db.Server.update(host_machine=socket.gethostname(),
-                                container_id=container_id,
-                                status='pending').where(habibi_db.Server.id == server_id).execute()
+        # With several docker daemons, pool tells, which one runs the container
+        host_machine = create_result.get('Host') or socket.gethostname()
+        self._update(habibi_db.Server, [server_id], host_machine=host_machine,
+                     container_id=container_id, status='pending')
         return container_id
 
     def terminate_server(self, server_id):
@@ -240,7 +591,8 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
 
         self.docker.kill(server.container_id)
         self.docker.remove_container(server.container_id)
-        habibi_db.Server.update(status='terminated').where(habibi_db.Server.id == server.id).execute()
+        self._update(habibi_db.Server, [server.id], status='terminated',
+                     terminated_at=datetime.datetime.now())
 
     def get_server_output(self, server_id):
         """Retrieve output of container for the server with id=`server_id`."""
@@ -250,7 +602,7 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
                     'Server has not been started yet. server_id={}'.format(server_id))
         return self.docker.logs(server['container_id'])
 
-    def orchestrate_event(self, event_id):
+    def orchestrate_event(self, event_id, compact=False, stream=False):
         """Calculate EventOrchestration for the event_id.
 
            Little explanation: Calculate targets of orchestration rules,
@@ -259,6 +611,11 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
            More detailed info: `https://scalr-wiki.atlassian.net/wiki/display/docs/Orchestration+Rules`
 
            :type event_id: integer
+           :param compact: if set, GVs with the same value for all target servers
+               are returned once, in `shared_global_variables`, and only the rest of them
+               for every server. `expand_orchestration` restores full format.
+           :param stream: if set, `server_to_rules_mapping` is a generator, items are built
+               while response is encoded by `habibi.utils.jsonstream.iterencode`.
            :returns: JSON representation of EventOrchestration (see private wiki for more info)
         """
         event = self._find_entities(habibi_db.Event, event_id)[0]
@@ -269,13 +626,13 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
 
         """Collect all servers of the farm, where event occured."""
         servers = []
-        for fr in farm.farm_roles:
-            for s in fr.servers:
-                if s.status in ('terminated', 'pending terminate', 'pending launch'):
-                    continue
-                s.farm_role_id = fr.id
-                s.behaviors = set(fr.role.behaviors)
-                servers.append(s)
+        with self._scope(habibi_db.Farm, farm.id):
+            for fr in farm.farm_roles:
+                behaviors = set(fr.role.behaviors)
+                for s in fr.servers:
+                    if s.status in ('terminated', 'pending terminate', 'pending launch'):
+                        continue
+                    servers.append(ServerInfo(s.id, fr.id, behaviors))
 
         matched_rules = []
         mapping = {}
@@ -287,7 +644,7 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
             if target['type'] == 'triggering-server':
                 sids.append(server.id)
             elif target['type'] == 'behavior':
-                sids += [s.id for s in servers if set(target['behaviors']) | s.behaviors]
+                sids += [s.id for s in servers if set(target['behaviors']) & s.behaviors]
             elif target['type'] == 'farm-role':
                 sids += [s.id for s in servers if s.farm_role_id in target['farm_roles']]
             elif target['type'] == 'farm':
@@ -302,23 +659,183 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
                     mapping[sid].append(rule_index)
 
         gvs = self.calculate_global_variables('server', mapping.keys(), event_id)
-        LOG.info('orchestrate_event: gvs: {}'.format(gvs))
-        LOG.info('orchestrate_event: mapping: {}'.format(mapping))
-        return {
+        # Formatted only if logged: for big farms these are huge
+        LOG.info('orchestrate_event: gvs: %s', gvs)
+        LOG.info('orchestrate_event: mapping: %s', mapping)
+
+        shared = compact and shared_items(six.itervalues(gvs)) or dict()
+
+        def global_variables(variables):
+            return [{'name': key, 'value': value, 'hidden': False}
+                    for key, value in variables.items() if key not in shared]
+
+        server_to_rules_mapping = ({
+            'server_id': server_id,
+            'global_variables': global_variables(gvs[server_id]),
+            'rule_indexes': rule_indexes}
+            for server_id, rule_indexes in mapping.items())
+
+        orchestration = {
             'rules': matched_rules,
-            'server_to_rules_mapping': [{
-                'server_id': server_id,
-                'global_variables': [
-                    {'name': key, 'value': value, 'hidden': False} \
-                    for key, value in gvs[server_id].items()],
-                'rule_indexes': rule_indexes} \
-                for server_id, rule_indexes in mapping.items()]}
+            'server_to_rules_mapping': stream and server_to_rules_mapping or list(server_to_rules_mapping)}
+        if compact:
+            orchestration['shared_global_variables'] = [
+                {'name': key, 'value': value, 'hidden': False} for key, value in shared.items()]
+        return orchestration
 
     def create_event(self, name, triggering_server_id, event_id=None):
-        """Create new event, that was triggered by server."""
+        """Create new event, that was triggered by server.
+
+           If api was created with `event_batch_size` (and without state engine),
+           event is queued and saved to DB later. Triggering server is read either way,
+           so returned dict is the same.
+        """
         event_id = event_id or str(uuid.uuid4())
-        return habibi_db.Event.create(name=name, triggering_server=triggering_server_id, id=event_id)
+        if self._event_queue is None or self.state is not None:
+            return self._create(habibi_db.Event, name=name, triggering_server=triggering_server_id, id=event_id)
+
+        # Event of unknown server could not be saved later (in sharded mode there is no shard for it)
+        server = self._find_entities(habibi_db.Server, triggering_server_id)[0]
+        event = habibi_db.Event(name=name, triggering_server=server, id=event_id)
+        self._event_queue.put(dict(name=name, triggering_server=server.id, id=event_id,
+                                   created_at=event.created_at))
+        return event
+
+    def flush_events(self):
+        """Save events, queued by `create_event`, to DB.
+           With state engine, all queued writes are saved.
+        """
+        if self._event_queue is not None:
+            self._event_queue.flush()
+        if self.state is not None:
+            self.state.flush()
+
+    def _insert_events(self, rows):
+        """Save events, queued by `create_event`. In sharded mode, every farm's events
+           are saved in separate transaction: saved rows are removed from `rows`,
+           so the queue retries only the rest, if saving fails.
+        """
+        # Queue may be flushed, when other api is connected: events belong to this api's DB
+        with habibi_db.using(self.database):
+            if self.shards is None:
+                with self.database.atomic():
+                    habibi_db.bulk_insert(habibi_db.Event, rows)
+                return
 
+            rows_by_farm = collections.OrderedDict()
+            unknown = []
+            for row in rows:
+                farm_id = self.shards.farm_of(habibi_db.Server, row['triggering_server'])
+                if farm_id is None:
+                    unknown.append(row['triggering_server'])
+                    continue
+                rows_by_farm.setdefault(farm_id, []).append(row)
+            for farm_id, farm_rows in six.iteritems(rows_by_farm):
+                with self.shards.using(farm_id), habibi_db.SHARD_PROXY.atomic():
+                    habibi_db.bulk_insert(habibi_db.Event, farm_rows)
+                for row in farm_rows:
+                    self.shards.remember(habibi_db.Event, row['id'], farm_id)
+                saved = set(row['id'] for row in farm_rows)
+                rows[:] = [row for row in rows if row['id'] not in saved]
+            if unknown:
+                raise habibi_exc.HabibiApiNotFound(habibi_db.Server, unknown, None)
+
+
+    def _fixture_path(self, name):
+        extension = isinstance(self.database, peewee.SqliteDatabase) and 'sqlite' or 'json'
+        return os.path.join(self.base_dir, 'fixtures', '{}.{}'.format(name, extension))
+
+    def _check_fixtures_supported(self):
+        if self.shards is not None:
+            raise habibi_exc.HabibiApiException('Fixtures are not supported in sharded mode')
+
+    def save_fixture(self, name):
+        """Save current state of DB as named fixture in `base_dir`.
+
+           :returns: path to fixture file
+        """
+        self._check_fixtures_supported()
+        self.flush_events()
+        path = self._fixture_path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        habibi_db.save_snapshot(self.database, path)
+        return path
+
+    def load_fixture(self, name):
+        """Replace contents of DB with fixture, saved earlier by `save_fixture`."""
+        self._check_fixtures_supported()
+        path = self._fixture_path(name)
+        if not os.path.exists(path):
+            raise habibi_exc.HabibiApiException('Fixture "{}" not found in {}'.format(name, path))
+        self.flush_events()
+        habibi_db.restore_snapshot(self.database, path)
+        if self.state is not None:
+            self.state.load()
+        if self.gv_cache is not None:
+            self.gv_cache.clear()
+
+    def _get_archive(self, model=None):
+        """Return archive, if it was ever created in `base_dir`, None otherwise.
+           If `model` is passed, return None for models, that are never archived.
+        """
+        if model is not None and model not in habibi_archive.Archive.archive_models:
+            return None
+        if self._archive is None and os.path.exists(self._archive_path):
+            self._archive = habibi_archive.Archive(self._archive_path)
+        return self._archive
+
+    def archive_old_entities(self, retention_period=None):
+        """Move events, older than `retention_period` seconds, and servers,
+           terminated earlier than that, from hot DB to the archive
+           (sqlite file in `base_dir`). Archived entities are still returned
+           by `get_*` and `find_*` methods.
+
+           Rows are moved in small batches, each batch in its own short transaction,
+           so concurrent api calls are not blocked for long.
+
+           :returns: dict with numbers of archived events and servers
+        """
+        if retention_period is None:
+            retention_period = self.retention_period
+        if retention_period is None:
+            raise habibi_exc.HabibiApiException('Retention period is not set')
+        if self._get_archive() is None:
+            self._archive = habibi_archive.Archive(self._archive_path)
+        self.flush_events()
+
+        Event, Server = habibi_db.Event, habibi_db.Server
+        FarmRole, Farm, Role = habibi_db.FarmRole, habibi_db.Farm, habibi_db.Role
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=retention_period)
+
+        # Related models are joined, so model_to_dict won't query them one by one
+        old_events = (Event.select(Event, Server, FarmRole, Farm, Role)
+                      .join(Server).join(FarmRole).join(Farm).switch(FarmRole).join(Role)
+                      .where(Event.created_at < cutoff))
+        old_servers = (Server.select(Server, FarmRole, Farm, Role)
+                       .join(FarmRole).join(Farm).switch(FarmRole).join(Role)
+                       .where((Server.status == 'terminated') &
+                              (Server.terminated_at < cutoff) &
+                              (Server.id.not_in(Event.select(Event.triggering_server)))))
+
+        archived = dict(events=0, servers=0)
+        for _ in self._each_shard():
+            for model, query, counter in ((Event, old_events, 'events'), (Server, old_servers, 'servers')):
+                while True:
+                    batch = list(query.limit(self.retention_batch_size))
+                    if not batch:
+                        break
+                    # Copy first: if we fail between copy and delete, copy is repeated next time
+                    self._archive.store(model, batch)
+                    with model._meta.database.atomic():
+                        model.delete().where(model.id.in_([obj.id for obj in batch])).execute()
+                    if self.state is not None:
+                        self.state.forget(model, [obj.id for obj in batch])
+                    self._invalidate_gvs(model, [obj.id for obj in batch])
+                    archived[counter] += len(batch)
+
+        LOG.info('Archived %(events)s events and %(servers)s servers', archived)
+        return archived
 
     def set_global_variable(self, gv_name, gv_value, scope, scope_id):
         """Set value of user-defined GV in the provided scope.
@@ -338,13 +855,14 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
         with self.database.atomic():
             try:
                 values_for_scopes = self.get_global_variable(name=gv_name)['scopes']
-                values_for_scopes[scope][scope_id] = gv_value
-                habibi_db.GlobalVariable.update(scopes=values_for_scopes).where(
-                    habibi_db.GlobalVariable.name == gv_name).execute()
+                values_for_scopes[scope][str(scope_id)] = gv_value
+                self._update(habibi_db.GlobalVariable, [gv_name], scopes=values_for_scopes)
             except habibi_exc.HabibiNotFound:
                 scopes = dict((scope, dict()) for scope in self._gv_scopes)
-                scopes[scope][scope_id] = gv_value
-                habibi_db.GlobalVariable.create(name=gv_name, scopes=scopes)
+                scopes[scope][str(scope_id)] = gv_value
+                self._create(habibi_db.GlobalVariable, name=gv_name, scopes=scopes)
+        if self.gv_cache is not None:
+            self.gv_cache.invalidate_user_defined(scope, scope_id)
 
 
     def calculate_global_variables(self, scope, scope_ids, event_id=None, user_defined=False):
@@ -365,27 +883,95 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
         """
         if not isinstance(scope_ids, (list, tuple)):
             scope_ids = [scope_ids]
+        if not scope_ids:
+            return dict()
 
         if scope not in self._gv_scopes:
             raise habibi_exc.HabibiApiException(
                 "Unknown scope for GVs (global variables): {}".format(scope))
-        scope_model = habibi_db.get_model_from_scope(scope)
-
-        def to_str(value):
-            return value is None and '' or str(value)
 
         # Mapping {scope_id1: {gv1: value, gv2: value}, scope_id2: {...}}
-        gvs = dict((_id, dict()) for _id in scope_ids)
-        try:
-            global_vars_list = self._find_entities(habibi_db.GlobalVariable)
-        except habibi_exc.HabibiApiNotFound:
-            global_vars_list = list()
+        gvs = dict()
+        # Ids of existing entities, event-related GVs are added only for them
+        found = []
+        cache = self.gv_cache
+        missing = list(scope_ids)
+        if cache is not None:
+            version = cache.version
+            missing = []
+            for _id in scope_ids:
+                gvs[_id] = cache.get(cache.key(scope, _id, None, user_defined))
+                if gvs[_id] is None:
+                    missing.append(_id)
+                else:
+                    found.append(_id)
+
+        if missing:
+            try:
+                resolved = self._resolve_global_variables(scope, missing, user_defined)
+            except habibi_exc.HabibiApiNotFound:
+                # Like without cache, error is raised only if none of servers exist
+                if not found:
+                    raise
+                resolved = dict((_id, (dict(), None)) for _id in missing)
+            for _id, (variables, entities) in six.iteritems(resolved):
+                gvs[_id] = variables
+                if entities is None:
+                    continue
+                found.append(_id)
+                if cache is not None:
+                    cache.put(cache.key(scope, _id, None, user_defined), variables, entities, version)
+
+        if scope == 'server' and event_id:
+            # Event-related GVs are the same for every server, so they are cached once per event
+            event_gvs = cache is not None and cache.get(cache.key('event', event_id)) or None
+            if event_gvs is None:
+                event = self._find_entities(habibi_db.Event, event_id)[0]
+                event_gvs, entities = self._event_global_variables(event)
+                if cache is not None:
+                    cache.put(cache.key('event', event_id), event_gvs, entities, version)
+            for _id in found:
+                gvs[_id].update(event_gvs)
+
+        return gvs
+
+    @staticmethod
+    def _gv_entities(server):
+        """Return (scope, id) of entities, that server-related GVs are calculated from."""
+        farm_role = server.farm_role
+        return [('server', server.id), ('farm_role', farm_role.id),
+                ('farm', farm_role.farm.id), ('role', farm_role.role.id)]
+
+    def _event_global_variables(self, event):
+        """Return event-related GVs and (scope, id) of entities, they are calculated from."""
+        triggering_server = event.triggering_server
+        role = triggering_server.farm_role.role
+        variables = dict(
+            SCALR_EVENT_NAME=event.name,
+            SCALR_EVENT_EXTERNAL_IP=triggering_server.public_ip,
+            SCALR_EVENT_INTERNAL_IP=triggering_server.private_ip,
+            SCALR_EVENT_ROLE_NAME=role.name,
+            SCALR_EVENT_INSTANCE_INDEX=triggering_server.index,
+            SCALR_EVENT_BEHAVIORS=','.join(role.behaviors),
+            SCALR_EVENT_INSTANCE_ID=triggering_server.id,
+            SCALR_EVENT_AMI_ID=role.image
+        )
+        return variables, [('event', event.id)] + self._gv_entities(triggering_server)
+
+    def _resolve_global_variables(self, scope, scope_ids, user_defined=False):
+        """Calculate GVs of the scope without event-related ones.
+
+           :return: {scope_id: (gvs, entities)}, where entities are (scope, id) of entities,
+               GVs were calculated from, or None if entity with `scope_id` doesn't exist.
+        """
+        scope_model = habibi_db.get_model_from_scope(scope)
+        gvs = dict((_id, (dict(), scope != 'server' and [(scope, _id)] or None)) for _id in scope_ids)
 
         if scope == 'server':
-            server_models = self._find_entities(habibi_db.Server, *scope_ids)
-            for server in server_models:
+            entities = self._find_entities(habibi_db.Server, *scope_ids)
+            for server in entities:
                 # Add server-scoped variables
-                gvs[server.id].update(dict(
+                gvs[server.id] = (dict(
                     SCALR_BEHAVIORS=','.join(server.farm_role.role.behaviors),
                     SCALR_FARM_ROLE_ID=server.farm_role.id,
                     SCALR_FARM_ID=server.farm_role.farm.id,
@@ -393,58 +979,50 @@ class HabibiApi(six.with_metaclass(MetaReturnDicts, object)):
                     SCALR_INSTANCE_INDEX=server.index,
                     SCALR_INTERNAL_IP=server.private_ip,
                     SCALR_EXTERNAL_IP=server.public_ip
-                ))
-
-            if event_id:
-                event = self._find_entities(habibi_db.Event, event_id)[0]
-                for server in server_models:
-                    gvs[server.id].update(dict(
-                        SCALR_EVENT_NAME=event.name,
-                        SCALR_EVENT_EXTERNAL_IP=event.triggering_server.public_ip,
-                        SCALR_EVENT_INTERNAL_IP=event.triggering_server.private_ip,
-                        SCALR_EVENT_ROLE_NAME=event.triggering_server.farm_role.role.name,
-                        SCALR_EVENT_INSTANCE_INDEX=event.triggering_server.index,
-                        SCALR_EVENT_BEHAVIORS=','.join(event.triggering_server.farm_role.role.behaviors),
-                        SCALR_EVENT_INSTANCE_ID=event.triggering_server.id,
-                        SCALR_EVENT_AMI_ID=event.triggering_server.farm_role.role.image
-                    ))
-
-        return gvs
+                ), self._gv_entities(server))
+        elif user_defined:
+            entities = self._find_entities(scope_model, *scope_ids)
 
-        """
-        def update_vars_from_scope(scope, scope_id, model=None):
-            if scope in processed_scopes:
-                return
-
-            if model is None:
-                model = getattr(self, "get_{0}".format(scope))(scope_id)
-
-            for gv in global_vars_list:
-                if gv.name in gvs:
-                    # GV with such name was redefined on lower scope
-                    continue
-                try:
-                    value_for_scope = gv.scopes[scope][scope_id]
-                except KeyError:
+        if user_defined:
+            try:
+                global_vars_list = self._find_entities(habibi_db.GlobalVariable)
+            except habibi_exc.HabibiApiNotFound:
+                global_vars_list = list()
+            by_id = dict((str(entity.id), entity) for entity in entities)
+            for _id in scope_ids:
+                entity = by_id.get(str(_id))
+                if entity is None:
+                    gvs[_id] = (dict(), None)
                     continue
+                chain = self._gv_chain(scope, entity)
+                variables = self._user_defined_gvs(global_vars_list, chain)
+                # System GVs can't be redefined
+                variables.update(gvs[_id][0])
+                gvs[_id] = (variables, chain)
 
-                gvs[scope_id][gv.name] = value_for_scope
-
-            processed_scopes.append(scope)
-            if scope in self.scopes_graph:
-                parents = sorted(six.iteritems(self.scopes_graph[scope]), key=lambda x: x[1],
-                                 reverse=True)
-
-                for parent, _ in parents:
-                    parent_id = getattr(model, parent).id
-                    update_vars_from_scope(parent, parent_id)
-
-        if user_defined:
-            scope_ids = six.map(str, scope_ids)
-            processed_scopes = list()
-            for scope_id in scope_ids:
-                update_vars_from_scope(scope, scope_id)
+        return gvs
 
-        return [{'name': key, 'value': to_str(value), 'private': 0}
-                for key, value in six.iteritems(gvs) if value]
+    def _gv_chain(self, scope, entity):
+        """Return (scope, id) of `entity` and of scopes, it inherits user-defined GVs from,
+           highest precedence first: server, farm role, farm, role.
         """
+        chain = [(scope, entity.id)]
+        parents = sorted(six.iteritems(self._gv_scopes_resolution.get(scope, {})),
+                         key=lambda item: item[1], reverse=True)
+        for parent, _ in parents:
+            chain += self._gv_chain(parent, getattr(entity, parent))
+        return chain
+
+    @staticmethod
+    def _user_defined_gvs(global_vars_list, chain):
+        """Values of user-defined GVs, set in scopes of `chain`: value of the first scope wins."""
+        variables = dict()
+        for gv in global_vars_list:
+            for scope, scope_id in chain:
+                # JSON keys are strings
+                values = gv.scopes.get(scope) or dict()
+                if str(scope_id) in values:
+                    value = values[str(scope_id)]
+                    variables[gv.name] = value is None and '' or str(value)
+                    break
+        return variables
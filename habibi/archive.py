@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.archive
+    ~~~~~~~~~~~~~~
+
+    Cold storage for events and terminated servers, that are no longer
+    interesting for running tests, but still may be looked up by id.
+    Archive lives in separate sqlite file, so it never competes
+    for write lock with the hot habibi DB.
+"""
+import json
+import datetime
+
+import six
+import peewee
+import playhouse.shortcuts as db_shortcuts
+
+import habibi.db as habibi_db
+
+
+ARCHIVE_PROXY = peewee.Proxy()
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+class ArchivedEntity(peewee.Model):
+    """Snapshot of hot entity, as api returned it (with related entities)."""
+    id = peewee.CharField(primary_key=True)
+    # Indexed columns, used for searching
+    name = peewee.CharField(null=True, index=True)
+    parent_id = peewee.CharField(null=True, index=True)
+    archived_at = peewee.DateTimeField(default=datetime.datetime.now)
+    data = peewee.TextField()
+
+    class Meta(object):
+        database = ARCHIVE_PROXY
+
+    def to_dict(self):
+        return json.loads(self.data)
+
+
+class ArchivedEvent(ArchivedEntity):
+    class Meta(object):
+        db_table = 'habibi_archived_events'
+
+
+class ArchivedServer(ArchivedEntity):
+    class Meta(object):
+        db_table = 'habibi_archived_servers'
+
+
+class Archive(object):
+    """Moves old rows from hot models to the archive and finds them there.
+
+       :param path: path to archive sqlite file
+    """
+
+    archive_models = {
+        habibi_db.Event: (ArchivedEvent, 'name', 'triggering_server'),
+        habibi_db.Server: (ArchivedServer, 'status', 'farm_role'),
+    }
+
+    def __init__(self, path):
+        self.database = peewee.SqliteDatabase(path)
+        ARCHIVE_PROXY.initialize(self.database)
+        for archive_model, _, _ in self.archive_models.values():
+            archive_model.create_table(fail_silently=True)
+
+    def store(self, model, objects):
+        """Save `objects` of hot `model` to archive. Saving same object twice is safe."""
+        archive_model, name_attr, parent_attr = self.archive_models[model]
+        rows = []
+        for obj in objects:
+            data = db_shortcuts.model_to_dict(obj)
+            parent = data[parent_attr]
+            rows.append(dict(id=str(obj.id),
+                             name=data[name_attr],
+                             parent_id=str(parent['id'] if isinstance(parent, dict) else parent),
+                             data=json.dumps(data, default=_json_default)))
+        with self.database.atomic():
+            for i in range(0, len(rows), habibi_db.SQLITE_MAX_VARIABLES // 5):
+                archive_model.insert_many(rows[i:i + habibi_db.SQLITE_MAX_VARIABLES // 5]).upsert().execute()
+
+    def find(self, model, ids=None, kwargs=None):
+        """Find archived entities of hot `model`.
+           Filters have the same meaning as in `HabibiApi._find_entities`.
+
+           :rtype: list of dicts
+        """
+        archive_model, name_attr, parent_attr = self.archive_models[model]
+        kwargs = dict(kwargs or {})
+        query = archive_model.select()
+        if ids:
+            query = query.where(archive_model.id.in_([str(_id) for _id in ids]))
+        if name_attr in kwargs:
+            query = query.where(archive_model.name == kwargs.pop(name_attr))
+        if parent_attr in kwargs:
+            query = query.where(archive_model.parent_id == str(kwargs.pop(parent_attr)))
+
+        found = []
+        for archived in query:
+            data = archived.to_dict()
+            for k, v in six.iteritems(kwargs):
+                value = data.get(k)
+                if isinstance(value, dict):
+                    value = value.get('id')
+                if value != v:
+                    break
+            else:
+                found.append(data)
+        return found
@@ -1,38 +1,321 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import sys
 import json
+import time
 import logging
+import sqlite3
+import datetime
+import threading
+import contextlib
 
 import six
 import peewee
-from playhouse import db_url
 
 import habibi.exc
 
 
-DB_PROXY = peewee.Proxy()
+class RoutingProxy(peewee.Proxy):
+    """Proxy, that may be pointed to another database for the current thread, see `using`.
+       Otherwise points to the database it was initialized with.
+    """
+
+    def __init__(self):
+        # Proxy allows to set only its own slots
+        object.__setattr__(self, '_local', threading.local())
+        super(RoutingProxy, self).__init__()
+
+    def __getattr__(self, attr):
+        database = getattr(self._local, 'database', None)
+        if database is not None:
+            return getattr(database, attr)
+        return super(RoutingProxy, self).__getattr__(attr)
+
+    @contextlib.contextmanager
+    def using(self, database):
+        previous = getattr(self._local, 'database', None)
+        self._local.database = database
+        try:
+            yield database
+        finally:
+            self._local.database = previous
+
+
+DB_PROXY = RoutingProxy()
+# Database of models, which rows are kept in per-farm databases in sharded mode
+SHARD_PROXY = RoutingProxy()
 LOG = logging.getLogger(__name__)
+SQLITE_MAX_VARIABLES = 999
+# Increment on every change of models, DB with older schema gets missing tables and columns created
+SCHEMA_VERSION = 3
+# Callables, that are called after every executed SQL statement, see `add_sql_listener`
+SQL_LISTENERS = []
 
 
 def connect_to_db(url):
     """Connect to DB specified in url,
-       create tables for all habibi models.
+       create tables for all habibi models, unless schema is up to date.
 
     :type  url: str
     :param url: Database url connection string.
     :return: database` object
     :return type: peewee.Database
     """
+    from playhouse import db_url
+
     database = db_url.connect(url)
     database.register_fields({'json': 'json'})
+    _notify_sql_listeners(database)
 
     DB_PROXY.initialize(database)
-    for model in SCALR_ENTITIES:
-        model.create_table(fail_silently=True)
+    SHARD_PROXY.initialize(database)
+    if get_schema_version() != SCHEMA_VERSION:
+        with database.atomic():
+            for model in SCALR_ENTITIES + (SchemaVersion,):
+                model.create_table(fail_silently=True)
+            _add_missing_columns(database, SCALR_ENTITIES)
+            SchemaVersion.delete().execute()
+            SchemaVersion.create(version=SCHEMA_VERSION)
     return database
 
 
+class ShardDatabase(peewee.SqliteDatabase):
+    """Sqlite database of one farm. Shared database, which holds global entities,
+       is attached to every connection, so queries can join tables of both.
+    """
+
+    def __init__(self, database, catalog_path, **kwargs):
+        self.catalog_path = catalog_path
+        super(ShardDatabase, self).__init__(database, **kwargs)
+
+    def _add_conn_hooks(self, conn):
+        super(ShardDatabase, self)._add_conn_hooks(conn)
+        conn.execute('ATTACH DATABASE ? AS catalog', (self.catalog_path,))
+
+
+@contextlib.contextmanager
+def using(database):
+    """Route queries of all models to `database` in the current thread.
+       Proxies point to the database, connected last, otherwise: e.g. writes,
+       deferred by api, must be flushed to its own database, even if other api connected later.
+       None leaves the default database.
+    """
+    with DB_PROXY.using(database), SHARD_PROXY.using(database):
+        yield database
+
+
+def connect_to_shard(path, catalog_path):
+    """Connect to per-farm sqlite database at `path`, create tables for `SHARDED_ENTITIES`.
+
+    :param catalog_path: path to sqlite file of shared database, connected by `connect_to_db`
+    """
+    database = ShardDatabase(path, catalog_path)
+    database.register_fields({'json': 'json'})
+    _notify_sql_listeners(database)
+    with SHARD_PROXY.using(database):
+        with database.atomic():
+            for model in SHARDED_ENTITIES:
+                model.create_table(fail_silently=True)
+            _add_missing_columns(database, SHARDED_ENTITIES)
+    return database
+
+
+def _add_missing_columns(database, models):
+    """Add columns for fields, that were added to `models` after their tables were created.
+       New fields must be nullable or have default.
+    """
+    from playhouse import migrate
+
+    migrator = migrate.SchemaMigrator.from_database(database)
+    operations = []
+    for model in models:
+        table = model._meta.db_table
+        existing = set(column.name for column in database.get_columns(table))
+        for field in model._meta.get_fields():
+            if field.db_column not in existing:
+                LOG.info('Adding column %s.%s', table, field.db_column)
+                operations.append(migrator.add_column(table, field.db_column, field))
+    migrate.migrate(*operations)
+
+
+def get_schema_version():
+    """Return version of habibi schema in connected DB, None if there is no schema."""
+    try:
+        return SchemaVersion.select(SchemaVersion.version).scalar()
+    except (peewee.OperationalError, peewee.ProgrammingError):
+        DB_PROXY.rollback()
+        return None
+
+
+def add_sql_listener(fn):
+    """Call `fn(sql, params, duration)` after every SQL statement, executed through habibi DB."""
+    SQL_LISTENERS.append(fn)
+
+
+def remove_sql_listener(fn):
+    if fn in SQL_LISTENERS:
+        SQL_LISTENERS.remove(fn)
+
+
+def _notify_sql_listeners(database):
+    execute_sql = database.execute_sql
+
+    def execute_sql_and_notify(sql, params=None, require_commit=True):
+        if not SQL_LISTENERS:
+            return execute_sql(sql, params, require_commit)
+        start = time.time()
+        try:
+            return execute_sql(sql, params, require_commit)
+        finally:
+            duration = time.time() - start
+            for listener in list(SQL_LISTENERS):
+                listener(sql, params, duration)
+
+    database.execute_sql = execute_sql_and_notify
+
+
+def bulk_insert(model, rows):
+    """Insert `rows` (list of dicts) into `model` table using multi-row INSERTs,
+       sized to stay under sqlite's limit of bound variables per statement.
+    """
+    rows_per_query = max(1, SQLITE_MAX_VARIABLES // len(model._meta.fields))
+    for i in range(0, len(rows), rows_per_query):
+        model.insert_many(rows[i:i + rows_per_query]).execute()
+
+
+def save_snapshot(database, path):
+    """Save all habibi tables of `database` to file at `path`.
+
+       Sqlite databases (including in-memory) are saved as sqlite file,
+       other databases as JSON.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    if not isinstance(database, peewee.SqliteDatabase):
+        return _save_json_snapshot(path)
+
+    conn = database.get_conn()
+    if hasattr(conn, 'backup'):
+        # Page-level copy, python 3.7+
+        target = sqlite3.connect(path)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+        return
+
+    database.execute_sql('ATTACH DATABASE ? AS snapshot', (path,))
+    try:
+        with database.atomic():
+            for model in _snapshot_models():
+                table = model._meta.db_table
+                create_sql = database.execute_sql(
+                    "SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+                database.execute_sql(create_sql.replace('"{}"'.format(table), 'snapshot."{}"'.format(table), 1))
+                database.execute_sql('INSERT INTO snapshot."{0}" ({1}) SELECT {1} FROM main."{0}"'.format(
+                    table, _column_list(model)))
+    finally:
+        database.execute_sql('DETACH DATABASE snapshot')
+
+
+def restore_snapshot(database, path):
+    """Replace contents of habibi tables in `database` with snapshot,
+       saved by `save_snapshot`. Snapshot must have the same schema version.
+    """
+    if not isinstance(database, peewee.SqliteDatabase):
+        return _restore_json_snapshot(database, path)
+
+    conn = database.get_conn()
+    if hasattr(conn, 'backup'):
+        source = sqlite3.connect(path)
+        try:
+            version = source.execute('SELECT version FROM "{}"'.format(SchemaVersion._meta.db_table)).fetchone()
+            _check_snapshot_version(version and version[0], path)
+            source.backup(conn)
+        finally:
+            source.close()
+        return
+
+    database.execute_sql('ATTACH DATABASE ? AS snapshot', (path,))
+    try:
+        version = database.execute_sql(
+            'SELECT version FROM snapshot."{}"'.format(SchemaVersion._meta.db_table)).fetchone()
+        _check_snapshot_version(version and version[0], path)
+        with database.atomic():
+            for model in _snapshot_models():
+                table = model._meta.db_table
+                database.execute_sql('DELETE FROM main."{}"'.format(table))
+                database.execute_sql('INSERT INTO main."{0}" ({1}) SELECT {1} FROM snapshot."{0}"'.format(
+                    table, _column_list(model)))
+    finally:
+        database.execute_sql('DETACH DATABASE snapshot')
+
+
+def _snapshot_models():
+    return SCALR_ENTITIES + (SchemaVersion,)
+
+
+def _column_list(model):
+    """Columns of `model` table, named explicitly: order of columns differs
+       between new tables and tables, that got columns added by `_add_missing_columns`.
+    """
+    return ', '.join('"{}"'.format(field.db_column) for field in model._meta.get_fields())
+
+
+def _check_snapshot_version(version, path):
+    if version != SCHEMA_VERSION:
+        raise habibi.exc.HabibiException(
+            'Snapshot {} has schema version {}, current is {}'.format(path, version, SCHEMA_VERSION))
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat(' ')
+    raise TypeError(repr(value))
+
+
+def _save_json_snapshot(path):
+    tables = dict((model._meta.db_table, list(model.select().dicts())) for model in _snapshot_models())
+    with open(path, 'w') as f:
+        json.dump(tables, f, default=_json_default)
+
+
+def _restore_json_snapshot(database, path):
+    with open(path) as f:
+        tables = json.load(f)
+    version = tables.get(SchemaVersion._meta.db_table)
+    _check_snapshot_version(version and version[0]['version'], path)
+    with using(database):
+        with database.atomic():
+            # Children first on delete, parents first on insert
+            for model in reversed(_snapshot_models()):
+                model.delete().execute()
+            for model in _snapshot_models():
+                rows = tables.get(model._meta.db_table)
+                if rows:
+                    bulk_insert(model, rows)
+        # After commit: ALTER TABLE commits implicitly in mysql
+        _reset_sequences(database, _snapshot_models())
+
+
+def _reset_sequences(database, models):
+    """Move auto-increment counters of `models` tables past the largest id:
+       rows, restored from snapshot, were inserted with explicit primary keys.
+       Sqlite tables need nothing: new rowid is always greater than the largest one.
+    """
+    for model in models:
+        if not model._meta.auto_increment:
+            continue
+        table, column = model._meta.db_table, model._meta.primary_key.db_column
+        next_id = (model.select(peewee.fn.Max(model._meta.primary_key)).scalar() or 0) + 1
+        if isinstance(database, peewee.PostgresqlDatabase):
+            database.execute_sql('SELECT setval(pg_get_serial_sequence(%s, %s), %s, false)',
+                                 (table, column, next_id))
+        elif isinstance(database, peewee.MySQLDatabase):
+            database.execute_sql('ALTER TABLE `{}` AUTO_INCREMENT = {}'.format(table, int(next_id)))
+
+
 def get_model_from_scope(scope):
     """Finds peewee model by scope name.
 
@@ -54,6 +337,11 @@ def get_model_from_scope(scope):
         six.raise_from(habibi.exc.HabibiModelNotFound(model_name), e)
 
 
+def get_scope_from_model(model):
+    """Reverse of `get_model_from_scope`: get_scope_from_model(FarmRole) returns 'farm_role'."""
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', model.__name__).lower()
+
+
 class JsonField(peewee.TextField):
     """Custom peewee field that stores JSON-like object in text field."""
     def db_value(self, value):
@@ -81,6 +369,7 @@ class HabibiModel(peewee.Model):
 
 class Farm(HabibiModel):
     name = peewee.CharField(unique=True, index=True)
+    status = peewee.CharField(default='running')
 
 
 class Role(HabibiModel):
@@ -95,7 +384,13 @@ class FarmRole(HabibiModel):
     orchestration = JsonField()
 
 
-class Server(HabibiModel):
+class ShardedModel(HabibiModel):
+    """Models, which rows may be kept in per-farm databases, see `connect_to_shard`."""
+    class Meta(object):
+        database = SHARD_PROXY
+
+
+class Server(ShardedModel):
     id = peewee.CharField(primary_key=True)
     index = peewee.IntegerField()
     farm_role = peewee.ForeignKeyField(FarmRole, related_name='servers')
@@ -105,12 +400,15 @@ class Server(HabibiModel):
     container_id = peewee.CharField(null=True)
     volumes = JsonField()
     status = peewee.CharField(default='pending launch')
+    crypto_key = peewee.CharField(null=True)
+    terminated_at = peewee.DateTimeField(null=True, index=True)
 
 
-class Event(HabibiModel):
+class Event(ShardedModel):
     name = peewee.CharField()
     id = peewee.CharField(primary_key=True)
     triggering_server = peewee.ForeignKeyField(Server, related_name='sent_events')
+    created_at = peewee.DateTimeField(default=datetime.datetime.now, index=True)
 
 
 class GlobalVariable(HabibiModel):
@@ -118,4 +416,9 @@ class GlobalVariable(HabibiModel):
     scopes = JsonField()
 
 
+class SchemaVersion(HabibiModel):
+    version = peewee.IntegerField()
+
+
 SCALR_ENTITIES = (Farm, Role, FarmRole, Server, Event, GlobalVariable)
+SHARDED_ENTITIES = (Server, Event)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.dockerpool
+    ~~~~~~~~~~~~~~~~~
+
+    Pool of docker clients, that looks like one `docker.Client`.
+
+    Every docker daemon gets up to `connections` clients, each keeps its
+    connection alive between calls and is used by one thread at a time,
+    so concurrent api calls don't wait for each other on a single socket.
+    Read-only calls are retried with exponential backoff on connection
+    errors and gateway errors of the daemon.
+
+    With several daemons, new containers are spread among them, and calls
+    for existing containers are sent to the daemon, that runs the container.
+    URLs `fake://<name>` are served by in-process `habibi.testing.FakeDockerClient`.
+"""
+import time
+import socket
+import logging
+import itertools
+import threading
+import contextlib
+import collections
+
+import six
+
+import habibi.exc as habibi_exc
+from habibi.utils.lazy import LazyModule
+
+docker = LazyModule('docker')
+requests = LazyModule('requests')
+habibi_testing = LazyModule('habibi.testing')
+
+
+LOG = logging.getLogger(__name__)
+
+# Calls, that don't change state of the daemon, so they may be repeated
+IDEMPOTENT_METHODS = frozenset([
+    'containers', 'diff', 'images', 'info', 'inspect_container', 'inspect_image',
+    'logs', 'ping', 'port', 'top', 'version'])
+# Calls, which first argument (or `container` keyword) is container
+CONTAINER_METHODS = frozenset([
+    'attach', 'commit', 'diff', 'exec_create', 'export', 'get_archive', 'inspect_container',
+    'kill', 'logs', 'pause', 'port', 'put_archive', 'remove_container', 'rename', 'resize',
+    'restart', 'start', 'stats', 'stop', 'top', 'unpause', 'update_container', 'wait'])
+# Daemon (or proxy in front of it) is temporarily unavailable
+RETRY_STATUSES = (502, 503, 504)
+
+
+def connect(url, timeout):
+    """Create docker client for daemon at `url`."""
+    if url.startswith('fake://'):
+        return habibi_testing.FakeDockerClient.daemon(url)
+    return docker.Client(base_url=url, timeout=timeout)
+
+
+def is_transient(error):
+    """True if call failed because of connection problem, not because of the call itself."""
+    if isinstance(error, docker.errors.APIError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                              socket.error))
+
+
+class HostPool(object):
+    """Up to `connections` clients of docker daemon at `url`, created on demand."""
+
+    def __init__(self, url, connections, timeout, client_factory):
+        self.url = url
+        self.timeout = timeout
+        self.client_factory = client_factory
+        # None stands for client, that was not created yet (or was closed after error)
+        self.idle = six.moves.queue.LifoQueue()
+        for _ in range(connections):
+            self.idle.put(None)
+
+    @contextlib.contextmanager
+    def client(self, wait):
+        """Check out client for exclusive use. Waits up to `wait` seconds for free one."""
+        try:
+            client = self.idle.get(timeout=wait)
+        except six.moves.queue.Empty:
+            raise habibi_exc.HabibiDockerException(
+                'No free connection to docker daemon {} in {}s'.format(self.url, wait))
+        try:
+            if client is None:
+                client = self.client_factory(self.url, self.timeout)
+            yield client
+        except Exception as e:
+            if is_transient(e):
+                # Connection may be broken, the next call gets new one
+                close = getattr(client, 'close', None)
+                if close is not None:
+                    close()
+                client = None
+            raise
+        finally:
+            self.idle.put(client)
+
+    def close(self):
+        clients = []
+        while True:
+            try:
+                clients.append(self.idle.get_nowait())
+            except six.moves.queue.Empty:
+                break
+        for client in clients:
+            if client is not None and hasattr(client, 'close'):
+                client.close()
+            self.idle.put(None)
+
+
+class DockerPool(object):
+    """Calls docker daemons at `urls` through pooled keep-alive clients.
+
+       :param connections: max number of clients (connections) per daemon
+       :param timeout: default timeout (seconds) of docker calls,
+           also the time to wait for free connection
+       :param timeouts: {method name: timeout} for calls, that need different timeout
+       :param retries: number of retries of idempotent calls after transient errors
+       :param backoff: delay before the first retry, doubled for every next one
+       :param client_factory: callable(url, timeout), that creates client, `connect` by default
+    """
+
+    def __init__(self, urls, connections=4, timeout=60, timeouts=None, retries=3, backoff=0.1,
+                 client_factory=None):
+        if isinstance(urls, six.string_types):
+            urls = urls.split(',')
+        self.urls = [url.strip() for url in urls]
+        self.timeout = timeout
+        self.timeouts = timeouts or dict()
+        self.retries = retries
+        self.backoff = backoff
+        self.hosts = collections.OrderedDict(
+            (url, HostPool(url, connections, timeout, client_factory or connect)) for url in self.urls)
+        # container id -> url of daemon, that runs it
+        self.container_hosts = dict()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+
+        def method(*args, **kwargs):
+            return self.call(item, *args, **kwargs)
+        method.__name__ = item
+        return method
+
+    def _container_id(self, method, args, kwargs):
+        if method not in CONTAINER_METHODS:
+            return None
+        container = kwargs.get('container', args[0] if args else None)
+        return container.get('Id') if isinstance(container, dict) else container
+
+    def host_of(self, container_id):
+        """Return url of daemon, that runs container, None if no daemon knows it."""
+        with self.lock:
+            url = self.container_hosts.get(container_id)
+        if url is not None or len(self.urls) == 1:
+            return url or self.urls[0]
+
+        for url in self.urls:
+            try:
+                self._call(url, 'inspect_container', (container_id,), {})
+            except Exception as e:
+                if is_transient(e):
+                    raise
+                continue
+            with self.lock:
+                self.container_hosts[container_id] = url
+            return url
+        return None
+
+    def _least_loaded(self):
+        with self.lock:
+            load = dict((url, 0) for url in self.urls)
+            for url in six.itervalues(self.container_hosts):
+                load[url] = load.get(url, 0) + 1
+            return min(self.urls, key=lambda url: load[url])
+
+    def call(self, method, *args, **kwargs):
+        """Call docker client `method` on the daemon, it belongs to."""
+        if method == 'create_container':
+            url = self._least_loaded()
+            result = self._call(url, method, args, kwargs)
+            with self.lock:
+                self.container_hosts[result['Id']] = url
+            if len(self.urls) > 1:
+                result['Host'] = url
+            return result
+
+        if method == 'containers' and len(self.urls) > 1:
+            return list(itertools.chain.from_iterable(
+                self._call(url, method, args, kwargs) for url in self.urls))
+
+        container_id = self._container_id(method, args, kwargs)
+        url = container_id and self.host_of(container_id) or self.urls[0]
+        result = self._call(url, method, args, kwargs)
+        if method == 'remove_container':
+            with self.lock:
+                self.container_hosts.pop(container_id, None)
+        return result
+
+    def _call(self, url, method, args, kwargs):
+        timeout = self.timeouts.get(method, self.timeout)
+        attempts = method in IDEMPOTENT_METHODS and self.retries + 1 or 1
+        for attempt in range(attempts):
+            try:
+                with self.hosts[url].client(self.timeout) as client:
+                    if hasattr(client, 'timeout'):
+                        client.timeout = timeout
+                    return getattr(client, method)(*args, **kwargs)
+            except Exception as e:
+                if attempt == attempts - 1 or not is_transient(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                LOG.warning('Docker call %s to %s failed (%s), retry in %.2fs', method, url, e, delay)
+                time.sleep(delay)
+
+    def close(self):
+        """Close connections of all clients."""
+        for host in six.itervalues(self.hosts):
+            host.close()
@@ -1,25 +1,62 @@
 __author__ = 'spike'
 
 import sys
+import time
 import logging
+import itertools
 import threading
+import collections
 import Queue
 
+from habibi import tracing
+
 LOG = logging.getLogger(__name__)
 
 
 
+class HistoryRecord(object):
+
+    __slots__ = ('seq', 'timestamp', 'event', 'keys')
+
+    def __init__(self, seq, timestamp, event, keys):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.event = event
+        self.keys = keys
+
+
 class EventMgr(object):
 
     events = dict()
     waitlist = dict()
 
+    # Recently notified events, bounded both by count and age (seconds).
+    # Lets `wait` match events, that were notified before it was called.
+    history_size = 1000
+    history_max_age = 300
+    # Event attributes history is indexed by
+    history_indexed_keys = ('event', 'source_behavior', 'target_behavior')
+    history = collections.deque()
+    # (key, value) -> deque of HistoryRecord
+    history_index = dict()
+    history_seq = itertools.count()
+    # Guards history and waitlist, so event can't slip between history lookup and
+    # waitlist registration
+    lock = threading.RLock()
+
     def add_listener(self, event, fn):
         if not event in self.events:
             self.events[event] = list()
         self.events[event].append(fn)
 
-    def wait(self, event, timeout=None, fn=None):
+    def remove_listener(self, event, fn):
+        listeners = self.events.get(event, [])
+        if fn in listeners:
+            listeners.remove(fn)
+        if not listeners:
+            self.events.pop(event, None)
+
+    def wait(self, event, timeout=None, fn=None, since=None):
         """
         wait for specific event to happen.
 
@@ -28,6 +65,14 @@ class EventMgr(object):
 
             is_first = wait(Event(event='queryenv', method='list-roles'), timeout=120,
                                 fn=lambda ev: ev.server.index == 1)
+
+        If since argument (unix timestamp) is passed, events notified after that moment and
+        still kept in history also match, so caller does not miss event, that happened
+        before `wait` was called:
+
+            started = time.time()
+            server.run()
+            wait(Event(event='HostUp'), timeout=120, since=started)
         """
         t_event = threading.Event()
         queue = fn and Queue.Queue() or None
@@ -36,7 +81,17 @@ class EventMgr(object):
         LOG.debug('Wait for event: %s' % event.cond)
 
         # TODO: Multiple threads could wait for single event ?
-        self.waitlist[event] = (t_event, queue, fn)
+        with self.lock:
+            happened = since is not None and self._find_in_history(event, since) or None
+            if happened is None:
+                self.waitlist[event] = (t_event, queue, fn)
+
+        if happened is not None:
+            LOG.debug('Event found in history: %s' % happened.cond)
+            if fn:
+                return fn(happened)
+            return
+
         try:
             t_event.wait(timeout)
             if not t_event.isSet():
@@ -50,7 +105,8 @@ class EventMgr(object):
                 else:
                     return res['result']
         finally:
-            del self.waitlist[event]
+            with self.lock:
+                del self.waitlist[event]
 
     def notify(self, event_to_apply):
         """
@@ -58,29 +114,83 @@ class EventMgr(object):
         for event with timeouts (using `wait` method). After that, notify all other listeners.
         """
 
+        with tracing.span('notify', 'events', event=event_to_apply.cond.get('event')):
+            self._notify(event_to_apply)
+
+    def _notify(self, event_to_apply):
         # Find matching listeners before any notifications, since event can be changed during notifications
         to_notify = list()
         for event, fn in self.events.iteritems():
             if event in event_to_apply:
                 to_notify.append(fn)
 
+        with self.lock:
+            self._remember(event_to_apply)
+            waiting = [(event, tevent_and_queue_and_maybe_fn)
+                       for event, tevent_and_queue_and_maybe_fn in self.waitlist.iteritems()
+                       if event in event_to_apply]
+
         # TODO: first - set all thread_events, second - run callbacks
         # Notify listeners who uses `wait` method, run callbacks
-        for event, tevent_and_queue_and_maybe_fn in self.waitlist.iteritems():
-            if event in event_to_apply:
-                tevent, queue, fn = tevent_and_queue_and_maybe_fn
-                tevent.set()
-                if fn is not None:
-                    try:
-                        queue.put(dict(status='ok', result=fn(event_to_apply)))
-                    except:
-                        queue.put(dict(status='error', error=sys.exc_info()))
+        for event, tevent_and_queue_and_maybe_fn in waiting:
+            tevent, queue, fn = tevent_and_queue_and_maybe_fn
+            tevent.set()
+            if fn is not None:
+                try:
+                    queue.put(dict(status='ok', result=fn(event_to_apply)))
+                except:
+                    queue.put(dict(status='error', error=sys.exc_info()))
 
         # Notify `listener` wrapped functions in spies
         for fn_list in to_notify:
             for fn in fn_list:
                 fn(event_to_apply)
 
+    def _remember(self, event):
+        now = time.time()
+        keys = [(key, event.cond[key]) for key in self.history_indexed_keys
+                if self._indexable(event.cond.get(key))]
+        record = HistoryRecord(next(self.history_seq), now, event, keys)
+        self.history.append(record)
+        for key in keys:
+            self.history_index.setdefault(key, collections.deque()).append(record)
+
+        # Records are appended in time order, so the oldest one is always leftmost,
+        # both in history and in every index bucket
+        while self.history and (len(self.history) > self.history_size or
+                                self.history[0].timestamp < now - self.history_max_age):
+            oldest = self.history.popleft()
+            for key in oldest.keys:
+                bucket = self.history_index[key]
+                bucket.popleft()
+                if not bucket:
+                    del self.history_index[key]
+
+    def _find_in_history(self, event, since):
+        """Return the earliest event in history, notified after `since`, that matches `event`."""
+        candidates = self.history
+        for key in self.history_indexed_keys:
+            value = event.cond.get(key)
+            if not self._indexable(value):
+                continue
+            bucket = self.history_index.get((key, value))
+            if not bucket:
+                return None
+            if len(bucket) < len(candidates):
+                candidates = bucket
+
+        found = None
+        for record in reversed(candidates):
+            if record.timestamp < since:
+                break
+            if event in record.event:
+                found = record.event
+        return found
+
+    @staticmethod
+    def _indexable(value):
+        return value is not None and not callable(value) and isinstance(value, collections.Hashable)
+
 
 class Event(object):
 
@@ -98,7 +208,7 @@ class Event(object):
     def __getitem__(self, item):
         return self.cond[item]
 
-    def __contains__(self, **test_cond):
+    def __contains__(self, test_cond):
         test_event = test_cond if isinstance(test_cond, Event) else Event(**test_cond)
         for k, v in test_event.cond.iteritems():
             k, attr = k.split('.', 1) if '.' in k else (k, None)
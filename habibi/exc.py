@@ -47,3 +47,33 @@ class HabibiApiNotFound(HabibiNotFound):
         return '{what} were not found in DB. Search conditions: {conds}.'.format(
             what=what, conds=search_conds)
 
+
+class HabibiDockerException(HabibiException):
+    pass
+
+
+class HabibiQueryBudgetExceeded(HabibiException):
+    def __init__(self, max_queries, count, report):
+        self.max_queries = max_queries
+        self.count = count
+        self.report = report
+        super(HabibiQueryBudgetExceeded, self).__init__()
+
+    def __str__(self):
+        return 'Query budget exceeded: {} queries issued, {} allowed.\n{}'.format(
+            self.count, self.max_queries, self.report)
+
+
+class HabibiServiceError(HabibiApiException):
+    """Exception, raised by api method in habibi service worker (see `habibi.service`)."""
+    def __init__(self, error_type, message):
+        self.error_type = error_type
+        self.message = message
+        super(HabibiServiceError, self).__init__()
+
+    def __str__(self):
+        return '{}: {}'.format(self.error_type, self.message)
+
+
+class HabibiServiceNotFound(HabibiServiceError, HabibiNotFound):
+    """Service worker raised one of HabibiNotFound exceptions."""
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.gvcache
+    ~~~~~~~~~~~~~~
+
+    LRU cache of resolved global variables, see `HabibiApi(gv_cache_size=...)`.
+
+    Every entry is tagged with entities, its variables were calculated from
+    (server, its farm role, role and farm, triggering server of event).
+    Changing entity invalidates only entries, tagged with it.
+"""
+import threading
+import collections
+
+
+class GlobalVariablesCache(object):
+    """Keeps at most `max_size` entries `{gv_name: value}`,
+       keyed by (scope, scope_id, event_id, user_defined), least recently used are evicted first.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        # tag -> set of keys; key -> tags
+        self.keys_by_tag = dict()
+        self.tags_by_key = dict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Incremented by every invalidation: values, calculated before it, may be stale
+        self.version = 0
+
+    @staticmethod
+    def key(scope, scope_id, event_id=None, user_defined=False):
+        return scope, str(scope_id), event_id and str(event_id) or None, bool(user_defined)
+
+    @staticmethod
+    def entity_tag(scope, scope_id):
+        return 'entity', scope, str(scope_id)
+
+    @staticmethod
+    def user_defined_tag(scope, scope_id):
+        return 'user_defined', scope, str(scope_id)
+
+    def get(self, key):
+        """Return copy of cached variables or None."""
+        with self.lock:
+            variables = self.entries.pop(key, None)
+            if variables is None:
+                self.misses += 1
+                return None
+            self.entries[key] = variables
+            self.hits += 1
+            return dict(variables)
+
+    def put(self, key, variables, entities, version=None):
+        """Cache `variables`, that were calculated from `entities` ((scope, id) pairs).
+           For user-defined variables, they are invalidated also by changes of GVs in scopes of `entities`.
+
+           :param version: value of `version` before calculation started. If cache was
+               invalidated since then, `variables` are not cached.
+        """
+        tags = set(self.entity_tag(*entity) for entity in entities)
+        if key[-1]:
+            tags.update(self.user_defined_tag(*entity) for entity in entities)
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self._remove(key)
+            self.entries[key] = dict(variables)
+            self.tags_by_key[key] = tags
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        if self.entries.pop(key, None) is None:
+            return False
+        for tag in self.tags_by_key.pop(key, ()):
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+        return True
+
+    def _invalidate_tag(self, tag):
+        with self.lock:
+            self.version += 1
+            for key in list(self.keys_by_tag.get(tag, ())):
+                self.invalidations += self._remove(key)
+
+    def invalidate(self, scope, scope_id):
+        """Drop entries, calculated from entity (e.g. 'server', server_id)."""
+        self._invalidate_tag(self.entity_tag(scope, scope_id))
+
+    def invalidate_user_defined(self, scope, scope_id):
+        """Drop user-defined variables of the scope and scopes below it."""
+        self._invalidate_tag(self.user_defined_tag(scope, scope_id))
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+            self.keys_by_tag.clear()
+            self.tags_by_key.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.entries), max_size=self.max_size, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, invalidations=self.invalidations,
+                        hit_rate=lookups and float(self.hits) / lookups or 0.0)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.loadgen
+    ~~~~~~~~~~~~~~
+
+    Load generator, that simulates scalarizr agents of many servers in-process,
+    to find out how much traffic single habibi instance can serve.
+
+    Every simulated server walks through lifecycle events (HostInit, BeforeHostUp, HostUp);
+    every step runs the same code path as real agent traffic does:
+    `create_event` -> `orchestrate_event` -> `EventMgr.notify`. Docker is replaced with
+    `habibi.testing.FakeDockerClient`.
+
+    Usage::
+
+        python -m habibi.loadgen --servers 1000 --concurrency 1,2,4,8,16 --duration 10
+"""
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+
+import habibi.api as habibi_api
+import habibi.events as habibi_events
+import habibi.metrics as habibi_metrics
+import habibi.service as habibi_service
+import habibi.testing as habibi_testing
+
+
+LOG = logging.getLogger(__name__)
+
+LIFECYCLE = ('HostInit', 'BeforeHostUp', 'HostUp')
+OPERATIONS = ('create_event', 'orchestrate_event', 'notify', 'step')
+
+
+class RunStats(object):
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = 0
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, latencies):
+        with self.lock:
+            for op, value in latencies:
+                self.latencies[op].append(value)
+
+    @property
+    def steps(self):
+        return len(self.latencies['step'])
+
+    @property
+    def throughput(self):
+        return self.elapsed and self.steps / self.elapsed or 0.0
+
+    def to_dict(self):
+        ret = dict(concurrency=self.concurrency, steps=self.steps, errors=self.errors,
+                   elapsed=self.elapsed, throughput=self.throughput, operations=dict())
+        for op, values in self.latencies.items():
+            values = sorted(values)
+            ret['operations'][op] = dict(count=len(values),
+                                         p50=habibi_metrics.percentile(values, 0.5),
+                                         p99=habibi_metrics.percentile(values, 0.99))
+        return ret
+
+
+class LoadGenerator(object):
+    """Drives lifecycle events of `server_ids` through `api` and `event_mgr`.
+
+       :param rate: target number of lifecycle steps per second for all workers together,
+           None means as fast as possible
+    """
+
+    def __init__(self, api, server_ids, event_mgr=None, rate=None):
+        self.api = api
+        self.server_ids = list(server_ids)
+        self.event_mgr = event_mgr or habibi_events.EventMgr()
+        self.rate = rate
+        self._next = 0
+        self._lock = threading.Lock()
+        # Server index -> number of lifecycle steps done
+        self._progress = [0] * len(self.server_ids)
+
+    def _take_server(self):
+        with self._lock:
+            index = self._next
+            self._next = (self._next + 1) % len(self.server_ids)
+            step = self._progress[index]
+            self._progress[index] += 1
+        return self.server_ids[index], LIFECYCLE[step % len(LIFECYCLE)]
+
+    def step(self):
+        """Simulate one agent event. Returns list of (operation, latency)."""
+        server_id, event_name = self._take_server()
+        latencies = []
+        started = time.time()
+        event = self.api.create_event(event_name, server_id)
+        latencies.append(('create_event', time.time() - started))
+
+        start = time.time()
+        orchestration = self.api.orchestrate_event(event['id'])
+        latencies.append(('orchestrate_event', time.time() - start))
+
+        start = time.time()
+        self.event_mgr.notify(habibi_events.Event(event=event_name, server_id=server_id,
+                                                  orchestration=orchestration))
+        latencies.append(('notify', time.time() - start))
+        latencies.append(('step', time.time() - started))
+        return latencies
+
+    def run(self, concurrency, duration):
+        """Run `concurrency` worker threads for `duration` seconds."""
+        stats = RunStats(concurrency)
+        deadline = time.time() + duration
+        interval = self.rate and float(concurrency) / self.rate or 0
+
+        def worker():
+            next_at = time.time()
+            while time.time() < deadline:
+                if interval:
+                    delay = next_at - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_at += interval
+                try:
+                    stats.add(self.step())
+                except Exception:
+                    LOG.debug('Load step failed', exc_info=True)
+                    with stats.lock:
+                        stats.errors += 1
+
+        started = time.time()
+        workers = [threading.Thread(target=worker, name='habibi-loadgen-{}'.format(i))
+                   for i in range(concurrency)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        for thread in workers:
+            thread.join()
+        stats.elapsed = time.time() - started
+        return stats
+
+
+def find_saturation(runs, min_gain=0.1):
+    """Return concurrency, after which adding workers increases throughput
+       by less than `min_gain` (fraction), or None if throughput still grows.
+    """
+    for previous, current in zip(runs, runs[1:]):
+        if current.throughput < previous.throughput * (1 + min_gain):
+            return previous.concurrency
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate scalarizr agents of many servers.')
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--farms', type=int, default=1)
+    parser.add_argument('--farm-roles', type=int, default=4, help='farm roles per farm')
+    parser.add_argument('--rules', type=int, default=2, help='orchestration rules per event')
+    parser.add_argument('--concurrency', default='1,2,4,8',
+                        help='comma-separated numbers of concurrent agents, run one after another')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--rate', type=float, help='target lifecycle steps per second (default: unlimited)')
+    parser.add_argument('--db-url', help='default: sqlite file in temporary directory. '
+                                         'In-memory sqlite is not shared between threads.')
+    parser.add_argument('--event-batch-size', type=int, help='see HabibiApi(event_batch_size=...)')
+    parser.add_argument('--state-engine', action='store_true', help='see HabibiApi(state_engine=...)')
+    parser.add_argument('--gv-cache', type=int, metavar='SIZE', help='see HabibiApi(gv_cache_size=...)')
+    parser.add_argument('--trace', type=float, metavar='SAMPLE_RATE',
+                        help='write traces of sampled api calls to --trace-dir, see HabibiApi(tracing=...)')
+    parser.add_argument('--trace-dir', default='habibi-traces',
+                        help='directory for trace files, kept after the run (default: %(default)s)')
+    parser.add_argument('--sharded', action='store_true', help='see HabibiApi(sharded=...)')
+    parser.add_argument('--workers', type=int,
+                        help='run api in that many service processes (habibi.service), agents call them over HTTP')
+    parser.add_argument('--port', type=int, default=8700, help='port of the first service worker')
+    args = parser.parse_args(argv)
+    if args.workers and (args.event_batch_size or args.state_engine or args.gv_cache):
+        parser.error('--event-batch-size, --state-engine and --gv-cache keep data in memory of one process, '
+                     'they can not be used with --workers')
+
+    base_dir = tempfile.mkdtemp()
+    pool = local_api = None
+    try:
+        api_options = dict(db_url=args.db_url or 'sqlite:///{}/habibi.db'.format(base_dir),
+                           base_dir=base_dir, docker_client=habibi_testing.FakeDockerClient(),
+                           event_batch_size=args.event_batch_size, state_engine=args.state_engine,
+                           sharded=args.sharded, gv_cache_size=args.gv_cache,
+                           tracing=args.trace is not None and os.path.abspath(args.trace_dir) or None,
+                           trace_sample_rate=args.trace or 0)
+        api = local_api = habibi_api.HabibiApi(**api_options)
+        per_farm_role = max(1, args.servers // (args.farms * args.farm_roles))
+        topology = habibi_testing.build_topology(api, farms=args.farms, farm_roles=args.farm_roles,
+                                                 servers=per_farm_role, gvs=0, rules=args.rules)
+        if args.workers:
+            api.flush_events()
+            pool = habibi_service.ServicePool(workers=args.workers, port=args.port, **api_options)
+            pool.start()
+            api = habibi_service.HabibiClient(pool.urls)
+        generator = LoadGenerator(api, [s['id'] for s in topology['servers']], rate=args.rate)
+        print('Simulating {} servers'.format(len(topology['servers'])))
+
+        runs = []
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            stats = generator.run(concurrency, args.duration)
+            runs.append(stats)
+            result = stats.to_dict()
+            print('concurrency={concurrency:<4} steps/s={throughput:9.1f} errors={errors}'.format(**result))
+            for op in OPERATIONS:
+                op_stats = result['operations'][op]
+                print('    {:18} p50={:8.2f}ms p99={:8.2f}ms'.format(
+                    op, op_stats['p50'] * 1000, op_stats['p99'] * 1000))
+
+        saturation = find_saturation(runs)
+        if saturation is None:
+            print('Throughput did not saturate, try higher concurrency')
+        else:
+            print('Saturation at concurrency={}'.format(saturation))
+        if args.trace is not None:
+            print('Traces: {}'.format(api_options['tracing']))
+        return 0
+    finally:
+        if pool is not None:
+            pool.stop()
+        if local_api is not None:
+            # Queued writes go to base dir, save them before it's removed
+            local_api.close()
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.metrics
+    ~~~~~~~~~~~~~~
+
+    Call counts and latency histograms of habibi api methods,
+    SQL statements and docker client calls.
+
+    Usage::
+
+        api = HabibiApi(metrics=Metrics(exporters=[PrometheusExporter('.habibi/metrics.prom')]))
+        ...
+        api.metrics.snapshot()  # {'api': {'create_server': {'count': 3, 'sum': 0.01, ...}}, ...}
+        api.metrics.export()
+"""
+import os
+import re
+import time
+import logging
+import threading
+
+import six
+
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets, seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+_statement_re = re.compile(r'^\s*(SELECT|INSERT(?: OR \w+)? INTO|UPDATE|DELETE FROM|\w+)'
+                           r'(?:.*?\sFROM)?\s*"?(\w+)?', re.IGNORECASE | re.DOTALL)
+
+
+def statement_name(sql):
+    """Short name of SQL statement: its kind and the first table.
+
+       >>> statement_name('SELECT "t1"."id" FROM "habibi_servers" AS t1 WHERE ...')
+       'SELECT habibi_servers'
+    """
+    match = _statement_re.match(sql)
+    if not match:
+        return sql.split(None, 1)[0].upper()
+    kind, table = match.groups()
+    kind = kind.split()[0].upper()
+    return table and '{} {}'.format(kind, table) or kind
+
+
+def percentile(sorted_values, fraction):
+    """Value of `sorted_values` at `fraction` (0.5 - median), 0.0 if there are no values."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Histogram(object):
+
+    __slots__ = ('count', 'sum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self):
+        return dict(count=self.count, sum=self.sum,
+                    buckets=dict(zip(BUCKETS, self.buckets)))
+
+
+class Metrics(object):
+    """Registry of latency histograms, grouped by kind ('api', 'sql', 'docker')
+       and name (method name or statement name).
+
+       SQL statements are also counted per api method, that issued them ('api_sql' kind).
+
+       :param exporters: list of objects with `export(snapshot)` method
+    """
+
+    def __init__(self, exporters=None):
+        self.exporters = exporters or []
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self._local = threading.local()
+
+    def observe(self, kind, name, duration):
+        with self.lock:
+            key = (kind, name)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(duration)
+
+    def timed(self, kind, name, fn, args=(), kwargs=None):
+        """Call fn(*args, **kwargs) and record its latency.
+           Arguments of `fn` are passed as tuple and dict: they may be named as arguments of `timed`.
+        """
+        kwargs = kwargs or dict()
+        calls = self._calls()
+        if kind == 'api':
+            calls.append(name)
+        start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.observe(kind, name, time.time() - start)
+            if kind == 'api':
+                calls.pop()
+
+    def _calls(self):
+        if not hasattr(self._local, 'calls'):
+            self._local.calls = []
+        return self._local.calls
+
+    def sql_listener(self, sql, params, duration):
+        name = statement_name(sql)
+        self.observe('sql', name, duration)
+        calls = self._calls()
+        if calls:
+            self.observe('api_sql', calls[-1], duration)
+
+    def snapshot(self):
+        """Return {kind: {name: {'count': .., 'sum': .., 'buckets': {bound: count}}}}"""
+        with self.lock:
+            ret = dict()
+            for (kind, name), histogram in six.iteritems(self.histograms):
+                ret.setdefault(kind, dict())[name] = histogram.to_dict()
+            return ret
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def export(self):
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+        return snapshot
+
+
+class InstrumentedClient(object):
+    """Proxy for docker client, that records latency of every method call."""
+
+    def __init__(self, client, metrics, kind='docker'):
+        self._client = client
+        self._metrics = metrics
+        self._kind = kind
+
+    def __getattr__(self, item):
+        attr = getattr(self._client, item)
+        if not callable(attr):
+            return attr
+
+        def timed_call(*args, **kwargs):
+            return self._metrics.timed(self._kind, item, attr, args, kwargs)
+        return timed_call
+
+
+class DictExporter(object):
+    """Keeps the latest exported snapshot in `last` attribute."""
+
+    def __init__(self):
+        self.last = None
+
+    def export(self, snapshot):
+        self.last = snapshot
+
+
+class PrometheusExporter(object):
+    """Writes snapshot to file in Prometheus text format
+       (e.g. for node_exporter textfile collector).
+    """
+
+    def __init__(self, path, prefix='habibi'):
+        self.path = path
+        self.prefix = prefix
+
+    def export(self, snapshot):
+        lines = []
+        for kind, histograms in sorted(six.iteritems(snapshot)):
+            metric = '{}_{}_seconds'.format(self.prefix, kind)
+            lines.append('# TYPE {} histogram'.format(metric))
+            for name, histogram in sorted(six.iteritems(histograms)):
+                label = name.replace('\\', '\\\\').replace('"', '\\"')
+                cumulative = 0
+                for bound in BUCKETS:
+                    cumulative += histogram['buckets'][bound]
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{{name="{}",le="{}"}} {}'.format(metric, label, le, cumulative))
+                lines.append('{}_sum{{name="{}"}} {}'.format(metric, label, histogram['sum']))
+                lines.append('{}_count{{name="{}"}} {}'.format(metric, label, histogram['count']))
+
+        # Write atomically, so collector never reads half-written file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp_path, self.path)
+
+
+class LogExporter(object):
+    """Logs one summary line per histogram, slowest first."""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or LOG
+        self.level = level
+
+    def export(self, snapshot):
+        rows = []
+        for kind, histograms in six.iteritems(snapshot):
+            for name, histogram in six.iteritems(histograms):
+                rows.append((histogram['sum'], kind, name, histogram['count']))
+        for total, kind, name, count in sorted(rows, reverse=True):
+            self.logger.log(self.level, '%s %s: %s calls, %.3fs total, %.2fms avg',
+                            kind, name, count, total, 1000.0 * total / count)
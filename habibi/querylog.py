@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.querylog
+    ~~~~~~~~~~~~~~~
+
+    Records SQL statements, issued through habibi DB, finds N+1 query patterns
+    and checks query budgets in tests.
+
+    Usage::
+
+        with QueryRecorder() as queries:
+            api.orchestrate_event(event_id)
+        print(queries.report())
+
+        with query_budget(5):
+            api.orchestrate_event(event_id)  # on exit: HabibiQueryBudgetExceeded, if there were over 5 queries
+
+        @query_budget(5)
+        def test_orchestration():
+            ...
+"""
+import os
+import re
+import sys
+import threading
+import collections
+
+import six
+import peewee
+
+import habibi.db as habibi_db
+import habibi.exc as habibi_exc
+
+
+_placeholders_list_re = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+_number_re = re.compile(r'\b\d+\b')
+_habibi_dir = os.path.dirname(os.path.abspath(__file__))
+_skip_files = tuple(os.path.join(_habibi_dir, name) for name in ('querylog.py', 'db.py', 'metrics.py'))
+
+
+def statement_shape(sql):
+    """Normalize statement, so queries that differ only in parameters have the same shape."""
+    sql = _placeholders_list_re.sub('(?...)', sql)
+    return _number_re.sub('N', sql)
+
+
+QueryRecord = collections.namedtuple('QueryRecord', 'sql params duration shape attribute call_site')
+
+
+def _query_origin():
+    """Find model attribute and habibi code line, that caused the query.
+
+       Attribute is found only for lazy foreign key access (e.g. `Server.farm_role`),
+       backrefs (`Farm.farm_roles`) are plain queries, executed when iterated.
+    """
+    attribute = call_site = None
+    frame = sys._getframe(2)
+    while frame is not None and (attribute is None or call_site is None):
+        descriptor = frame.f_locals.get('self')
+        if attribute is None and isinstance(descriptor, peewee.RelationDescriptor):
+            field = descriptor.field
+            attribute = '{}.{}'.format(field.model_class.__name__, field.name)
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if call_site is None and filename.startswith(_habibi_dir) and not filename.startswith(_skip_files):
+            call_site = '{}:{} {}'.format(os.path.relpath(filename, os.path.dirname(_habibi_dir)),
+                                          frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return attribute, call_site
+
+
+class QueryRecorder(object):
+    """Context manager and decorator, that records SQL statements issued in the current thread.
+
+       :param max_queries: if set, raise HabibiQueryBudgetExceeded on exit,
+           when more statements were executed
+       :param n_plus_one_threshold: how many times the same statement shape must repeat
+           to be reported as N+1 pattern
+    """
+
+    def __init__(self, max_queries=None, n_plus_one_threshold=3):
+        self.max_queries = max_queries
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = []
+        self._thread = None
+
+    def _record(self, sql, params, duration):
+        if threading.current_thread() is not self._thread:
+            return
+        attribute, call_site = _query_origin()
+        self.queries.append(QueryRecord(sql, params, duration, statement_shape(sql), attribute, call_site))
+
+    def __enter__(self):
+        self.queries = []
+        self._thread = threading.current_thread()
+        habibi_db.add_sql_listener(self._record)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        habibi_db.remove_sql_listener(self._record)
+        if exc_type is None and self.max_queries is not None and self.count > self.max_queries:
+            raise habibi_exc.HabibiQueryBudgetExceeded(self.max_queries, self.count, self.report())
+
+    def __call__(self, fn):
+        @six.wraps(fn)
+        def wrapped(*args, **kwargs):
+            with QueryRecorder(self.max_queries, self.n_plus_one_threshold):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def shapes(self):
+        """Return list of (shape, [QueryRecord, ...]), most repeated first."""
+        grouped = collections.OrderedDict()
+        for query in self.queries:
+            grouped.setdefault(query.shape, []).append(query)
+        return sorted(six.iteritems(grouped), key=lambda item: len(item[1]), reverse=True)
+
+    def n_plus_one(self):
+        """Return list of dicts, describing repeated statements:
+           shape, count, model attributes and call sites, that issued them.
+        """
+        found = []
+        for shape, queries in self.shapes():
+            if len(queries) < self.n_plus_one_threshold:
+                break
+            found.append(dict(
+                shape=shape,
+                count=len(queries),
+                attributes=sorted(set(q.attribute for q in queries if q.attribute)),
+                call_sites=sorted(set(q.call_site for q in queries if q.call_site))))
+        return found
+
+    def report(self):
+        lines = ['{} queries, {:.2f}ms'.format(self.count, 1000 * sum(q.duration for q in self.queries))]
+        for pattern in self.n_plus_one():
+            lines.append('N+1: {count} x {shape}'.format(**pattern))
+            for origin in pattern['attributes'] + pattern['call_sites']:
+                lines.append('    from {}'.format(origin))
+        return '\n'.join(lines)
+
+
+def query_budget(max_queries, **kwargs):
+    """Shortcut for QueryRecorder(max_queries=max_queries)."""
+    return QueryRecorder(max_queries=max_queries, **kwargs)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.service
+    ~~~~~~~~~~~~~~
+
+    Standalone habibi service: `HabibiApi` methods, served over HTTP
+    by a pool of worker processes, so api calls are not limited by one interpreter's GIL.
+
+    Every worker listens on its own port (`port`, `port + 1`, ...) and has its own
+    `HabibiApi` object; workers share the DB. `HabibiClient` has the same methods as
+    `HabibiApi` and sends calls for the same farm to the same worker, so per-process
+    caches (SQLite page cache, pooled connections) stay warm.
+
+    Request is POST of JSON object `{"method": ..., "args": [...], "params": {...}}`,
+    response is `{"status": "ok", "payload": ...}` or `{"status": "error", "error": ..., "error_type": ...}`.
+    Datetimes are sent as ISO 8601 strings. Results with generators are streamed.
+
+    Usage::
+
+        python -m habibi.service --workers 4 --port 8700 --db-url sqlite:////var/lib/habibi/habibi.db
+"""
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import inspect
+import argparse
+import datetime
+import itertools
+import threading
+import collections
+import multiprocessing
+from wsgiref import simple_server
+# datetime.strptime imports it on first call, which is not thread-safe in python 2:
+# concurrent requests, that parse datetimes from DB, fail with AttributeError
+import _strptime
+
+import six
+
+import habibi.exc as habibi_exc
+import habibi.api as habibi_api
+from habibi.utils import jsonstream
+
+
+LOG = logging.getLogger(__name__)
+
+# Call arguments, that identify farm of the call (besides farm_id), and kinds of entities they refer to
+ROUTING_ARGS = (('farm_role_id', 'farm_role'), ('server_id', 'server'),
+                ('triggering_server_id', 'server'), ('event_id', 'event'))
+
+
+class ApiJSONEncoder(json.JSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.date)):
+            return o.isoformat()
+        if isinstance(o, collections.Iterable):
+            return list(o)
+        return super(ApiJSONEncoder, self).default(o)
+
+
+def api_methods():
+    """Names of `HabibiApi` methods, that may be called through service, except `get_*` and `find_*`."""
+    return sorted(name for name, value in six.iteritems(vars(habibi_api.HabibiApi))
+                  if not name.startswith('_') and name not in habibi_api.LIFECYCLE_METHODS
+                  and inspect.isfunction(value))
+
+
+def is_api_method(name):
+    return name in api_methods() or name.startswith(('get_', 'find_'))
+
+
+class ApiService(object):
+    """WSGI application, that calls methods of `api`."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def __call__(self, environ, start_response):
+        try:
+            try:
+                length = int(environ['CONTENT_LENGTH'])
+                data = json.loads(environ['wsgi.input'].read(length))
+                if not is_api_method(data['method']):
+                    raise habibi_exc.HabibiApiException('Unknown api method "{}"'.format(data['method']))
+                method = getattr(self.api, data['method'])
+                args = data.get('args') or []
+                params = data.get('params') or dict()
+                LOG.debug('Api service call. Method: %s, args: %s, params: %s', data['method'], args, params)
+            except:
+                start_response('400 Bad request', [], sys.exc_info())
+                return [str(sys.exc_info()[1]).encode()]
+
+            try:
+                result = dict(status='ok', payload=method(*args, **params))
+                if jsonstream.is_lazy(result):
+                    # E.g. orchestrate_event(stream=True): response is built while it's sent
+                    start_response('200 OK', [('Content-type', 'application/json')])
+                    return (chunk.encode() for chunk in jsonstream.iterencode(result, cls=ApiJSONEncoder))
+            except:
+                e = sys.exc_info()
+                if not isinstance(e[1], habibi_exc.HabibiException):
+                    LOG.error('Api internal error occured', exc_info=e)
+                result = dict(status='error', error=str(e[1]), error_type=type(e[1]).__name__,
+                              not_found=isinstance(e[1], habibi_exc.HabibiNotFound))
+
+            result = json.dumps(result, cls=ApiJSONEncoder).encode()
+            headers = [('Content-type', 'application/json'),
+                       ('Content-length', str(len(result)))]
+            start_response('200 OK', headers)
+            return [result]
+        except:
+            start_response('500 Internal Server Error', [], sys.exc_info())
+            LOG.exception('Unhandled exception')
+            return [b'']
+
+
+class ThreadingWSGIServer(six.moves.socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+
+def serve(host, port, api_options):
+    """Serve `HabibiApi(**api_options)` on `host`:`port` until process is terminated.
+       On SIGTERM api is closed, so queued writes are saved.
+    """
+    api = habibi_api.HabibiApi(**api_options)
+    server = simple_server.make_server(host, port, ApiService(api), server_class=ThreadingWSGIServer,
+                                       handler_class=QuietHandler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    LOG.info('Habibi api worker listens on %s:%s', host, port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        api.close()
+
+
+class ServicePool(object):
+    """Runs `workers` processes, that serve `HabibiApi(**api_options)`
+       on ports `port`, `port + 1`, ..., `port + workers - 1`.
+
+       DB must be shared between processes: in-memory sqlite is not allowed.
+       For pooled connections within worker use `+pool` DB urls (e.g. `postgres+pool://`).
+       Api options, that keep entities in process memory (`state_engine`, `gv_cache_size`,
+       `event_batch_size`), are not allowed: workers would see different data.
+    """
+
+    def __init__(self, workers=None, host='127.0.0.1', port=8700, start_timeout=10, **api_options):
+        db_url = api_options.get('db_url') or 'sqlite:///:memory:'
+        if ':memory:' in db_url:
+            raise habibi_exc.HabibiApiException('Api service workers need shared DB, got {}'.format(db_url))
+        if api_options.get('state_engine'):
+            raise habibi_exc.HabibiApiException('State engine can not be used by api service workers')
+        if api_options.get('gv_cache_size'):
+            raise habibi_exc.HabibiApiException('GV cache can not be used by api service workers')
+        if api_options.get('event_batch_size'):
+            raise habibi_exc.HabibiApiException('Event batches can not be used by api service workers')
+        self.workers = workers or multiprocessing.cpu_count()
+        self.host = host
+        self.port = port
+        self.start_timeout = start_timeout
+        self.api_options = api_options
+        self.processes = []
+
+    @property
+    def urls(self):
+        return ['http://{}:{}'.format(self.host, self.port + i) for i in range(self.workers)]
+
+    def start(self):
+        # Create schema once, before workers race for it
+        api = habibi_api.HabibiApi(**self.api_options)
+        api.database.close()
+        api.close()
+
+        for i in range(self.workers):
+            process = multiprocessing.Process(target=serve, name='habibi-api-{}'.format(i),
+                                              args=(self.host, self.port + i, self.api_options))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        for i in range(self.workers):
+            self._wait_for_port(self.port + i)
+
+    def _wait_for_port(self, port):
+        deadline = time.time() + self.start_timeout
+        while True:
+            try:
+                socket.create_connection((self.host, port), timeout=1).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    self.stop()
+                    raise habibi_exc.HabibiApiException('Api worker on port {} did not start'.format(port))
+                time.sleep(0.05)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class HabibiClient(object):
+    """Calls `HabibiApi` methods in service workers at `urls`.
+
+       Arguments are checked against signatures of `HabibiApi` methods before the call.
+       Calls, related to known farm, are sent to worker `farm_id % len(urls)`.
+       Farms of servers, events and farm roles are learned from results of previous calls,
+       calls without known farm are spread among all workers.
+    """
+
+    def __init__(self, urls, timeout=60):
+        self.urls = list(urls)
+        self.timeout = timeout
+        # entity kind -> {id: farm_id}
+        self.routes = dict((kind, dict()) for kind in ('farm_role', 'server', 'event'))
+        self._next_worker = itertools.count()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, item):
+        if not is_api_method(item):
+            raise AttributeError(item)
+        fn = vars(habibi_api.HabibiApi).get(item)
+        if fn is not None:
+            # Original function, not the one wrapped by MetaReturnDicts
+            fn = getattr(fn, '__wrapped__', fn)
+
+        def method(*args, **kwargs):
+            if fn is not None:
+                callargs = inspect.getcallargs(fn, self, *args, **kwargs)
+                callargs.pop('self')
+                return self.call(item, params=callargs)
+            return self.call(item, args=args, params=kwargs)
+        method.__name__ = item
+        method.__doc__ = fn is not None and fn.__doc__ or None
+        return method
+
+    def _worker(self, params):
+        if params.get('farm_id') is not None:
+            return int(params['farm_id']) % len(self.urls)
+        for name, kind in ROUTING_ARGS:
+            farm_id = params.get(name) is not None and self.routes[kind].get(str(params[name]))
+            if farm_id:
+                return int(farm_id) % len(self.urls)
+        with self._lock:
+            return next(self._next_worker) % len(self.urls)
+
+    def _learn(self, entity):
+        """Remember farm of `entity`, if it's server, event or farm role."""
+        if not isinstance(entity, dict) or 'id' not in entity:
+            return
+        if isinstance(entity.get('triggering_server'), dict):
+            kind, farm_role = 'event', entity['triggering_server'].get('farm_role')
+        elif isinstance(entity.get('farm_role'), dict):
+            kind, farm_role = 'server', entity['farm_role']
+        elif isinstance(entity.get('farm'), dict):
+            kind, farm_role = 'farm_role', entity
+        else:
+            return
+        farm = isinstance(farm_role, dict) and farm_role.get('farm')
+        if isinstance(farm, dict) and 'id' in farm:
+            self.routes[kind][str(entity['id'])] = farm['id']
+            if kind == 'event':
+                self._learn(entity['triggering_server'])
+            elif kind == 'server':
+                self._learn(farm_role)
+
+    def call(self, method, args=None, params=None):
+        """Call api `method` in one of workers, return its result."""
+        params = params or dict()
+        url = six.moves.urllib.parse.urlparse(self.urls[self._worker(params)])
+        body = json.dumps(dict(method=method, args=args or [], params=params), cls=ApiJSONEncoder)
+
+        connection = six.moves.http_client.HTTPConnection(url.hostname, url.port, timeout=self.timeout)
+        try:
+            connection.request('POST', '/', body, {'Content-type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise habibi_exc.HabibiApiException('Api service responded {} {}: {}'.format(
+                response.status, response.reason, data))
+
+        result = json.loads(data.decode())
+        if result['status'] != 'ok':
+            error = result.get('not_found') and habibi_exc.HabibiServiceNotFound or habibi_exc.HabibiServiceError
+            raise error(result.get('error_type'), result.get('error'))
+
+        payload = result.get('payload')
+        for entity in isinstance(payload, list) and payload or [payload]:
+            self._learn(entity)
+        return payload
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve habibi api by pool of worker processes.')
+    parser.add_argument('--workers', type=int, help='default: number of CPUs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700, help='port of the first worker')
+    parser.add_argument('--db-url', required=True, help='DB, shared by workers')
+    parser.add_argument('--base-dir')
+    parser.add_argument('--docker-url')
+    parser.add_argument('--sharded', action='store_true', help='see HabibiApi(sharded=...)')
+    args = parser.parse_args(argv)
+
+    pool = ServicePool(workers=args.workers, host=args.host, port=args.port, db_url=args.db_url,
+                       base_dir=args.base_dir, docker_url=args.docker_url, sharded=args.sharded)
+    with pool:
+        print('Habibi api workers: {}'.format(' '.join(pool.urls)))
+        try:
+            while all(process.is_alive() for process in pool.processes):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.sharding
+    ~~~~~~~~~~~~~~~
+
+    Per-farm sqlite databases. Servers and events of every farm are kept in its own file,
+    so writes to different farms don't wait for each other on sqlite's database lock.
+    Farms, roles, farm roles and GVs stay in the shared (catalog) database.
+"""
+import os
+import glob
+import logging
+import threading
+
+import habibi.db as habibi_db
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ShardRouter(object):
+    """Opens per-farm databases in `shard_dir` and finds out, which farm entities belong to.
+
+       Farms of servers and events are cached after they were created or found,
+       unknown ids are looked up in every shard.
+
+       :param catalog_path: path to sqlite file of shared database
+    """
+
+    # Foreign key of sharded model, that leads to the farm
+    parent_fields = {
+        habibi_db.Server: 'farm_role',
+        habibi_db.Event: 'triggering_server',
+    }
+
+    def __init__(self, shard_dir, catalog_path):
+        self.shard_dir = shard_dir
+        self.catalog_path = catalog_path
+        self.databases = dict()
+        # model -> {pk: farm_id}
+        self.routes = dict((model, dict()) for model in (habibi_db.FarmRole,) + habibi_db.SHARDED_ENTITIES)
+        self.lock = threading.Lock()
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+
+    def _path(self, farm_id):
+        return os.path.join(self.shard_dir, 'farm-{}.db'.format(farm_id))
+
+    def database(self, farm_id):
+        """Return database of farm `farm_id`, create it, if needed."""
+        farm_id = int(farm_id)
+        with self.lock:
+            if farm_id not in self.databases:
+                self.databases[farm_id] = habibi_db.connect_to_shard(self._path(farm_id), self.catalog_path)
+            return self.databases[farm_id]
+
+    def farm_ids(self):
+        """Ids of farms, which have databases."""
+        paths = glob.glob(os.path.join(self.shard_dir, 'farm-*.db'))
+        found = set(int(os.path.basename(path)[len('farm-'):-len('.db')]) for path in paths)
+        return sorted(found | set(self.databases))
+
+    def using(self, farm_id):
+        """Context manager, that routes queries of sharded models to the database of farm `farm_id`."""
+        return habibi_db.SHARD_PROXY.using(self.database(farm_id))
+
+    def remember(self, model, pk, farm_id):
+        self.routes[model][pk] = farm_id
+
+    def farm_of(self, model, pk):
+        """Return id of the farm, that entity of `model` with primary key `pk` belongs to,
+           None if entity does not exist.
+        """
+        if model is habibi_db.Farm:
+            return int(pk)
+        routes = self.routes[model]
+        if pk in routes:
+            return routes[pk]
+
+        if model is habibi_db.FarmRole:
+            farm_id = model.select(model.farm).where(model.id == pk).scalar()
+            if farm_id is not None:
+                routes[pk] = farm_id
+            return farm_id
+
+        for farm_id in self.farm_ids():
+            with self.using(farm_id):
+                if model.select(model.id).where(model.id == pk).exists():
+                    routes[pk] = farm_id
+                    return farm_id
+        return None
+
+    def group_by_farm(self, model, pks):
+        """Return {farm_id: [pk, ...]}, entities, that don't exist, are skipped."""
+        groups = dict()
+        for pk in pks:
+            farm_id = self.farm_of(model, pk)
+            if farm_id is not None:
+                groups.setdefault(farm_id, []).append(pk)
+        return groups
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.state
+    ~~~~~~~~~~~~
+
+    In-memory state engine: holds habibi entities as compact records
+    with indexes by id, foreign keys and status, serves reads from memory
+    and persists writes to DB asynchronously (write-behind).
+
+    Records mimic peewee models, that api code works with: foreign key attributes
+    point to parent records, related names (`farm.farm_roles`, `farm_role.servers`)
+    are lists of child records, `to_dict` returns the same dict as `model_to_dict`.
+
+    DB stays the source of truth for restarts: `StateEngine.load` reads all entities
+    back. Writes, queued but not yet flushed, are lost if process crashes,
+    so `flush_interval` bounds amount of lost data in time. Writes, that DB rejected,
+    stay queued and are retried by the next flush (explicit `flush` reraises the error),
+    failed attempts are counted in `StateEngine.failures`. After `max_retries` failed retries
+    writes are dropped from the queue to `StateEngine.dead_letters` and logged.
+"""
+import json
+import logging
+import threading
+import collections
+
+import six
+import peewee
+
+import habibi.db as habibi_db
+import habibi.exc as habibi_exc
+import habibi.writebehind as habibi_writebehind
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Record(object):
+    """Base class of in-memory entities. Subclasses are created for every model by `record_class`."""
+    __slots__ = ()
+
+    model = None
+    # Names of plain fields, foreign keys and related names (lists of children)
+    fields = ()
+    foreign_keys = ()
+    backrefs = ()
+
+    @property
+    def pk(self):
+        return getattr(self, self.model._meta.primary_key.name)
+
+    def to_dict(self):
+        data = dict((name, getattr(self, name)) for name in self.fields)
+        for name in self.foreign_keys:
+            parent = getattr(self, name)
+            data[name] = parent.to_dict() if parent is not None else {}
+        return data
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.pk)
+
+
+def _json_property(name):
+    """JSON values are kept serialized: every read returns new object, like DB does."""
+    slot = '_' + name
+
+    def getter(self):
+        value = getattr(self, slot)
+        return value if value is None else json.loads(value)
+
+    def setter(self, value):
+        setattr(self, slot, json.dumps(value))
+
+    return property(getter, setter)
+
+
+def record_class(model):
+    """Create `Record` subclass with slots for fields of peewee `model`."""
+    fields, foreign_keys, slots = [], [], []
+    class_dict = dict(model=model)
+    for field in model._meta.get_fields():
+        if isinstance(field, peewee.ForeignKeyField):
+            foreign_keys.append(field.name)
+            slots.append(field.name)
+        elif isinstance(field, habibi_db.JsonField):
+            fields.append(field.name)
+            slots.append('_' + field.name)
+            class_dict[field.name] = _json_property(field.name)
+        else:
+            fields.append(field.name)
+            slots.append(field.name)
+    backrefs = list(model._meta.reverse_rel)
+    class_dict.update(__slots__=tuple(slots + backrefs), fields=tuple(fields),
+                      foreign_keys=tuple(foreign_keys), backrefs=tuple(backrefs))
+    return type(model.__name__ + 'Record', (Record,), class_dict)
+
+
+class StateEngine(object):
+    """Keeps all habibi entities in memory.
+
+       Every write is applied to memory immediately and queued for DB,
+       queue is flushed in one transaction when it holds `batch_size` writes,
+       or when the oldest write waits longer than `flush_interval` seconds.
+
+       Engine assumes, it is the only writer to DB: changes, made to DB
+       by other processes after `load`, are not visible.
+
+       :param database: database, entities are loaded from and written to,
+           the one `habibi.db` models point to, if not set
+    """
+
+    models = habibi_db.SCALR_ENTITIES
+    # Besides foreign keys, which are always indexed
+    indexed_fields = {
+        habibi_db.Farm: ('name', 'status'),
+        habibi_db.Role: ('name',),
+        habibi_db.Server: ('status',),
+    }
+    # Integer fields, for which engine gives out next values
+    sequence_fields = {
+        habibi_db.Server: ('index',),
+    }
+
+    def __init__(self, batch_size=100, flush_interval=None, max_retries=3, database=None):
+        self.records = dict((model, record_class(model)) for model in self.models)
+        self.lock = threading.RLock()
+        self.database = database
+        self.queue = habibi_writebehind.WriteBehindQueue(
+            self._persist, batch_size=batch_size, flush_interval=flush_interval, max_retries=max_retries)
+        self._reset()
+
+    def _reset(self):
+        # model -> {pk: record}, in insertion order
+        self.by_id = dict((model, collections.OrderedDict()) for model in self.models)
+        # model -> {field name: {value: {pk: record}}}
+        self.indexes = dict()
+        self.sequences = dict()
+        for model in self.models:
+            names = self.records[model].foreign_keys + self.indexed_fields.get(model, ())
+            self.indexes[model] = dict((name, dict()) for name in names)
+            names = self.sequence_fields.get(model, ())
+            if model._meta.auto_increment:
+                names += (model._meta.primary_key.name,)
+            self.sequences[model] = dict((name, 0) for name in names)
+
+    def start(self, background=True):
+        """Save queued writes at exit and start background thread, that flushes expired writes.
+           See `WriteBehindQueue.start`.
+        """
+        self.queue.start(background)
+
+    def stop(self):
+        """Stop background thread and write all queued changes to DB."""
+        self.queue.stop()
+
+    def flush(self):
+        """Write all queued changes to DB. If it fails, changes stay queued and exception is reraised."""
+        self.queue.flush()
+
+    @property
+    def failures(self):
+        """Number of failed attempts to write queued changes to DB."""
+        return self.queue.failures
+
+    @property
+    def dead_letters(self):
+        """Queued writes, that were dropped after `max_retries` failed retries."""
+        return self.queue.dead_letters
+
+    def load(self):
+        """Replace contents of memory with entities from DB. Queued writes are flushed first."""
+        with self.lock, habibi_db.using(self.database):
+            self.flush()
+            self._reset()
+            # Parents come first in SCALR_ENTITIES, so foreign keys are resolved while loading
+            for model in self.models:
+                fields = model._meta.get_fields()
+                names = [f.name for f in fields]
+                for row in model.select(*fields).tuples():
+                    # DB doesn't enforce foreign keys: e.g. servers of removed farm role are kept
+                    self._add(model, dict(zip(names, row)), strict=False)
+            LOG.debug('Loaded state: %s', dict((m.__name__, len(r)) for m, r in six.iteritems(self.by_id)))
+
+    def next_value(self, model, field_name):
+        """Return value of sequence field (e.g. Server.index) for the next record."""
+        with self.lock:
+            return self.sequences[model][field_name] + 1
+
+    def _coerce(self, model, name, value):
+        """Convert filter value to the form it's kept in records."""
+        field = model._meta.fields[name]
+        if isinstance(field, peewee.ForeignKeyField):
+            if isinstance(value, (Record, peewee.Model)):
+                return value.pk if isinstance(value, Record) else value._get_pk_value()
+            if isinstance(value, dict):
+                value = value[field.to_field.name]
+            return field.to_field.python_value(value)
+        if isinstance(field, habibi_db.JsonField) or value is None:
+            return value
+        return field.python_value(value)
+
+    def _value(self, record, name):
+        """Value of field `name` as kept in indexes: pk of parent for foreign keys."""
+        value = getattr(record, name)
+        if name in record.foreign_keys:
+            return value.pk if value is not None else None
+        return value
+
+    def _resolve(self, model, values, strict=True):
+        """Return values with pks in foreign keys replaced by parent records.
+           If not `strict`, missing parents are replaced with None.
+        """
+        values = dict(values)
+        for name in self.records[model].foreign_keys:
+            if values.get(name) is None:
+                continue
+            parent_model = model._meta.fields[name].rel_model
+            parent_pk = self._coerce(model, name, values[name])
+            values[name] = self.by_id[parent_model].get(parent_pk)
+            if values[name] is None and strict:
+                raise habibi_exc.HabibiApiNotFound(parent_model, [parent_pk], None)
+        return values
+
+    def _check_unique(self, model, values, pk):
+        for name in self.indexed_fields.get(model, ()):
+            if name in values and model._meta.fields[name].unique:
+                if any(other != pk for other in self.indexes[model][name].get(values[name], ())):
+                    raise peewee.IntegrityError('{} with {}={} already exists'.format(
+                        model.__name__, name, values[name]))
+
+    def _add(self, model, values, strict=True):
+        record = self.records[model]()
+        for name in record.backrefs:
+            setattr(record, name, [])
+        values = self._resolve(model, values, strict)
+        for name in record.fields + record.foreign_keys:
+            setattr(record, name, values.get(name))
+
+        pk = record.pk
+        if pk in self.by_id[model]:
+            raise peewee.IntegrityError('{} with {}={} already exists'.format(
+                model.__name__, model._meta.primary_key.name, pk))
+        self._check_unique(model, values, pk)
+
+        self.by_id[model][pk] = record
+        self._index(model, record)
+        for name, latest in six.iteritems(self.sequences[model]):
+            self.sequences[model][name] = max(latest, getattr(record, name) or 0)
+        return record
+
+    def _index(self, model, record, names=None):
+        for name in names or self.indexes[model]:
+            value = self._value(record, name)
+            self.indexes[model][name].setdefault(value, collections.OrderedDict())[record.pk] = record
+            if name in record.foreign_keys and value is not None:
+                getattr(getattr(record, name), model._meta.fields[name].related_name).append(record)
+
+    def _unindex(self, model, record, names=None):
+        for name in names or self.indexes[model]:
+            value = self._value(record, name)
+            self.indexes[model][name].get(value, {}).pop(record.pk, None)
+            if name in record.foreign_keys and value is not None:
+                children = getattr(getattr(record, name), model._meta.fields[name].related_name)
+                if record in children:
+                    children.remove(record)
+
+    def _remove(self, model, record):
+        self.by_id[model].pop(record.pk, None)
+        self._unindex(model, record)
+
+    def find(self, model, ids=None, filters=None):
+        """Return list of `model` records with pk in `ids` (if passed),
+           which fields are equal to `filters` values.
+        """
+        filters = dict((name, self._coerce(model, name, value))
+                       for name, value in six.iteritems(filters or dict()))
+        with self.lock:
+            if ids:
+                pk_field = model._meta.primary_key
+                by_id = self.by_id[model]
+                pks = collections.OrderedDict.fromkeys(pk_field.python_value(pk) for pk in ids)
+                records = [by_id[pk] for pk in pks if pk in by_id]
+            else:
+                # Narrow down using one of indexed fields
+                for name, value in six.iteritems(filters):
+                    if name in self.indexes[model]:
+                        records = list(self.indexes[model][name].get(value, {}).values())
+                        filters.pop(name)
+                        break
+                else:
+                    records = list(self.by_id[model].values())
+
+        for name, value in six.iteritems(filters):
+            records = [record for record in records if self._value(record, name) == value]
+        return records
+
+    def create(self, model, **values):
+        """Add new record, return it. Values missing from `values` are set to field defaults."""
+        with self.lock:
+            for name in self.sequences[model]:
+                if values.get(name) is None:
+                    values[name] = self.next_value(model, name)
+            for field in model._meta.get_fields():
+                if field.name not in values and field.default is not None:
+                    values[field.name] = field.default() if callable(field.default) else field.default
+            record = self._add(model, values)
+            self.queue.put(('insert', model, self._row(record)))
+        return record
+
+    def update(self, model, pk, **values):
+        """Update fields of the record with primary key `pk`."""
+        with self.lock:
+            record = self.by_id[model].get(model._meta.primary_key.python_value(pk))
+            if record is None:
+                raise habibi_exc.HabibiApiNotFound(model, [pk], None)
+            resolved = self._resolve(model, values)
+            self._check_unique(model, resolved, record.pk)
+            # Only indexes of changed fields are touched: children lists of parents may be long
+            changed = [name for name in self.indexes[model] if name in values]
+            self._unindex(model, record, changed)
+            for name, value in six.iteritems(resolved):
+                setattr(record, name, value)
+            self._index(model, record, changed)
+            self.queue.put(('update', model, record.pk, values))
+        return record
+
+    def delete(self, model, pk):
+        """Delete record with primary key `pk`. Children are kept, like in DB."""
+        with self.lock:
+            record = self.by_id[model].get(model._meta.primary_key.python_value(pk))
+            if record is not None:
+                self._remove(model, record)
+                self.queue.put(('delete', model, record.pk))
+
+    def forget(self, model, pks):
+        """Drop records from memory only, e.g. after they were moved from DB elsewhere."""
+        with self.lock:
+            for pk in pks:
+                record = self.by_id[model].get(pk)
+                if record is not None:
+                    self._remove(model, record)
+
+    def _row(self, record):
+        row = dict((name, getattr(record, name)) for name in record.fields)
+        for name in record.foreign_keys:
+            row[name] = self._value(record, name)
+        return row
+
+    def _persist(self, operations):
+        """Apply queued writes to DB in one transaction, runs of inserts are batched."""
+        with habibi_db.using(self.database), habibi_db.DB_PROXY.atomic():
+            inserts, inserts_model = [], None
+            for operation in operations + [(None, None)]:
+                action, model = operation[:2]
+                if inserts and (action != 'insert' or model is not inserts_model):
+                    habibi_db.bulk_insert(inserts_model, inserts)
+                    inserts = []
+                if action == 'insert':
+                    inserts_model = model
+                    inserts.append(operation[2])
+                elif action == 'update':
+                    pk, values = operation[2:]
+                    model.update(**values).where(model._meta.primary_key == pk).execute()
+                elif action == 'delete':
+                    model.delete().where(model._meta.primary_key == operation[2]).execute()
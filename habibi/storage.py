@@ -6,46 +6,305 @@ import sys
 import json
 import glob
 import uuid
+import fcntl
 import logging
-from scalarizr.linux import lvm2, system
+import subprocess
+import contextlib
 from habibi import events
+from habibi import tracing
+from habibi.utils import chunked_image
 
 LOG = logging.getLogger(__name__)
 
 vg_name = 'tests'
 cgroup_mpoint = '/sys/fs/cgroup' # Ubuntu default
+# Executable that loads device BPF program on cgroup v2 hosts. Called as
+# `<helper> <cgroup_dir> allow|deny <rule> [<rule> ...]`. Habibi doesn't ship one:
+# without it volumes can't be attached on cgroup v2 host (other storage calls work).
+cgroup_v2_device_helper = None
 snap_size = '100M'
 snapshot_dir = '/tmp/snapshots'
+# Store snapshots in compressed chunked format (see habibi.utils.chunked_image)
+compress_snapshots = False
+compress_chunk_size = 4 * 1024 ** 2
+compress_level = 1
+# Number of compression processes, None means number of CPUs
+compress_workers = None
+# Directory for volume images of 'sparse' backend
+image_dir = '/tmp/habibi-volumes'
+# 'lvm' or 'sparse', see `backends`
+storage_backend = 'lvm'
 port = 12345
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
 
 class StorageError(Exception):
     pass
 
 
+def system(args, shell=False):
+    LOG.debug('Executing: %s', args)
+    command = args.split(None, 1)[0] if isinstance(args, basestring) else args[0]
+    with tracing.span(command, 'storage', args=args):
+        proc = subprocess.Popen(args, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+    if proc.returncode:
+        raise StorageError('Command %s failed with code %s: %s' % (args, proc.returncode, err.strip()))
+    return out
+
+
+def reflink(src, dst):
+    """
+    Copy file `src` to `dst` using reflink (shared extents, O(1) regardless of size)
+    if filesystem supports it (btrfs, xfs with reflink=1), otherwise make sparse copy.
+    """
+    with open(src, 'rb') as src_f:
+        with open(dst, 'wb') as dst_f:
+            try:
+                fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+                return True
+            except (IOError, OSError):
+                pass
+    system(['cp', '--sparse=always', src, dst])
+    return False
+
+
+class LvmBackend(object):
+    """Volumes are logical volumes of `vg_name` volume group."""
+
+    # New logical volumes contain garbage
+    zeroed_volumes = False
+
+    def __init__(self, lvm2=None):
+        if lvm2 is None:
+            from scalarizr.linux import lvm2
+        self.lvm2 = tracing.TracedClient(lvm2, kind='lvm')
+
+    def create_volume(self, volume_id, size, snapshot_path=None):
+        lvm2 = self.lvm2
+        lvm2.lvcreate(vg_name, name=volume_id, size='%sG' % size)
+        lvinfo = lvm2.lvs(lvm2.lvpath(vg_name, volume_id)).values()[0]
+        device = os.path.realpath(lvinfo.lv_path)
+        if snapshot_path:
+            # Apply snapshot
+            system('dd if=%s of=%s' % (snapshot_path, device), shell=True)
+        return device
+
+    @contextlib.contextmanager
+    def snapshot_source(self, volume, snapshot_id):
+        """Yields path of point-in-time copy of the volume."""
+        lvm2 = self.lvm2
+        lvm2.lvcreate(os.path.join('/dev', vg_name, volume['id']), snapshot=True,
+                      name=snapshot_id, size=snap_size)
+        lv_info = None
+        try:
+            lv_info = lvm2.lvs(lvm2.lvpath(vg_name, snapshot_id)).values()[0]
+            yield lv_info.lv_path
+        finally:
+            if lv_info:
+                lvm2.lvremove(lv_info.lv_path)
+            else:
+                lvm2.lvremove(os.path.join('/dev', vg_name, snapshot_id))
+
+    def create_snapshot(self, volume, snapshot_path):
+        with self.snapshot_source(volume, os.path.basename(snapshot_path)) as source:
+            system('dd if=%s | cp --sparse=always /dev/stdin %s' % (source, snapshot_path), shell=True)
+
+    def destroy_volume(self, volume):
+        try:
+            self.lvm2.lvremove(volume['host_path'])
+        except self.lvm2.NotFound:
+            # Already removed, e.g. with the whole volume group
+            pass
+
+    def cleanup(self):
+        # Remove all volumes of volume group
+        try:
+            self.lvm2.vgs(vg_name)
+        except self.lvm2.NotFound:
+            pass
+        else:
+            self.lvm2.vgremove(vg_name)
+
+
+class SparseFileBackend(object):
+    """
+    Volumes are sparse image files in `image_dir`, exposed as block devices
+    through loop devices. Snapshots and volumes created from snapshots are reflink
+    copies of image files, so they take no time and space until blocks diverge.
+    No volume group is required.
+    """
+
+    zeroed_volumes = True
+
+    def __init__(self, directory=None):
+        self.directory = directory or image_dir
+        # Volume id -> loop device
+        self.loop_devices = dict()
+
+    def _image_path(self, volume_id):
+        return os.path.join(self.directory, '%s.img' % volume_id)
+
+    def create_volume(self, volume_id, size, snapshot_path=None):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        image = self._image_path(volume_id)
+        if snapshot_path:
+            reflink(snapshot_path, image)
+        size_bytes = int(size) * 1024 ** 3
+        with open(image, 'ab') as f:
+            if f.tell() < size_bytes:
+                f.truncate(size_bytes)
+        try:
+            device = system(['losetup', '--find', '--show', image]).strip()
+        except:
+            os.remove(image)
+            raise
+        self.loop_devices[volume_id] = device
+        return device
+
+    @contextlib.contextmanager
+    def snapshot_source(self, volume, snapshot_id):
+        """Yields path of point-in-time copy of the volume."""
+        source = os.path.join(self.directory, '%s.snap' % snapshot_id)
+        reflink(self._image_path(volume['id']), source)
+        try:
+            yield source
+        finally:
+            os.remove(source)
+
+    def create_snapshot(self, volume, snapshot_path):
+        reflink(self._image_path(volume['id']), snapshot_path)
+
+    def destroy_volume(self, volume):
+        device = self.loop_devices.pop(volume['id'], volume['host_path'])
+        system(['losetup', '--detach', device])
+        os.remove(self._image_path(volume['id']))
+
+    def cleanup(self):
+        for volume_id, device in self.loop_devices.items():
+            system(['losetup', '--detach', device])
+            os.remove(self._image_path(volume_id))
+        self.loop_devices.clear()
+
+
+backends = {
+    'lvm': LvmBackend,
+    'sparse': SparseFileBackend
+}
+
+
+class CgroupDeviceIndex(object):
+    """
+    Maps instance id to the cgroup directory of its container.
+
+    Directory scan runs once per instance (on first lookup); entry is dropped
+    when server terminates. Supports cgroup v1 (devices.allow/devices.deny files).
+    On cgroup v2 device access is controlled by BPF program: habibi doesn't load it itself,
+    attach and detach are unsupported there without external `cgroup_v2_device_helper`.
+    """
+
+    v1_patterns = ('devices/lxc/%s*',)
+    v2_patterns = ('lxc/%s*', 'lxc.payload.%s*', 'system.slice/docker-%s*.scope')
+
+    def __init__(self, mpoint=None):
+        self.mpoint = mpoint or cgroup_mpoint
+        self.paths = dict()
+        self._version = None
+
+    @property
+    def version(self):
+        if self._version is None:
+            unified = os.path.exists(os.path.join(self.mpoint, 'cgroup.controllers'))
+            self._version = 2 if unified else 1
+        return self._version
+
+    def check_supported(self):
+        """Raise StorageError, if device access of containers can't be managed on this host.
+        Checked on attach and detach only: volumes and snapshots are managed on any host.
+        """
+        if 2 == self.version and not cgroup_v2_device_helper:
+            raise StorageError('%s is cgroup v2 hierarchy: device access of containers is controlled '
+                               'by BPF programs there, set storage.cgroup_v2_device_helper to '
+                               'executable, that loads them' % self.mpoint)
+
+    def lookup(self, instance_id):
+        """Return cgroup dir of the instance, or None if container is gone."""
+        path = self.paths.get(instance_id)
+        if path and os.path.isdir(path):
+            return path
+
+        patterns = self.v2_patterns if 2 == self.version else self.v1_patterns
+        for pattern in patterns:
+            found = glob.glob(os.path.join(self.mpoint, pattern % instance_id))
+            if found:
+                self.paths[instance_id] = found[0]
+                return found[0]
+        self.paths.pop(instance_id, None)
+        return None
+
+    def forget(self, instance_id):
+        self.paths.pop(instance_id, None)
+
+    def apply(self, instance_id, action, volumes):
+        """
+        Allow or deny access to block devices of `volumes` for the instance.
+        All rules are applied in one batch: cgroup is looked up once, and on v1
+        control file is opened once (kernel accepts single rule per write, so
+        every rule is still a separate unbuffered write).
+
+        :param action: 'allow' or 'deny'
+        :returns: False if instance cgroup does not exist, True otherwise
+        """
+        self.check_supported()
+        path = self.lookup(instance_id)
+        if path is None:
+            return False
+        rules = ["b %s:%s rwm" % (volume['maj'], volume['min']) for volume in volumes]
+        if not rules:
+            return True
+
+        if 2 == self.version:
+            system([cgroup_v2_device_helper, path, action] + rules)
+        else:
+            with open(os.path.join(path, 'devices.%s' % action), 'w', 0) as f:
+                for rule in rules:
+                    f.write(rule + "\n")
+        return True
+
+
 class StorageMgr():
 
-    def __init__(self, farm):
+    def __init__(self, farm, backend=None):
         self.farm = farm
+        backend = backend or storage_backend
+        try:
+            self.backend = backends[backend]()
+        except KeyError:
+            raise StorageError('Unknown storage backend: %s' % backend)
         self.volumes = dict()
         self.snapshots = dict()
         # Server_id -> [volumes attached]
         self.attachments = dict()
+        self.cgroups = CgroupDeviceIndex()
 
     @events.listener(event='server_terminated')
     def _server_terminated(self, server):
         if self.attachments.get(server['id']):
-            for volume in self.attachments[server['id']]:
-                self.detach_volume(volume['id'], server['id'])
+            volumes = list(self.attachments[server['id']])
+            try:
+                self._detach_volumes(volumes, server['id'])
+            except StorageError:
+                # Container is gone, its device rules are gone with its cgroup
+                LOG.warning('Failed to deny devices of terminated server %s', server['id'], exc_info=True)
+                for volume in volumes:
+                    volume['attached_to'] = None
+                self.attachments.pop(server['id'], None)
+        self.cgroups.forget(server['id'])
 
 
     def cleanup(self):
-        # Remove all volumes of volume group
-        try:
-            lvm2.vgs(vg_name)
-        except lvm2.NotFound:
-            pass
-        else:
-            lvm2.vgremove(vg_name)
+        self.backend.cleanup()
 
 
     def __call__(self, environ, start_response):
@@ -63,7 +322,8 @@ class StorageMgr():
                 return str(sys.exc_info()[1])
 
             try:
-                payload = method(**params)
+                with tracing.span(data['method'], 'storage_api'):
+                    payload = method(**params)
                 result = dict(status='ok')
                 if payload:
                     result['payload'] = payload
@@ -101,12 +361,17 @@ class StorageMgr():
 
         id = 'vol-%s' % str(uuid.uuid4())[:7]
 
-        lvm2.lvcreate(vg_name, name=id, size='%sG' % size)
-        lvinfo = lvm2.lvs(lvm2.lvpath(vg_name, id)).values()[0]
-        device = os.path.realpath(lvinfo.lv_path)
-        if snapshot_id:
-            # Apply snapshot
-            system('dd if=%s of=%s' % (self._get_snapshot_path(snapshot_id), device), shell=True)
+        size = size or snapshot['size']
+        if snapshot_id and snapshot.get('format') == 'chunked':
+            device = self.backend.create_volume(id, size)
+            stats = chunked_image.decompress(self._get_snapshot_path(snapshot_id), device,
+                                             workers=compress_workers,
+                                             skip_zero_chunks=self.backend.zeroed_volumes)
+            LOG.info('Snapshot %s restored to %s: %s bytes, %.2f MB/s',
+                     snapshot_id, id, stats['size'], stats['throughput'] / 1024.0 ** 2)
+        else:
+            snapshot_path = snapshot_id and self._get_snapshot_path(snapshot_id) or None
+            device = self.backend.create_volume(id, size, snapshot_path)
 
         stat = os.stat(device)
         maj, min = (os.major(stat.st_rdev), os.minor(stat.st_rdev))
@@ -117,68 +382,82 @@ class StorageMgr():
 
 
     def attach_volume(self, volume_id, instance_id):
-        assert volume_id in self.volumes, 'Volume "%s" not found' % volume_id
-        volume = self.volumes[volume_id]
-        attached_to = volume['attached_to']
-        assert attached_to == None, 'Volume already attached to instance "%s"' % attached_to
+        return dict(volume=self.attach_volumes([volume_id], instance_id)['volumes'][0])
+
 
-        allow_path_wildcard = os.path.join(cgroup_mpoint, 'devices/lxc/%s*/devices.allow' % instance_id)
-        allow_path = glob.glob(allow_path_wildcard)[0]
+    def attach_volumes(self, volume_ids, instance_id):
+        volumes = []
+        for volume_id in volume_ids:
+            assert volume_id in self.volumes, 'Volume "%s" not found' % volume_id
+            volume = self.volumes[volume_id]
+            attached_to = volume['attached_to']
+            assert attached_to == None, 'Volume already attached to instance "%s"' % attached_to
+            volumes.append(volume)
+
+        if not self.cgroups.apply(instance_id, 'allow', volumes):
+            raise StorageError('Instance "%s" not found' % instance_id)
 
-        with open(allow_path, 'w') as f:
-            f.write("b %s:%s rwm\n" % (volume['maj'], volume['min']))
-        volume['attached_to'] = instance_id
         if self.attachments.get(instance_id) is None:
             self.attachments[instance_id] = []
-        self.attachments[instance_id].append(volume)
-        return dict(volume=volume)
+        for volume in volumes:
+            volume['attached_to'] = instance_id
+            self.attachments[instance_id].append(volume)
+        return dict(volumes=volumes)
 
 
     def detach_volume(self, volume_id, instance_id):
-        assert volume_id in self.volumes, 'Volume "%s" not found' % volume_id
-        volume = self.volumes[volume_id]
-        attached_to = volume['attached_to']
-        assert attached_to == instance_id, 'Volume not atached to instance "%s"' % instance_id
+        self.detach_volumes([volume_id], instance_id)
+
+
+    def detach_volumes(self, volume_ids, instance_id):
+        volumes = []
+        for volume_id in volume_ids:
+            assert volume_id in self.volumes, 'Volume "%s" not found' % volume_id
+            volume = self.volumes[volume_id]
+            attached_to = volume['attached_to']
+            assert attached_to == instance_id, 'Volume not atached to instance "%s"' % instance_id
+            volumes.append(volume)
+        self._detach_volumes(volumes, instance_id)
 
-        deny_path_wildcard = os.path.join(cgroup_mpoint, 'devices/lxc/%s*/devices.deny' % instance_id)
+
+    def _detach_volumes(self, volumes, instance_id):
         try:
-            deny_path = glob.glob(deny_path_wildcard)[0]
-        except IndexError:
+            self.cgroups.apply(instance_id, 'deny', volumes)
+        except (IOError, OSError):
             # Server is no longer exist
-            pass
-        else:
-            try:
-                # Again. does not exist
-                with open(deny_path, 'w') as f:
-                    f.write("b %s:%s rwm\n" % (volume['maj'], volume['min']))
-            except IOError:
-                pass
+            self.cgroups.forget(instance_id)
 
-        volume['attached_to'] = None
-        self.attachments[instance_id].remove(volume)
+        for volume in volumes:
+            volume['attached_to'] = None
+            self.attachments[instance_id].remove(volume)
 
 
-    def create_snapshot(self, volume_id):
+    def create_snapshot(self, volume_id, compress=None):
+        """
+        :param compress: write snapshot in compressed chunked format, which is smaller
+            but slower to create and restore than raw image. Defaults to `compress_snapshots`.
+        """
         assert volume_id in self.volumes, 'Volume "%s" not found' % volume_id
         volume = self.volumes[volume_id]
+        compress = compress_snapshots if compress is None else compress
 
         snapshot_id = str(uuid.uuid4())[:7]
         if not os.path.isdir(snapshot_dir):
             os.makedirs(snapshot_dir)
         snap_path = self._get_snapshot_path(snapshot_id)
 
-        lvm2.lvcreate(os.path.join('/dev', vg_name, volume['id']), snapshot=True, name=snapshot_id, size=snap_size)
-        lv_info = None
-        try:
-            lv_info = lvm2.lvs(lvm2.lvpath(vg_name, snapshot_id)).values()[0]
-            system('dd if=%s | cp --sparse=always /dev/stdin %s' % (lv_info.lv_path, snap_path), shell=True)
-        finally:
-            if lv_info:
-                lvm2.lvremove(lv_info.lv_path)
-            else:
-                lvm2.lvremove(os.path.join('/dev', vg_name, snapshot_id))
+        if compress:
+            with self.backend.snapshot_source(volume, snapshot_id) as source:
+                stats = chunked_image.compress(source, snap_path, chunk_size=compress_chunk_size,
+                                               level=compress_level, workers=compress_workers)
+            LOG.info('Snapshot %s of %s: %s -> %s bytes, ratio %s, %.2f MB/s',
+                     snapshot_id, volume_id, stats['size'], stats['compressed_size'],
+                     stats['compression_ratio'], stats['throughput'] / 1024.0 ** 2)
+            snapshot = dict(id=snapshot_id, size=volume['size'], format='chunked', stats=stats)
+        else:
+            self.backend.create_snapshot(volume, snap_path)
+            snapshot = dict(id=snapshot_id, size=volume['size'], format='raw')
 
-        snapshot = dict(id=snapshot_id, size=volume['size'])
         self.snapshots[snapshot_id] = snapshot
         return snapshot
 
@@ -207,7 +486,8 @@ class StorageMgr():
 
         if attached_to:
             raise StorageError('Can not destroy volume: volume attached to instance %s' % attached_to)
-        lvm2.lvremove(volume['host_path'])
+        self.backend.destroy_volume(volume)
+        del self.volumes[id]
 
 
     def destroy_snapshot(self, id):
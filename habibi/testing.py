@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.testing
+    ~~~~~~~~~~~~~~
+
+    Helpers for running habibi without docker: in-process fake docker client
+    and generator of synthetic farm topologies.
+"""
+import uuid
+import threading
+
+import habibi.exc as habibi_exc
+
+
+class FakeDockerClient(object):
+    """In-process replacement for `docker.Client`, that only keeps track of containers."""
+
+    # url -> client, shared by all users of `fake://` url (see `habibi.dockerpool`)
+    daemons = dict()
+    daemons_lock = threading.Lock()
+
+    def __init__(self, base_url=None, **kwargs):
+        self.base_url = base_url
+        self.containers_by_id = dict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def daemon(cls, url):
+        """Return fake daemon for `url`, the same one for every call in the process."""
+        with cls.daemons_lock:
+            if url not in cls.daemons:
+                cls.daemons[url] = cls(base_url=url)
+            return cls.daemons[url]
+
+    def _get(self, container):
+        container_id = container['Id'] if isinstance(container, dict) else container
+        try:
+            return self.containers_by_id[container_id]
+        except KeyError:
+            raise habibi_exc.HabibiApiNotFound(FakeContainer, [container_id], None)
+
+    def create_container(self, image, command=None, environment=None, **kwargs):
+        container_id = uuid.uuid4().hex + uuid.uuid4().hex
+        with self.lock:
+            self.containers_by_id[container_id] = dict(
+                Id=container_id, Image=image, Command=command, Env=environment,
+                State=dict(Running=False, ExitCode=0), Logs='')
+        return dict(Id=container_id, Warnings=None)
+
+    def start(self, container, **kwargs):
+        self._get(container)['State']['Running'] = True
+
+    def kill(self, container, **kwargs):
+        self._get(container)['State']['Running'] = False
+
+    def stop(self, container, **kwargs):
+        self.kill(container)
+
+    def remove_container(self, container, **kwargs):
+        with self.lock:
+            self.containers_by_id.pop(self._get(container)['Id'])
+
+    def inspect_container(self, container):
+        return self._get(container)
+
+    def logs(self, container, **kwargs):
+        return self._get(container)['Logs']
+
+    def containers(self, all=False, **kwargs):
+        return [dict(Id=c['Id'], Image=c['Image']) for c in self.containers_by_id.values()
+                if all or c['State']['Running']]
+
+    def ping(self):
+        return 'OK'
+
+
+class FakeContainer(object):
+    """Used in not found errors of FakeDockerClient."""
+
+
+def build_topology(api, farms=1, farm_roles=2, servers=10, gvs=5, rules=2, status='running'):
+    """Create synthetic infrastructure through `api`.
+
+       :param farms: number of farms
+       :param farm_roles: number of farm roles in every farm
+       :param servers: number of servers of every farm role
+       :param gvs: number of user-defined GVs for every scope (farm, role, farm role)
+       :param rules: number of orchestration rules per event of every farm role
+       :param status: status of created servers
+       :returns: dict with lists of created farms, roles, farm_roles and servers
+    """
+    behaviors = ('base', 'app', 'mysql2', 'chef', 'redis')
+    targets = ({'type': 'farm'}, {'type': 'triggering-server'},
+               {'type': 'behavior', 'behaviors': ['app']})
+    topology = dict(farms=[], roles=[], farm_roles=[], servers=[])
+
+    for role_index in range(farm_roles):
+        role = api.create_role('role-{}-{}'.format(role_index, uuid.uuid4().hex[:8]), 'ubuntu:14.04',
+                               behaviors=['base', behaviors[role_index % len(behaviors)]])
+        topology['roles'].append(role)
+
+    for farm_index in range(farms):
+        farm = api.create_farm('farm-{}-{}'.format(farm_index, uuid.uuid4().hex[:8]))
+        topology['farms'].append(farm)
+        for role in topology['roles']:
+            orchestration = dict(
+                (event, [dict(target=targets[i % len(targets)], script='rule-{}'.format(i))
+                         for i in range(rules)])
+                for event in ('HostInit', 'BeforeHostUp', 'HostUp'))
+            farm_role = api.farm_add_role(farm['id'], role['id'], orchestration=orchestration)
+            topology['farm_roles'].append(farm_role)
+            for _ in range(servers):
+                topology['servers'].append(api.create_server(farm_role['id'], status=status))
+
+    for i in range(gvs):
+        for scope in ('farm', 'role', 'farm_role'):
+            for entity in topology[scope + 's']:
+                api.set_global_variable('GV_{}_{}'.format(scope.upper(), i), 'value-{}'.format(i),
+                                        scope, entity['id'])
+    return topology
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.tracing
+    ~~~~~~~~~~~~~~
+
+    Nested timing spans of api methods, SQL statements, docker calls,
+    event notifications and storage commands, grouped into traces.
+
+    Span, started when no other span is open in the thread, is the root of a new trace,
+    spans, started inside it, are its children and share its trace id.
+    Whether trace is recorded is decided once, for its root (`sample_rate`),
+    so spans of unsampled traces cost only a thread-local lookup.
+    Finished traces are passed to exporters as lists of spans.
+
+    Usage::
+
+        api = HabibiApi(tracing=True)   # writes to <base_dir>/traces/
+        ...
+        # chrome://tracing or https://ui.perfetto.dev: open <base_dir>/traces/trace-<pid>.json
+"""
+import os
+import json
+import time
+import random
+import inspect
+import logging
+import threading
+
+import habibi.metrics as habibi_metrics
+
+
+LOG = logging.getLogger(__name__)
+
+# Tracer, used by code, that is not bound to api object (EventMgr, storage), see `install`
+_installed = None
+
+
+def _new_id():
+    return '{:016x}'.format(random.getrandbits(64))
+
+
+class Span(object):
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind', 'start', 'duration',
+                 'thread', 'attrs', 'error')
+
+    def __init__(self, trace_id, parent_id, name, kind, attrs, start=None):
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = start or time.time()
+        self.duration = None
+        self.thread = threading.current_thread().name
+        self.attrs = attrs
+        self.error = None
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class _NoSpan(object):
+    """Context manager, used when tracing is off."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_SPAN = _NoSpan()
+
+
+class _SpanContext(object):
+
+    __slots__ = ('tracer', 'name', 'kind', 'attrs', 'span')
+
+    def __init__(self, tracer, name, kind, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.span = self.tracer._open(self.name, self.kind, self.attrs)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.span is not None and exc_type is not None:
+            self.span.error = '{}: {}'.format(exc_type.__name__, exc_value)
+        self.tracer._close(self.span)
+        return False
+
+
+class Tracer(object):
+    """Collects spans of sampled traces and passes finished traces to `exporters`.
+
+       :param exporters: list of objects with `export(spans)` method
+       :param sample_rate: share of traces to record, 0..1
+       :param max_spans: max number of spans, recorded per trace, the rest are counted in `dropped`
+    """
+
+    def __init__(self, exporters=None, sample_rate=1.0, max_spans=10000):
+        self.exporters = exporters or []
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.dropped = 0
+        self._local = threading.local()
+
+    def _stack(self):
+        local = self._local
+        if not hasattr(local, 'stack'):
+            # Open spans, None stands for span of unsampled trace; finished spans of current trace
+            local.stack = []
+            local.spans = []
+        return local.stack
+
+    def span(self, name, kind='internal', **attrs):
+        """Context manager, that measures its body as span. Returns Span or None, if trace is not sampled."""
+        return _SpanContext(self, name, kind, attrs)
+
+    def current(self):
+        """Return innermost open span of the thread, None if there is none or trace is not sampled."""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _open(self, name, kind, attrs, start=None):
+        stack = self._stack()
+        if stack:
+            parent = stack[-1]
+            span = parent and Span(parent.trace_id, parent.span_id, name, kind, attrs, start)
+        else:
+            sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+            span = sampled and Span(_new_id(), None, name, kind, attrs, start) or None
+        stack.append(span)
+        return span
+
+    def _close(self, span):
+        stack = self._stack()
+        stack.pop()
+        if span is None:
+            return
+        if span.duration is None:
+            span.duration = time.time() - span.start
+        spans = self._local.spans
+        if len(spans) < self.max_spans:
+            spans.append(span)
+        else:
+            self.dropped += 1
+        if not stack:
+            self._local.spans = []
+            self._export(spans)
+
+    def record(self, name, kind, start, duration, **attrs):
+        """Add span, that has already finished (e.g. SQL statement, reported by listener)."""
+        span = self._open(name, kind, attrs, start)
+        if span is not None:
+            span.duration = duration
+        self._close(span)
+
+    def sql_listener(self, sql, params, duration):
+        if self.current() is not None:
+            self.record(habibi_metrics.statement_name(sql), 'sql', time.time() - duration, duration, sql=sql)
+
+    def _export(self, spans):
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except:
+                LOG.exception('Trace export failed: %s', exporter)
+
+
+def install(tracer):
+    """Make `tracer` record spans of code, that is not bound to api object (EventMgr, storage)."""
+    global _installed
+    _installed = tracer
+
+
+def span(name, kind='internal', **attrs):
+    """Span of installed tracer, does nothing, unless tracer is installed."""
+    tracer = _installed
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, kind, **attrs)
+
+
+class TracedClient(object):
+    """Proxy for docker client (or other object), that records span of every method call.
+       Other attributes, including classes (e.g. exceptions of the client), are returned as they are.
+       If `tracer` is None, installed tracer is used.
+    """
+
+    def __init__(self, client, tracer=None, kind='docker'):
+        self._client = client
+        self._tracer = tracer
+        self._kind = kind
+
+    def __getattr__(self, item):
+        attr = getattr(self._client, item)
+        if not callable(attr) or inspect.isclass(attr):
+            return attr
+
+        def traced_call(*args, **kwargs):
+            tracer = self._tracer
+            with tracer.span(item, self._kind) if tracer is not None else span(item, self._kind):
+                return attr(*args, **kwargs)
+        return traced_call
+
+
+class ListExporter(object):
+    """Keeps exported traces (lists of spans) in `traces` attribute."""
+
+    def __init__(self):
+        self.traces = []
+
+    def export(self, spans):
+        self.traces.append(spans)
+
+
+class _FileExporter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        return open(self.path, 'a')
+
+
+class JsonLinesExporter(_FileExporter):
+    """Appends spans to file at `path`, one JSON object per line."""
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict(), default=str) + '\n' for span in spans)
+        with self.lock:
+            with self._open() as f:
+                f.write(lines)
+
+
+class ChromeTraceExporter(_FileExporter):
+    """Appends spans to file at `path` in Chrome trace event format (JSON array form),
+       which chrome://tracing and Perfetto open as flame graph. Closing bracket
+       of the array is optional in this format, so spans are simply appended.
+    """
+
+    def __init__(self, path):
+        super(ChromeTraceExporter, self).__init__(path)
+        # thread name -> numeric id
+        self.threads = dict()
+
+    def export(self, spans):
+        pid = os.getpid()
+        events = []
+        with self.lock:
+            for span in spans:
+                if span.thread not in self.threads:
+                    self.threads[span.thread] = len(self.threads) + 1
+                    events.append(dict(name='thread_name', ph='M', pid=pid, tid=self.threads[span.thread],
+                                       args=dict(name=span.thread)))
+                args = dict(span.attrs, trace_id=span.trace_id)
+                if span.error:
+                    args['error'] = span.error
+                events.append(dict(name=span.name, cat=span.kind, ph='X', pid=pid,
+                                   tid=self.threads[span.thread], ts=int(span.start * 1e6),
+                                   dur=int(span.duration * 1e6), args=args))
+            text = ''.join(json.dumps(event, default=str) + ',\n' for event in events)
+            new = not os.path.exists(self.path)
+            with self._open() as f:
+                f.write(('[\n' if new else '') + text)
+
+
+def file_tracer(directory, sample_rate=1.0):
+    """Tracer, that writes spans of this process to JSONL and Chrome trace files in `directory`."""
+    pid = os.getpid()
+    return Tracer(exporters=[JsonLinesExporter(os.path.join(directory, 'spans-{}.jsonl'.format(pid))),
+                             ChromeTraceExporter(os.path.join(directory, 'trace-{}.json'.format(pid)))],
+                  sample_rate=sample_rate)
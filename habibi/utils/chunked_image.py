@@ -0,0 +1,185 @@
+"""
+    habibi.utils.chunked_image
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Compressed, seekable image format for volume snapshots.
+
+    Image is split into fixed-size chunks, every chunk is compressed independently,
+    so chunks can be (de)compressed in parallel and any of them can be read without
+    touching the others. All-zero chunks are not stored at all.
+
+    Layout::
+
+        header:  MAGIC | chunk_size (u32) | image_size (u64)
+        chunks:  zlib-compressed chunk data, one after another
+        index:   (offset (u64), length (u32)) per chunk, length 0 means zero chunk
+        trailer: index_offset (u64) | chunks count (u32) | MAGIC
+"""
+import os
+import time
+import zlib
+import struct
+import multiprocessing
+
+MAGIC = 'HBSNAP01'
+HEADER = struct.Struct('<8sIQ')
+INDEX_ENTRY = struct.Struct('<QI')
+TRAILER = struct.Struct('<QI8s')
+
+
+class ChunkedImageError(Exception):
+    pass
+
+
+def is_chunked_image(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _compress_chunk(args):
+    data, level = args
+    if not data.strip('\0'):
+        return None
+    return zlib.compress(data, level)
+
+
+def _read_chunks(path, chunk_size, level):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data, level
+
+
+def _image_size(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        return f.tell()
+
+
+def compress(src_path, dst_path, chunk_size=4 * 1024 ** 2, level=1, workers=None):
+    """
+    Write image (file or block device) `src_path` to `dst_path` in chunked format.
+
+    :returns: dict with size, compressed_size, compression_ratio and throughput (bytes/sec)
+    """
+    start = time.time()
+    image_size = _image_size(src_path)
+    index = []
+    pool = multiprocessing.Pool(workers)
+    try:
+        with open(dst_path, 'wb') as dst:
+            dst.write(HEADER.pack(MAGIC, chunk_size, image_size))
+            chunks = pool.imap(_compress_chunk, _read_chunks(src_path, chunk_size, level))
+            for compressed in chunks:
+                if compressed is None:
+                    index.append((0, 0))
+                else:
+                    index.append((dst.tell(), len(compressed)))
+                    dst.write(compressed)
+
+            index_offset = dst.tell()
+            for entry in index:
+                dst.write(INDEX_ENTRY.pack(*entry))
+            dst.write(TRAILER.pack(index_offset, len(index), MAGIC))
+            compressed_size = dst.tell()
+    finally:
+        pool.close()
+        pool.join()
+
+    return _stats(image_size, compressed_size, time.time() - start)
+
+
+def _stats(size, compressed_size, elapsed):
+    return dict(size=size,
+                compressed_size=compressed_size,
+                compression_ratio=round(float(size) / compressed_size, 2) if compressed_size else 0,
+                throughput=int(size / elapsed) if elapsed else 0)
+
+
+class ChunkedImage(object):
+    """Random-access reader of chunked image."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        magic, self.chunk_size, self.size = HEADER.unpack(self.fp.read(HEADER.size))
+        if magic != MAGIC:
+            self.fp.close()
+            raise ChunkedImageError('%s is not a chunked image' % path)
+
+        self.fp.seek(-TRAILER.size, os.SEEK_END)
+        self.compressed_size = self.fp.tell() + TRAILER.size
+        index_offset, count, _ = TRAILER.unpack(self.fp.read(TRAILER.size))
+        self.fp.seek(index_offset)
+        raw_index = self.fp.read(count * INDEX_ENTRY.size)
+        self.index = [INDEX_ENTRY.unpack_from(raw_index, i * INDEX_ENTRY.size)
+                      for i in range(count)]
+
+    def chunk_length(self, number):
+        return min(self.chunk_size, self.size - number * self.chunk_size)
+
+    def read_compressed(self, number):
+        """Return compressed data of chunk `number`, None for zero chunk."""
+        offset, length = self.index[number]
+        if not length:
+            return None
+        self.fp.seek(offset)
+        return self.fp.read(length)
+
+    def read_chunk(self, number):
+        data = self.read_compressed(number)
+        if data is None:
+            return '\0' * self.chunk_length(number)
+        return zlib.decompress(data)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _decompress_chunk(data):
+    return data is not None and zlib.decompress(data) or None
+
+
+def _write_all(fd, data):
+    """os.write may write less than asked (e.g. to pipes), write the rest until done."""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def decompress(src_path, dst_path, workers=None, skip_zero_chunks=False):
+    """
+    Write chunked image `src_path` directly into `dst_path` (file or block device).
+
+    :param skip_zero_chunks: do not write zero chunks, set it if `dst_path`
+        is known to be zeroed already (e.g. fresh sparse file).
+    :returns: dict with size, compressed_size, compression_ratio and throughput (bytes/sec)
+    """
+    start = time.time()
+    with ChunkedImage(src_path) as image:
+        pool = multiprocessing.Pool(workers)
+        try:
+            compressed = (image.read_compressed(i) for i in range(len(image.index)))
+            fd = os.open(dst_path, os.O_WRONLY)
+            try:
+                for number, data in enumerate(pool.imap(_decompress_chunk, compressed)):
+                    if data is None:
+                        if skip_zero_chunks:
+                            continue
+                        data = '\0' * image.chunk_length(number)
+                    os.lseek(fd, number * image.chunk_size, os.SEEK_SET)
+                    _write_all(fd, data)
+            finally:
+                os.close(fd)
+        finally:
+            pool.close()
+            pool.join()
+        return _stats(image.size, image.compressed_size, time.time() - start)
@@ -1,9 +1,107 @@
+"""
+    habibi.utils.crypto
+    ~~~~~~~~~~~~~~~~~~~
+
+    Random keys from OS CSPRNG (`os.urandom`), generated in bulk, and pool
+    of pre-generated keys, so callers (e.g. `HabibiApi.create_server`) don't wait for them.
+"""
 import os
 import string
-import random
+import logging
+import threading
+import collections
+
+
+LOG = logging.getLogger(__name__)
+
+KEY_CHARS = string.ascii_letters + string.digits + string.punctuation
+# Bytes above the largest multiple of len(KEY_CHARS) are rejected, so every char is equally likely
+_BYTE_LIMIT = 256 - 256 % len(KEY_CHARS)
+
 
 def keygen(length=10):
-    avail_chars = string.letters + string.digits + string.punctuation
-    random.seed = os.urandom(1024)
+    return keygen_bulk(1, length)[0]
+
+
+def keygen_bulk(count, length=10):
+    """Return list of `count` random keys of `length` chars. Random bytes are read at once."""
+    needed = count * length
+    chars = []
+    while len(chars) < needed:
+        # Read a bit more, than is needed on average, so second read is rare
+        missing = needed - len(chars)
+        data = bytearray(os.urandom(missing * 256 // _BYTE_LIMIT + 16))
+        chars += [KEY_CHARS[b % len(KEY_CHARS)] for b in data if b < _BYTE_LIMIT]
+    key_string = ''.join(chars[:needed])
+    return [key_string[i:i + length] for i in range(0, needed, length)]
+
+
+class KeyPool(object):
+    """Keeps up to `size` pre-generated keys of `length` chars.
+
+       Once started, background thread refills pool, when less than `low_water`
+       keys are left. Without thread pool is refilled by `get` when it's empty.
+       If thread lags behind, `get` generates a key in place (counted in `misses`).
+    """
+
+    def __init__(self, size=1000, length=64, low_water=None):
+        self.size = size
+        self.length = length
+        self.low_water = size // 2 if low_water is None else low_water
+        self.keys = collections.deque()
+        self.misses = 0
+        self._refill_lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._stopped = False
+        self._refiller = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def refill(self):
+        """Generate keys, that are missing from the pool."""
+        with self._refill_lock:
+            missing = self.size - len(self.keys)
+            if missing > 0:
+                self.keys.extend(keygen_bulk(missing, self.length))
+
+    def get(self):
+        """Return key, that was never returned before."""
+        if self._refiller is None and not self.keys:
+            self.refill()
+        try:
+            key = self.keys.popleft()
+        except IndexError:
+            self.misses += 1
+            key = keygen(self.length)
+        if self._refiller is not None and len(self.keys) < self.low_water:
+            self._wanted.set()
+        return key
+
+    def start(self):
+        """Fill pool in background thread."""
+        if self._refiller is not None:
+            return
+        self._refiller = threading.Thread(target=self._refill_when_wanted, name='habibi-key-pool')
+        self._refiller.daemon = True
+        self._wanted.set()
+        self._refiller.start()
+
+    def stop(self):
+        if self._refiller is None:
+            return
+        self._stopped = True
+        self._wanted.set()
+        self._refiller.join()
+        self._refiller = None
 
-    return ''.join([random.choice(avail_chars) for _ in range(length)])
+    def _refill_when_wanted(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            if self._stopped:
+                return
+            try:
+                self.refill()
+            except:
+                LOG.exception('Key pool refill failed')
@@ -0,0 +1,74 @@
+"""
+    habibi.utils.jsonstream
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    JSON encoder, that produces text chunk by chunk. Iterators in encoded object
+    (e.g. generators, that build items of long lists) are encoded as JSON arrays
+    and consumed while encoding, so whole object never has to be in memory.
+"""
+import json
+import collections
+
+import six
+
+
+def is_lazy(obj):
+    """True if `obj` is an iterator, or contains one in its dicts and lists."""
+    if isinstance(obj, collections.Iterator):
+        return True
+    if isinstance(obj, dict):
+        return any(is_lazy(value) for value in six.itervalues(obj))
+    if isinstance(obj, (list, tuple)):
+        return any(is_lazy(value) for value in obj)
+    return False
+
+
+def iterencode(obj, cls=None):
+    """Yield JSON text of `obj` in chunks.
+
+       Parts of `obj` without iterators are encoded whole, by `cls` encoder
+       (`json.JSONEncoder` by default), every item of an iterator - separately.
+    """
+    encoder = (cls or json.JSONEncoder)()
+    return _iterencode(obj, encoder)
+
+
+def _encode_key(key, encoder):
+    """Return JSON string of dict key, converted by `encoder` the same way, as in whole dicts
+       (e.g. 1 -> "1"), None for keys, that encoder skips. Keys of other types raise TypeError.
+    """
+    if isinstance(key, six.string_types):
+        return encoder.encode(key)
+    # '{"1": null}' -> '"1"'
+    encoded = encoder.encode({key: None})
+    if encoded == '{}':
+        return None
+    return encoded[1:-len(encoder.key_separator + 'null}')]
+
+
+def _iterencode(obj, encoder):
+    if not is_lazy(obj):
+        yield encoder.encode(obj)
+    elif isinstance(obj, dict):
+        yield '{'
+        items = six.iteritems(obj)
+        if encoder.sort_keys:
+            items = sorted(items, key=lambda item: item[0])
+        first = True
+        for key, value in items:
+            key = _encode_key(key, encoder)
+            if key is None:
+                continue
+            yield '{}{}{}'.format(not first and encoder.item_separator or '', key, encoder.key_separator)
+            first = False
+            for chunk in _iterencode(value, encoder):
+                yield chunk
+        yield '}'
+    else:
+        yield '['
+        for i, item in enumerate(obj):
+            if i:
+                yield encoder.item_separator
+            for chunk in _iterencode(item, encoder):
+                yield chunk
+        yield ']'
@@ -0,0 +1,17 @@
+import importlib
+
+
+class LazyModule(object):
+    """Stands for module, that is imported on first attribute access.
+       Keeps imports of heavy dependencies out of habibi import time.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, item):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return getattr(module, item)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    habibi.writebehind
+    ~~~~~~~~~~~~~~~~~~
+
+    In-memory queue, that defers writes and flushes them in batches.
+"""
+import time
+import atexit
+import logging
+import threading
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    """Collects items and passes them to `flush_fn` in batches.
+
+       Queue is flushed when it holds `batch_size` items, when the oldest item
+       waits longer than `flush_interval` seconds (checked on every `put`,
+       and by background thread, if started), when `flush` is called explicitly,
+       and on `stop` (registered to run at interpreter exit by `start`).
+
+       If `flush_fn` fails, items stay queued and are passed to it again on the next flush.
+       After `max_retries` failed retries in a row items are moved to `dead_letters`,
+       so writes, that can never succeed, don't block the queue forever.
+       Failures are counted in `failures`, the last one is kept in `last_error`.
+
+       :param flush_fn: callable, that accepts list of items. If it saves part of them
+           and then fails, it should remove saved items from the list, so they are not saved twice.
+    """
+
+    def __init__(self, flush_fn, batch_size=100, flush_interval=None, max_retries=3):
+        self.flush_fn = flush_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.pending = list()
+        self.oldest_at = None
+        self.lock = threading.RLock()
+        self.failures = 0
+        self.last_error = None
+        # Items, that were given up after `max_retries` failed retries
+        self.dead_letters = list()
+        self._retries = 0
+        self._flusher = None
+        self._started = False
+        self._stopped = threading.Event()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def put(self, item):
+        with self.lock:
+            if not self.pending:
+                self.oldest_at = time.time()
+            self.pending.append(item)
+            if len(self.pending) >= self.batch_size or self._expired():
+                # Item is queued either way: failure is not caller's, it's retried by the next flush
+                self._try_flush()
+
+    def _expired(self):
+        return (self.flush_interval is not None and self.pending and
+                time.time() - self.oldest_at >= self.flush_interval)
+
+    def flush(self):
+        """Pass all pending items to `flush_fn`.
+           If `flush_fn` fails, exception is reraised, items are put back to the queue,
+           or moved to `dead_letters`, if they failed `max_retries` retries.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            items, self.pending = self.pending, list()
+            oldest_at, self.oldest_at = self.oldest_at, None
+            try:
+                self.flush_fn(items)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = e
+                if items and self._retries >= self.max_retries:
+                    LOG.error('Write-behind flush failed %s times in a row, %s items are dropped: %s',
+                              self._retries + 1, len(items), e)
+                    self.dead_letters.extend(items)
+                    self._retries = 0
+                elif items:
+                    self._retries += 1
+                    self.pending[:0] = items
+                    self.oldest_at = oldest_at
+                raise
+            self._retries = 0
+
+    def _try_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception('Write-behind flush failed, %s items stay queued', len(self.pending))
+
+    def start(self, background=True):
+        """Register `stop` to run at interpreter exit, so queued items are not lost,
+           and start background thread, that flushes expired items, if `flush_interval` is set.
+
+           Thread must be able to reach the same storage as the caller:
+           e.g. peewee keeps connection per thread, so in-memory sqlite database
+           is not visible from the background thread. Pass `background=False` then.
+        """
+        with self.lock:
+            if self._started:
+                return
+            self._started = True
+        atexit.register(self.stop)
+        if background and self.flush_interval is not None:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='habibi-write-behind')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def stop(self):
+        """Stop background thread and flush the queue."""
+        if not self._stopped.is_set():
+            self._stopped.set()
+            if self._flusher is not None:
+                self._flusher.join()
+                self._flusher = None
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            with self.lock:
+                if self._expired():
+                    self._try_flush()
@@ -2,9 +2,20 @@ import os
 import tempfile
 import shutil
 
+import habibi.api as habibi_api
+
 def before_all(ctx):
     ctx.base_dir = tempfile.mkdtemp()
 
+def after_scenario(ctx, scenario):
+    service = getattr(ctx, 'service', None)
+    if service is not None:
+        service.stop()
+        ctx.service = None
+    api = getattr(ctx, 'api', None)
+    if isinstance(api, habibi_api.HabibiApi):
+        api.close()
+
 def after_all(ctx):
     if os.path.isdir(ctx.base_dir):
         shutil.rmtree(ctx.base_dir)
\ No newline at end of file
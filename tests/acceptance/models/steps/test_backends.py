@@ -1,17 +1,773 @@
 __author__ = 'spike'
 
+import os
+import re
+import sys
 import json
+import time
 import random
+import socket
+import collections
+import threading
+import sqlite3
+import subprocess
 
 import behave
+import requests
 
 import habibi.api as habibi_api
+import habibi.db as habibi_db
+import habibi.dockerpool as habibi_dockerpool
+import habibi.events as habibi_events
+import habibi.exc as habibi_exc
+import habibi.loadgen as habibi_loadgen
+import habibi.metrics as habibi_metrics
+import habibi.querylog as habibi_querylog
+import habibi.service as habibi_service
+import habibi.testing as habibi_testing
+import habibi.tracing as habibi_tracing
+import habibi.writebehind as habibi_writebehind
+from habibi.utils import jsonstream
 
 
 @behave.given('I created habibi api object')
 def i_created_api(ctx):
     ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///:memory:")
 
+@behave.given('I created habibi api object with state engine')
+def i_created_api_with_state(ctx):
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, state_engine=True,
+                                   db_url="sqlite:///{}/state.db".format(ctx.base_dir))
+
+@behave.given('I created sharded habibi api object')
+def i_created_sharded_api(ctx):
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, sharded=True,
+                                   db_url="sqlite:///{}/catalog.db".format(ctx.base_dir))
+
+@behave.given('I created habibi api object with GV cache')
+def i_created_api_with_gv_cache(ctx):
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///:memory:", gv_cache_size=100,
+                                   docker_client=habibi_testing.FakeDockerClient())
+
+@behave.given("I created habibi api object with docker hosts '{docker_url}'")
+def i_created_api_with_docker_hosts(ctx, docker_url):
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///:memory:", docker_url=docker_url)
+
+@behave.given('I created habibi api object with tracing')
+def i_created_api_with_tracing(ctx):
+    ctx.traces = habibi_tracing.ListExporter()
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///:memory:",
+                                   tracing=habibi_tracing.Tracer(exporters=[ctx.traces]))
+
+@behave.given("I created habibi api object with state engine and database file '{name}'")
+def i_created_api_with_state_and_db_file(ctx, name):
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, state_engine=True,
+                                   db_url="sqlite:///{}".format(os.path.join(ctx.base_dir, name)))
+
+@behave.when("other habibi api object connected to database file '{name}'")
+def other_api_connected(ctx, name):
+    ctx.other_api = habibi_api.HabibiApi(base_dir=ctx.base_dir,
+                                         db_url="sqlite:///{}".format(os.path.join(ctx.base_dir, name)))
+    ctx.other_api.database
+
+@behave.when('I closed habibi api object')
+def close_api(ctx):
+    ctx.api.close()
+
+def farm_names_in_db_file(ctx, name):
+    conn = sqlite3.connect(os.path.join(ctx.base_dir, name))
+    try:
+        return [row[0] for row in conn.execute('SELECT name FROM habibi_farms ORDER BY id')]
+    finally:
+        conn.close()
+
+@behave.then("database file '{name}' keeps farms '{farm_names}'")
+def db_file_keeps_farms(ctx, name, farm_names):
+    assert farm_names.split(',') == farm_names_in_db_file(ctx, name)
+
+@behave.then("database file '{name}' keeps no farms")
+def db_file_keeps_no_farms(ctx, name):
+    assert [] == farm_names_in_db_file(ctx, name)
+
+@behave.given('I created write-behind queue, that fails to save items, with {retries:d} retries')
+def i_created_failing_queue(ctx, retries):
+    ctx.saved_items = []
+    ctx.queue_fails = True
+
+    def save(items):
+        if ctx.queue_fails:
+            raise IOError('Disk is full')
+        ctx.saved_items.extend(items)
+    ctx.queue = habibi_writebehind.WriteBehindQueue(save, batch_size=100, max_retries=retries)
+
+@behave.when("I queued items '{items}' and flushed them {times:d} times")
+def queue_and_flush(ctx, items, times):
+    for item in items.split(','):
+        ctx.queue.put(item)
+    for _ in range(times):
+        try:
+            ctx.queue.flush()
+        except IOError:
+            pass
+
+@behave.when('write-behind queue saves items again')
+def queue_saves_again(ctx):
+    ctx.queue_fails = False
+
+@behave.then("write-behind queue keeps items '{items}'")
+def queue_keeps(ctx, items):
+    assert items.split(',') == ctx.queue.pending
+
+@behave.then("write-behind queue dropped items '{items}' after {failures:d} failures")
+def queue_dropped(ctx, items, failures):
+    assert items.split(',') == ctx.queue.dead_letters
+    assert failures == ctx.queue.failures
+
+@behave.then("write-behind queue saved items '{items}'")
+def queue_saved(ctx, items):
+    ctx.queue.stop()
+    assert items.split(',') == ctx.saved_items
+    assert [] == ctx.queue.pending
+
+@behave.given("I created habibi api object with database file '{name}'")
+@behave.when("I created habibi api object with database file '{name}'")
+def i_created_api_with_db_file(ctx, name):
+    ctx.db_url = "sqlite:///{}".format(os.path.join(ctx.base_dir, name))
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url=ctx.db_url)
+
+@behave.given("I created habibi api object with database file '{name}' and event batches of {batch_size:d}")
+def i_created_api_with_event_batches(ctx, name, batch_size):
+    ctx.db_url = "sqlite:///{}".format(os.path.join(ctx.base_dir, name))
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url=ctx.db_url, event_batch_size=batch_size)
+
+@behave.when("I queued event '{name}' of that server")
+def queue_event(ctx, name):
+    ctx.event = ctx.api.create_event(name, ctx.server['id'])
+
+@behave.then('queued event is the same as saved one')
+def queued_event_saved(ctx):
+    assert ctx.server['id'] == ctx.event['triggering_server']['id']
+    assert ctx.farm_role['id'] == ctx.event['triggering_server']['farm_role']['id']
+    assert ctx.event == ctx.api.get_event(ctx.event['id'])
+
+@behave.then("database file '{name}' keeps {how_much:d} events")
+def db_file_keeps_events(ctx, name, how_much):
+    conn = sqlite3.connect(os.path.join(ctx.base_dir, name))
+    try:
+        assert how_much == conn.execute('SELECT count(*) FROM habibi_events').fetchone()[0]
+    finally:
+        conn.close()
+
+@behave.given("I created habibi api object with database file '{name}' without column '{column}' of {table}")
+def i_created_api_with_old_schema(ctx, name, column, table):
+    # Schema of the previous version: newer column is missing, api adds it to the end of table
+    current_path = os.path.join(ctx.base_dir, 'current-' + name)
+    habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///{}".format(current_path)).database
+    current = sqlite3.connect(current_path)
+    old = sqlite3.connect(os.path.join(ctx.base_dir, name))
+    for sql, in current.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL"):
+        if 'CREATE TABLE "habibi_{}"'.format(table) in sql:
+            sql = re.sub(r'"{}" [^,]+, '.format(column), '', sql)
+        old.execute(sql)
+    old.execute('INSERT INTO habibi_schemaversions (version) VALUES (?)', (habibi_db.SCHEMA_VERSION - 1,))
+    old.commit()
+    old.close()
+    current.close()
+    i_created_api_with_db_file(ctx, name)
+
+@behave.then('that server is the same as before')
+def server_not_changed(ctx):
+    assert ctx.server['crypto_key']
+    assert json.dumps(ctx.server, sort_keys=True) == json.dumps(ctx.api.get_server(ctx.server['id']), sort_keys=True)
+
+@behave.given("I created habibi api object with metrics and database file '{name}'")
+def i_created_api_with_metrics_and_db_file(ctx, name):
+    ctx.db_url = "sqlite:///{}".format(os.path.join(ctx.base_dir, name))
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url=ctx.db_url, metrics=True)
+
+@behave.when('{how_much:d} threads created farms at once')
+def create_farms_concurrently(ctx, how_much):
+    errors = []
+
+    def create_farm(index):
+        try:
+            ctx.api.create_farm('concurrent-farm-{}'.format(index))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=create_farm, args=(i,)) for i in range(how_much)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+@behave.then('{how_much:d} farms exist')
+def farms_exist(ctx, how_much):
+    assert how_much == len(ctx.api.find_farms())
+
+@behave.then('SQL statements are recorded once')
+def sql_recorded_once(ctx):
+    assert 1 == habibi_db.SQL_LISTENERS.count(ctx.api.metrics.sql_listener)
+    inserts = ctx.api.metrics.snapshot()['sql']['INSERT habibi_farms']
+    assert len(ctx.api.find_farms()) == inserts['count']
+
+@behave.given("I started api service with database file '{name}'")
+def i_started_api_service(ctx, name):
+    # Free port for the only worker
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    ctx.service = habibi_service.ServicePool(workers=1, port=port, base_dir=ctx.base_dir,
+                                             db_url="sqlite:///{}".format(os.path.join(ctx.base_dir, name)))
+    ctx.service.start()
+    ctx.api = habibi_service.HabibiClient(ctx.service.urls)
+
+@behave.then("api service refuses option '{option}' of {value}")
+def service_refuses_option(ctx, option, value):
+    options = {option: json.loads(value.lower())}
+    try:
+        habibi_service.ServicePool(workers=1, base_dir=ctx.base_dir,
+                                   db_url="sqlite:///{}/refused.db".format(ctx.base_dir), **options)
+    except habibi_exc.HabibiApiException as e:
+        assert 'workers' in str(e)
+    else:
+        raise AssertionError('Api service accepted {}={}'.format(option, value))
+
+@behave.when('I created {how_much:d} events of that server')
+def create_events(ctx, how_much):
+    for _ in range(how_much):
+        ctx.api.create_event('ServiceEvent', ctx.server['id'])
+
+@behave.when('{how_much:d} threads read events of that server at once')
+def read_events_concurrently(ctx, how_much):
+    ctx.results = []
+    errors = []
+
+    def read_events():
+        try:
+            ctx.results.append(ctx.api.find_events(triggering_server=ctx.server['id']))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read_events) for _ in range(how_much)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+    assert how_much == len(ctx.results)
+
+@behave.then('every thread received {how_much:d} events')
+def threads_received_events(ctx, how_much):
+    for events in ctx.results:
+        assert how_much == len(events)
+        assert all(event['created_at'] for event in events)
+
+def nested_data(lazy):
+    """Dicts with keys of all types, JSON accepts, lists are generators if `lazy`."""
+    listed = lazy and iter or list
+    return {3: listed([{2.5: 'float', None: listed([1, 2])}]),
+            True: 'bool',
+            'name': listed([{7: listed('ab')}, {}]),
+            u'unicode': dict(nested={False: listed([])})}
+
+@behave.when('I streamed nested dicts with non-string keys and generators')
+def stream_nested_dicts(ctx):
+    ctx.streamed = ''.join(jsonstream.iterencode(nested_data(lazy=True)))
+
+@behave.then('streamed JSON is the same as json.dumps of the same data')
+def streamed_json_matches(ctx):
+    assert json.dumps(nested_data(lazy=False)) == ctx.streamed
+
+@behave.then('streaming dict with tuple key fails')
+def streaming_tuple_key_fails(ctx):
+    try:
+        ''.join(jsonstream.iterencode({(1, 2): iter([1])}))
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('Tuple key was encoded')
+
+@behave.given('I created event manager')
+def i_created_event_mgr(ctx):
+    ctx.event_mgr = habibi_events.EventMgr()
+    ctx.notified_since = time.time()
+
+@behave.given('I created event manager with history of {how_much:d} events')
+def i_created_event_mgr_with_history(ctx, how_much):
+    i_created_event_mgr(ctx)
+    ctx.event_mgr.history_size = how_much
+
+@behave.when("server '{server_id}' notified event '{event}'")
+def notify_event(ctx, server_id, event):
+    ctx.event_mgr.notify(habibi_events.Event(event=event, server_id=server_id))
+
+@behave.when("I added listener of event '{event}'")
+def add_event_listener(ctx, event):
+    ctx.listened = []
+    ctx.listener = (habibi_events.Event(event=event), ctx.listened.append)
+    ctx.event_mgr.add_listener(*ctx.listener)
+
+@behave.when('I removed that listener')
+def remove_event_listener(ctx):
+    ctx.event_mgr.remove_listener(*ctx.listener)
+
+@behave.then("listener got events of servers '{server_ids}'")
+def listener_got_events(ctx, server_ids):
+    assert server_ids.split(',') == [event.server_id for event in ctx.listened]
+    assert ctx.listener[0] not in ctx.event_mgr.events
+
+@behave.then("waiting for event '{event}' since before notification returns server '{server_id}'")
+def wait_for_past_event(ctx, event, server_id):
+    found = ctx.event_mgr.wait(habibi_events.Event(event=event), timeout=0.01, since=ctx.notified_since,
+                               fn=lambda happened: happened.server_id)
+    assert server_id == found
+
+@behave.then("waiting for event '{event}' since {when} times out")
+def wait_for_event_times_out(ctx, event, when):
+    if when == 'now':
+        # Later than any notification, even on coarse clock
+        time.sleep(0.01)
+        since = time.time()
+    else:
+        since = ctx.notified_since
+    try:
+        ctx.event_mgr.wait(habibi_events.Event(event=event), timeout=0.01, since=since)
+    except Exception as e:
+        assert 'Timeout' in str(e)
+    else:
+        raise AssertionError('Event {} was found'.format(event))
+
+@behave.given("I created habibi api object with fake docker in directory '{name}'")
+def i_created_api_in_dir(ctx, name):
+    ctx.docker = habibi_testing.FakeDockerClient()
+    ctx.api = habibi_api.HabibiApi(base_dir=os.path.join(ctx.base_dir, name), db_url="sqlite:///:memory:",
+                                   docker_client=ctx.docker)
+
+@behave.given("I created habibi api object with fake docker in directory '{name}' "
+              "and retention period of {seconds:d} seconds")
+def i_created_api_with_retention(ctx, name, seconds):
+    ctx.docker = habibi_testing.FakeDockerClient()
+    ctx.api = habibi_api.HabibiApi(base_dir=os.path.join(ctx.base_dir, name), db_url="sqlite:///:memory:",
+                                   docker_client=ctx.docker, retention_period=seconds)
+
+@behave.when('I terminated that server')
+def terminate_server(ctx):
+    ctx.api.terminate_server(ctx.server['id'])
+
+@behave.when('I archived entities older than {seconds:f} seconds')
+def archive_entities(ctx, seconds):
+    time.sleep(seconds * 2)
+    ctx.archived = ctx.api.archive_old_entities(retention_period=seconds)
+
+@behave.then('{events:d} events and {servers:d} servers were archived')
+def entities_archived(ctx, events, servers):
+    assert dict(events=events, servers=servers) == ctx.archived
+
+@behave.then('hot database keeps no events and servers')
+def hot_db_empty(ctx):
+    assert 0 == habibi_db.Event.select().count()
+    assert 0 == habibi_db.Server.select().count()
+
+@behave.then("that server is '{status}'")
+def server_status(ctx, status):
+    server = ctx.api.get_server(ctx.server['id'])
+    assert status == server['status']
+    assert ctx.farm_role['id'] == server['farm_role']['id']
+    assert [server] == ctx.api.find_servers(status=status, farm_role=ctx.farm_role['id'])
+
+@behave.given("I created habibi api object with metrics exported to '{name}'")
+def i_created_api_with_metrics_exporter(ctx, name):
+    ctx.metrics_path = os.path.join(ctx.base_dir, name)
+    metrics = habibi_metrics.Metrics(exporters=[habibi_metrics.PrometheusExporter(ctx.metrics_path)])
+    ctx.api = habibi_api.HabibiApi(base_dir=ctx.base_dir, db_url="sqlite:///:memory:", metrics=metrics)
+
+@behave.when('I exported metrics')
+def export_metrics(ctx):
+    ctx.api.metrics.export()
+    with open(ctx.metrics_path) as f:
+        ctx.metrics_lines = f.read().splitlines()
+
+@behave.then('metrics file has lines')
+def metrics_file_has_lines(ctx):
+    for line in ctx.text.splitlines():
+        assert line in ctx.metrics_lines, line
+
+@behave.then('metrics buckets are cumulative')
+def metrics_buckets_cumulative(ctx):
+    counts = collections.OrderedDict()
+    for line in ctx.metrics_lines:
+        if '_bucket{' in line:
+            series, value = line.rsplit(' ', 1)
+            counts.setdefault(series.split(',le=')[0], []).append(int(value))
+    assert counts
+    for series, values in counts.items():
+        assert values == sorted(values), series
+
+@behave.when('I built topology of {farms:d} farms with {farm_roles:d} farm roles of {servers:d} servers')
+def build_topology(ctx, farms, farm_roles, servers):
+    ctx.topology = habibi_testing.build_topology(ctx.api, farms=farms, farm_roles=farm_roles,
+                                                 servers=servers, gvs=0)
+
+@behave.when('I built topology of {farms:d} farms with {farm_roles:d} farm roles of {servers:d} servers '
+             'and {rules:d} rules')
+def build_topology_with_rules(ctx, farms, farm_roles, servers, rules):
+    ctx.topology = habibi_testing.build_topology(ctx.api, farms=farms, farm_roles=farm_roles,
+                                                 servers=servers, gvs=0, rules=rules)
+
+@behave.when('I orchestrated that event')
+def orchestrate_event(ctx):
+    ctx.orchestration = ctx.api.orchestrate_event(ctx.event['id'])
+
+@behave.when('I orchestrated that event compactly')
+def orchestrate_event_compactly(ctx):
+    ctx.compact_orchestration = ctx.api.orchestrate_event(ctx.event['id'], compact=True)
+
+@behave.when('I streamed orchestration of that event')
+def stream_orchestration(ctx):
+    orchestration = ctx.api.orchestrate_event(ctx.event['id'], stream=True)
+    assert jsonstream.is_lazy(orchestration), orchestration
+    ctx.streamed = ''.join(jsonstream.iterencode(orchestration, cls=habibi_service.ApiJSONEncoder))
+
+def normalized_orchestration(orchestration):
+    """Orchestration with servers and their GVs in the same order."""
+    mapping = [dict(entry, global_variables=sorted(entry['global_variables'], key=lambda gv: gv['name']))
+               for entry in orchestration['server_to_rules_mapping']]
+    return dict(orchestration, server_to_rules_mapping=sorted(mapping, key=lambda entry: entry['server_id']))
+
+@behave.then("compact orchestration returns GV '{name}' once")
+def compact_orchestration_shares_gv(ctx, name):
+    shared = [gv['name'] for gv in ctx.compact_orchestration['shared_global_variables']]
+    assert name in shared, shared
+    for entry in ctx.compact_orchestration['server_to_rules_mapping']:
+        assert name not in [gv['name'] for gv in entry['global_variables']], entry
+
+@behave.then('expanded compact orchestration is the same as full one')
+def expanded_orchestration_matches(ctx):
+    expanded = habibi_api.expand_orchestration(ctx.compact_orchestration)
+    assert normalized_orchestration(ctx.orchestration) == normalized_orchestration(expanded)
+
+@behave.then('streamed orchestration is the same as full one')
+def streamed_orchestration_matches(ctx):
+    full = json.loads(json.dumps(ctx.orchestration, cls=habibi_service.ApiJSONEncoder))
+    assert normalized_orchestration(full) == normalized_orchestration(json.loads(ctx.streamed))
+
+def servers_of_rule(ctx, script):
+    indexes = [i for i, rule in enumerate(ctx.orchestration['rules']) if script == rule['script']]
+    assert 1 == len(indexes), ctx.orchestration['rules']
+    return [item['server_id'] for item in ctx.orchestration['server_to_rules_mapping']
+            if indexes[0] in item['rule_indexes']]
+
+@behave.then("rule '{script}' targets {how_much:d} servers")
+def rule_targets(ctx, script, how_much):
+    assert how_much == len(servers_of_rule(ctx, script))
+
+@behave.then("rule '{script}' targets {how_much:d} servers with behavior '{behavior}'")
+def rule_targets_behavior(ctx, script, how_much, behavior):
+    server_ids = servers_of_rule(ctx, script)
+    assert how_much == len(server_ids)
+    for server_id in server_ids:
+        server = ctx.api.get_server(server_id)
+        assert behavior in server['farm_role']['role']['behaviors'], server
+
+@behave.when('I started servers of that topology')
+def start_topology_servers(ctx):
+    for server in ctx.topology['servers']:
+        ctx.api.run_server(server['id'], cmd=['true'])
+    assert len(ctx.topology['servers']) == len(ctx.docker.containers())
+
+@behave.when('I terminated the first farm')
+def terminate_first_farm(ctx):
+    ctx.api.farm_terminate(ctx.topology['farms'][0]['id'])
+
+@behave.then("the first farm is '{status}'")
+def first_farm_status(ctx, status):
+    assert status == ctx.api.get_farm(ctx.topology['farms'][0]['id'])['status']
+
+@behave.then("all {how_much:d} servers of that topology are '{status}'")
+def topology_servers_status(ctx, how_much, status):
+    servers = ctx.api.find_servers(*[server['id'] for server in ctx.topology['servers']])
+    assert [status] * how_much == [server['status'] for server in servers]
+
+@behave.then('fake docker runs no containers')
+def fake_docker_empty(ctx):
+    assert [] == ctx.docker.containers(all=True)
+
+@behave.when('I generated load of that topology with {concurrency:d} agents for {duration:f} seconds')
+def generate_load(ctx, concurrency, duration):
+    generator = habibi_loadgen.LoadGenerator(ctx.api, [s['id'] for s in ctx.topology['servers']])
+    ctx.load = generator.run(concurrency, duration)
+
+@behave.then('load steps were done without errors')
+def load_without_errors(ctx):
+    assert 0 == ctx.load.errors
+    assert ctx.load.steps > 0
+    assert ctx.load.throughput > 0
+
+@behave.then('every load step created one event')
+def load_events_created(ctx):
+    server_ids = [s['id'] for s in ctx.topology['servers']]
+    assert ctx.load.steps == habibi_db.Event.select().where(
+        habibi_db.Event.triggering_server << server_ids).count()
+
+@behave.then('latency percentiles of every load operation are ordered')
+def load_percentiles(ctx):
+    result = ctx.load.to_dict()
+    for op in habibi_loadgen.OPERATIONS:
+        op_stats = result['operations'][op]
+        assert ctx.load.steps == op_stats['count']
+        assert 0 < op_stats['p50'] <= op_stats['p99']
+
+def synthetic_runs(throughputs, concurrencies):
+    runs = []
+    for throughput, concurrency in zip(throughputs.split(','), concurrencies.split(',')):
+        stats = habibi_loadgen.RunStats(int(concurrency))
+        stats.add([('step', 0.001)] * int(throughput))
+        stats.elapsed = 1.0
+        runs.append(stats)
+    return runs
+
+@behave.then('throughput of {throughputs} steps/s with {concurrencies} agents saturates at {concurrency:d} agents')
+def load_saturates(ctx, throughputs, concurrencies, concurrency):
+    assert concurrency == habibi_loadgen.find_saturation(synthetic_runs(throughputs, concurrencies))
+
+@behave.then('throughput of {throughputs} steps/s with {concurrencies} agents does not saturate')
+def load_not_saturated(ctx, throughputs, concurrencies):
+    assert habibi_loadgen.find_saturation(synthetic_runs(throughputs, concurrencies)) is None
+
+class BreakingDockerClient(object):
+    """Client of fake docker daemon, which next `failures` calls raise connection error."""
+
+    def __init__(self, url, timeout=None):
+        self.daemon = habibi_testing.FakeDockerClient.daemon(url)
+        self.failures = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def __getattr__(self, item):
+        method = getattr(self.daemon, item)
+
+        def call(*args, **kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise requests.exceptions.ConnectionError('Connection reset by peer')
+            return method(*args, **kwargs)
+        return call
+
+def breaking_client_factory(ctx):
+    ctx.docker_clients = []
+
+    def factory(url, timeout):
+        ctx.docker_clients.append(BreakingDockerClient(url, timeout))
+        return ctx.docker_clients[-1]
+    return factory
+
+@behave.given("I created docker pool of '{urls}' with breaking connections")
+def i_created_docker_pool(ctx, urls):
+    ctx.docker_pool = habibi_dockerpool.DockerPool(urls, connections=1, backoff=0,
+                                                   client_factory=breaking_client_factory(ctx))
+
+@behave.when('I created container through docker pool')
+def create_pooled_container(ctx):
+    ctx.container_id = ctx.docker_pool.create_container('ubuntu:14.04', command=['true'])['Id']
+    ctx.docker_pool.start(ctx.container_id)
+
+@behave.when('docker connection broke')
+def break_docker_connection(ctx):
+    assert 1 == len(ctx.docker_clients)
+    ctx.docker_clients[0].failures = 1
+
+@behave.then('I inspected that container through docker pool')
+def inspect_pooled_container(ctx):
+    assert ctx.container_id == ctx.docker_pool.inspect_container(ctx.container_id)['Id']
+
+@behave.then('broken docker connection was closed and replaced')
+def docker_connection_replaced(ctx):
+    assert 2 == len(ctx.docker_clients)
+    assert ctx.docker_clients[0].closed
+    assert not ctx.docker_clients[1].closed
+
+@behave.then('killing that container through docker pool fails with connection error')
+def kill_pooled_container_fails(ctx):
+    try:
+        ctx.docker_pool.kill(ctx.container_id)
+    except requests.exceptions.ConnectionError:
+        assert 0 == ctx.docker_clients[0].failures
+    else:
+        raise AssertionError('Kill was retried')
+
+@behave.then('that container is still running')
+def pooled_container_running(ctx):
+    daemon = habibi_testing.FakeDockerClient.daemon(ctx.docker_pool.urls[0])
+    assert daemon.inspect_container(ctx.container_id)['State']['Running']
+
+@behave.when('I created {how_much:d} containers through docker pool')
+def create_pooled_containers(ctx, how_much):
+    ctx.container_ids = [ctx.docker_pool.create_container('ubuntu:14.04', command=['true'])['Id']
+                         for _ in range(how_much)]
+
+@behave.then('every docker daemon of the pool runs {how_much:d} containers')
+def containers_per_pooled_daemon(ctx, how_much):
+    for url in ctx.docker_pool.urls:
+        assert how_much == len(habibi_testing.FakeDockerClient.daemon(url).containers(all=True))
+
+@behave.then('new docker pool finds daemon of every container')
+def new_pool_finds_daemons(ctx):
+    pool = habibi_dockerpool.DockerPool(ctx.docker_pool.urls, backoff=0)
+    for container_id in ctx.container_ids:
+        url = pool.host_of(container_id)
+        assert container_id in [c['Id'] for c in habibi_testing.FakeDockerClient.daemon(url).containers(all=True)]
+    assert pool.host_of('unknown') is None
+
+@behave.then('I removed every container through docker pool')
+def remove_pooled_containers(ctx):
+    for container_id in ctx.container_ids:
+        ctx.docker_pool.remove_container(container_id)
+    assert [] == ctx.docker_pool.containers(all=True)
+
+@behave.when("I saved JSON snapshot '{name}'")
+def save_json_snapshot(ctx, name):
+    # Format of non-sqlite databases
+    with habibi_db.using(ctx.api.database):
+        habibi_db._save_json_snapshot(os.path.join(ctx.base_dir, name))
+
+@behave.when("I restored JSON snapshot '{name}'")
+def restore_json_snapshot(ctx, name):
+    habibi_db._restore_json_snapshot(ctx.api.database, os.path.join(ctx.base_dir, name))
+
+@behave.then("farms '{names}' have ids {ids}")
+def farms_have_ids(ctx, names, ids):
+    farms = ctx.api.find_farms()
+    assert names.split(',') == [farm['name'] for farm in farms]
+    assert [int(i) for i in ids.split(',')] == [farm['id'] for farm in farms]
+
+@behave.when("I created event '{name}' of the first server")
+def create_event_of_first_server(ctx, name):
+    ctx.event = ctx.api.create_event(name, ctx.topology['servers'][0]['id'])
+
+@behave.when('I recorded queries of orchestration of that event')
+def record_orchestration_queries(ctx):
+    with habibi_querylog.QueryRecorder() as ctx.queries:
+        ctx.api.orchestrate_event(ctx.event['id'])
+
+def n_plus_one_of_table(ctx, table):
+    found = [pattern for pattern in ctx.queries.n_plus_one()
+             if 'FROM "{}"'.format(table) in pattern['shape']]
+    assert 1 == len(found), ctx.queries.report()
+    return found[0]
+
+@behave.then("query of '{table}' was repeated {times:d} times in '{function}'")
+def query_repeated_times(ctx, table, times, function):
+    pattern = n_plus_one_of_table(ctx, table)
+    assert times == pattern['count']
+    assert any(site.startswith('habibi/api.py:') and site.endswith(' ' + function)
+               for site in pattern['call_sites']), pattern
+
+@behave.then("query of '{table}' was repeated from '{attribute}' in '{function}'")
+def query_repeated_from(ctx, table, attribute, function):
+    pattern = n_plus_one_of_table(ctx, table)
+    assert [attribute] == pattern['attributes']
+    assert any(site.endswith(' ' + function) for site in pattern['call_sites']), pattern
+
+@behave.then('orchestration of that event exceeds query budget of {max_queries:d}')
+def query_budget_exceeded(ctx, max_queries):
+    try:
+        with habibi_querylog.query_budget(max_queries):
+            ctx.api.orchestrate_event(ctx.event['id'])
+    except habibi_exc.HabibiQueryBudgetExceeded as e:
+        assert 'N+1' in str(e)
+    else:
+        raise AssertionError('Query budget was not exceeded')
+
+@behave.when('process with event batches of {batch_size:d} created {how_much:d} events of that server and exited')
+def create_events_in_process(ctx, batch_size, how_much):
+    script = ('import habibi.api as habibi_api\n'
+              'api = habibi_api.HabibiApi(base_dir={!r}, db_url={!r}, event_batch_size={})\n'
+              'for _ in range({}):\n'
+              '    api.create_event("BatchEvent", {!r})\n').format(
+                  ctx.base_dir, ctx.db_url, batch_size, how_much, ctx.server['id'])
+    subprocess.check_call([sys.executable, '-c', script])
+
+@behave.then('that server has {how_much:d} events')
+def server_has_events(ctx, how_much):
+    assert how_much == len(ctx.api.find_events(triggering_server=ctx.server['id']))
+
+@behave.when('I created server of that farm_role')
+def create_server(ctx):
+    ctx.server = ctx.api.create_server(ctx.farm_role['id'])
+
+@behave.then('server is stored in database of my farm')
+def server_in_farm_shard(ctx):
+    assert os.path.exists(os.path.join(ctx.base_dir, 'shards', 'farm-{}.db'.format(ctx.farm['id'])))
+    assert ctx.server['id'] == ctx.api.get_server(ctx.server['id'])['id']
+    assert ctx.farm['id'] == ctx.api.get_server(ctx.server['id'])['farm_role']['farm']['id']
+
+@behave.when('I calculated GVs of that server {times:d} times')
+def calculate_gvs(ctx, times):
+    for _ in range(times):
+        gvs = ctx.api.calculate_global_variables('server', [ctx.server['id']])
+        assert ctx.farm_role['id'] == gvs[ctx.server['id']]['SCALR_FARM_ROLE_ID']
+
+@behave.when('I started that server')
+def start_server(ctx):
+    ctx.api.run_server(ctx.server['id'], cmd=['true'])
+
+@behave.when("I set GV '{name}' to '{value}' on that {scope}")
+def set_gv_on_scope(ctx, name, value, scope):
+    ctx.api.set_global_variable(name, value, scope, getattr(ctx, scope)['id'])
+
+@behave.when('I calculated user-defined GVs of that server {times:d} times')
+def calculate_user_defined_gvs(ctx, times):
+    for _ in range(times):
+        ctx.gvs = ctx.api.calculate_global_variables('server', [ctx.server['id']], user_defined=True)
+
+@behave.then('user-defined GVs of that server were calculated {times:d} times')
+def user_defined_gvs_calculated(ctx, times):
+    gvs_calculated(ctx, times)
+
+@behave.then("user-defined GVs of that server are '{expected}'")
+def user_defined_gvs_are(ctx, expected):
+    variables = ctx.gvs[ctx.server['id']]
+    assert ctx.server['id'] == variables['SCALR_SERVER_ID']
+    user_defined = dict((k, v) for k, v in variables.items() if not k.startswith('SCALR_'))
+    assert dict(item.split('=') for item in expected.split(',')) == user_defined, user_defined
+
+@behave.then('GVs of that server were calculated {times:d} times')
+def gvs_calculated(ctx, times):
+    assert times == ctx.api.gv_cache.stats()['misses']
+
+@behave.when('I started {how_much:d} servers of that farm_role')
+def start_servers(ctx, how_much):
+    for _ in range(how_much):
+        server = ctx.api.create_server(ctx.farm_role['id'])
+        ctx.api.run_server(server['id'], cmd=['true'])
+
+@behave.then('every docker host runs {how_much:d} containers')
+def containers_per_host(ctx, how_much):
+    for url in ctx.api.docker_url.split(','):
+        assert how_much == len(habibi_testing.FakeDockerClient.daemon(url).containers())
+
+@behave.then('every server has its own crypto key')
+def servers_have_keys(ctx):
+    keys = [server['crypto_key'] for server in ctx.api.find_servers()]
+    assert all(keys) and len(set(keys)) == len(keys)
+
+@behave.then("trace of '{method}' call contains SQL statements")
+def trace_has_sql(ctx, method):
+    trace = [spans for spans in ctx.traces.traces if spans[-1].name == method][0]
+    root = trace[-1]
+    assert root.kind == 'api' and root.parent_id is None
+    assert any(span.kind == 'sql' and span.parent_id == root.span_id for span in trace)
+
+@behave.when('I restarted habibi api object with state engine')
+def i_restarted_api_with_state(ctx):
+    ctx.api.flush_events()
+    i_created_api_with_state(ctx)
+
 @behave.when("I created new farm named '{farm_name}'")
 def add_farm(ctx, farm_name):
     ctx.farm = new_farm = ctx.api.create_farm(name=farm_name)
@@ -47,6 +803,22 @@ def set_gv(ctx):
         gv = ctx.api.set_global_variable(**kwds)
         ctx.gvs.append(gv)
 
+@behave.when("I saved fixture '{name}'")
+def save_fixture(ctx, name):
+    ctx.api.save_fixture(name)
+
+@behave.when('I created habibi api object')
+def i_created_another_api(ctx):
+    i_created_api(ctx)
+
+@behave.when("I loaded fixture '{name}'")
+def load_fixture(ctx, name):
+    ctx.api.load_fixture(name)
+
+@behave.then("farm named '{farm_name}' exists")
+def farm_exists(ctx, farm_name):
+    assert 1 == len(ctx.api.find_farms(name=farm_name))
+
 @behave.when('I try to find my scalr objects through API')
 def find(ctx):
     ctx.all_entities = dict()
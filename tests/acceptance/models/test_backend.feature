@@ -24,6 +24,348 @@ Feature: Habibi entities saved to persistent DB
         When I try to find my scalr objects through API
         Then I receive exactly what I added before
 
+    Scenario: Restore infrastructure from fixture
+        Given I created habibi api object
+        When I created new farm named 'fixture-farm'
+         And I saved fixture 'one-farm'
+         And I created habibi api object
+         And I loaded fixture 'one-farm'
+        Then farm named 'fixture-farm' exists
+
+    Scenario: Restore fixture of migrated database to new one
+        Given I created habibi api object with database file 'migrated.db' without column 'crypto_key' of servers
+        When I created new farm named 'migrated-farm'
+         And I created new role named 'migrated-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I saved fixture 'migrated'
+         And I created habibi api object with database file 'new.db'
+         And I loaded fixture 'migrated'
+        Then that server is the same as before
+
+    Scenario: Recover in-memory state from DB
+        Given I created habibi api object with state engine
+        When I created new farm named 'state-farm'
+         And I restarted habibi api object with state engine
+        Then farm named 'state-farm' exists
+
+    Scenario: Keep servers of farm in separate database
+        Given I created sharded habibi api object
+        When I created new farm named 'sharded-farm'
+         And I created new role named 'sharded-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+        Then server is stored in database of my farm
+
+    Scenario: Recalculate cached GVs of started server
+        Given I created habibi api object with GV cache
+        When I created new farm named 'gv-farm'
+         And I created new role named 'gv-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I calculated GVs of that server 2 times
+        Then GVs of that server were calculated 1 times
+        When I started that server
+         And I calculated GVs of that server 1 times
+        Then GVs of that server were calculated 2 times
+
+    Scenario: Resolve and cache user-defined GVs of server
+        Given I created habibi api object with GV cache
+        When I created new farm named 'user-gv-farm'
+         And I created new role named 'user-gv-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I set GV 'LEVEL' to 'role' on that role
+         And I set GV 'LEVEL' to 'farm' on that farm
+         And I set GV 'ROLE_ONLY' to 'role' on that role
+         And I set GV 'SCALR_SERVER_ID' to 'redefined' on that server
+         And I calculated user-defined GVs of that server 2 times
+        Then user-defined GVs of that server were calculated 1 times
+         And user-defined GVs of that server are 'LEVEL=farm,ROLE_ONLY=role'
+        When I set GV 'LEVEL' to 'farm role' on that farm_role
+         And I calculated user-defined GVs of that server 1 times
+        Then user-defined GVs of that server were calculated 2 times
+         And user-defined GVs of that server are 'LEVEL=farm role,ROLE_ONLY=role'
+
+    Scenario: Spread containers across docker hosts
+        Given I created habibi api object with docker hosts 'fake://host-1,fake://host-2'
+        When I created new farm named 'docker-farm'
+         And I created new role named 'docker-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I started 4 servers of that farm_role
+        Then every docker host runs 2 containers
+
+    Scenario: Assign crypto keys to new servers
+        Given I created habibi api object
+        When I created new farm named 'key-farm'
+         And I created new role named 'key-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I created server of that farm_role
+        Then every server has its own crypto key
+
+    Scenario: Trace api calls
+        Given I created habibi api object with tracing
+        When I created new farm named 'traced-farm'
+        Then trace of 'create_farm' call contains SQL statements
+
+    Scenario: Save queued events at exit
+        Given I created habibi api object with database file 'events.db'
+        When I created new farm named 'batch-farm'
+         And I created new role named 'batch-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And process with event batches of 100 created 5 events of that server and exited
+        Then that server has 5 events
+
+    Scenario: Return queued event like saved one
+        Given I created habibi api object with database file 'queued-events.db' and event batches of 100
+        When I created new farm named 'queued-farm'
+         And I created new role named 'queued-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I queued event 'HostInit' of that server
+        Then queued event is the same as saved one
+
+    Scenario: Save queued events to database of their api
+        Given I created habibi api object with database file 'own-events.db' and event batches of 100
+        When I created new farm named 'own-events-farm'
+         And I created new role named 'own-events-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I queued event 'HostInit' of that server
+         And other habibi api object connected to database file 'other-events.db'
+         And I closed habibi api object
+        Then database file 'own-events.db' keeps 1 events
+         And database file 'other-events.db' keeps 0 events
+
+    Scenario: Connect once on concurrent first calls
+        Given I created habibi api object with metrics and database file 'concurrent.db'
+        When 8 threads created farms at once
+        Then 8 farms exist
+         And SQL statements are recorded once
+
+    Scenario: Serve concurrent calls by api service
+        Given I started api service with database file 'service.db'
+        When I created new farm named 'service-farm'
+         And I created new role named 'service-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I created 3 events of that server
+         And 8 threads read events of that server at once
+        Then every thread received 3 events
+
+    Scenario: Refuse api options, that keep data in memory of service worker
+        Then api service refuses option 'event_batch_size' of 100
+         And api service refuses option 'state_engine' of True
+         And api service refuses option 'gv_cache_size' of 100
+
+    Scenario: Stream JSON with non-string keys
+        When I streamed nested dicts with non-string keys and generators
+        Then streamed JSON is the same as json.dumps of the same data
+         And streaming dict with tuple key fails
+
+    Scenario: Wait for event, that was notified before
+        Given I created event manager
+        When server 'history-1' notified event 'HistoryHostUp'
+         And server 'history-2' notified event 'HistoryHostInit'
+        Then waiting for event 'HistoryHostUp' since before notification returns server 'history-1'
+         And waiting for event 'HistoryHostUp' since now times out
+
+    Scenario: Forget events beyond history size
+        Given I created event manager with history of 2 events
+        When server 'history-3' notified event 'HistoryRebundle'
+         And server 'history-4' notified event 'HistoryReboot'
+         And server 'history-5' notified event 'HistoryReboot'
+        Then waiting for event 'HistoryRebundle' since before notification times out
+         And waiting for event 'HistoryReboot' since before notification returns server 'history-4'
+
+    Scenario: Remove event listener
+        Given I created event manager
+        When I added listener of event 'ListenedHostUp'
+         And server 'listened-1' notified event 'ListenedHostUp'
+         And I removed that listener
+         And server 'listened-2' notified event 'ListenedHostUp'
+        Then listener got events of servers 'listened-1'
+
+    Scenario: Read archived events and servers
+        Given I created habibi api object with fake docker in directory 'archive-test'
+        When I created new farm named 'archive-farm'
+         And I created new role named 'archive-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I started that server
+         And I created 2 events of that server
+         And I terminated that server
+         And I archived entities older than 0.05 seconds
+        Then 2 events and 1 servers were archived
+         And hot database keeps no events and servers
+         And that server has 2 events
+         And that server is 'terminated'
+
+    Scenario: Archive entities with zero retention period
+        Given I created habibi api object with fake docker in directory 'archive-zero' and retention period of 3600 seconds
+        When I created new farm named 'archive-zero-farm'
+         And I created new role named 'archive-zero-role'
+            """
+            {"image": "ubuntu:14.04", "behaviors": ["base"]}
+            """
+         And I added this role to my farm
+         And I created server of that farm_role
+         And I started that server
+         And I created 1 events of that server
+         And I terminated that server
+         And I archived entities older than 0.0 seconds
+        Then 1 events and 1 servers were archived
+         And hot database keeps no events and servers
+
+    Scenario: Export metrics in Prometheus format
+        Given I created habibi api object with metrics exported to 'metrics.prom'
+        When I created new farm named 'metrics-farm'
+         And I created new farm named 'metrics-farm-2'
+         And I exported metrics
+        Then metrics file has lines
+            """
+            # TYPE habibi_api_seconds histogram
+            habibi_api_seconds_count{name="create_farm"} 2
+            habibi_api_seconds_bucket{name="create_farm",le="+Inf"} 2
+            habibi_api_sql_seconds_count{name="create_farm"} 2
+            habibi_sql_seconds_count{name="INSERT habibi_farms"} 2
+            """
+         And metrics buckets are cumulative
+
+    Scenario: Find N+1 queries of orchestration
+        Given I created habibi api object
+        When I built topology of 1 farms with 3 farm roles of 1 servers
+         And I created event 'HostUp' of the first server
+         And I recorded queries of orchestration of that event
+        Then query of 'habibi_servers' was repeated 3 times in 'orchestrate_event'
+         And query of 'habibi_roles' was repeated from 'FarmRole.role' in 'orchestrate_event'
+         And orchestration of that event exceeds query budget of 5
+
+    Scenario: Orchestrate event of synthetic topology by behavior
+        Given I created habibi api object with fake docker in directory 'behavior'
+        When I built topology of 1 farms with 3 farm roles of 2 servers and 3 rules
+         And I created event 'HostUp' of the first server
+         And I orchestrated that event
+        Then rule 'rule-0' targets 6 servers
+         And rule 'rule-1' targets 1 servers
+         And rule 'rule-2' targets 2 servers with behavior 'app'
+
+    Scenario: Orchestrate event compactly and as stream
+        Given I created habibi api object with fake docker in directory 'compact'
+        When I built topology of 1 farms with 2 farm roles of 2 servers and 3 rules
+         And I created event 'HostUp' of the first server
+         And I orchestrated that event
+         And I orchestrated that event compactly
+         And I streamed orchestration of that event
+        Then compact orchestration returns GV 'SCALR_FARM_ID' once
+         And expanded compact orchestration is the same as full one
+         And streamed orchestration is the same as full one
+
+    Scenario: Terminate synthetic farm
+        Given I created habibi api object with fake docker in directory 'farm-terminate'
+        When I built topology of 1 farms with 2 farm roles of 2 servers
+         And I started servers of that topology
+         And I terminated the first farm
+        Then the first farm is 'terminated'
+         And all 4 servers of that topology are 'terminated'
+         And fake docker runs no containers
+
+    Scenario: Generate load of simulated agents
+        Given I created habibi api object with database file 'loadgen.db'
+        When I built topology of 1 farms with 2 farm roles of 3 servers
+         And I generated load of that topology with 2 agents for 0.3 seconds
+        Then load steps were done without errors
+         And every load step created one event
+         And latency percentiles of every load operation are ordered
+
+    Scenario: Find saturation point of load
+        Then throughput of 10,19,20,21 steps/s with 1,2,4,8 agents saturates at 2 agents
+         And throughput of 10,20,40 steps/s with 1,2,4 agents does not saturate
+
+    Scenario: Retry read-only docker calls after connection error
+        Given I created docker pool of 'fake://failover-read' with breaking connections
+        When I created container through docker pool
+         And docker connection broke
+        Then I inspected that container through docker pool
+         And broken docker connection was closed and replaced
+
+    Scenario: Don't retry docker calls, that change containers
+        Given I created docker pool of 'fake://failover-write' with breaking connections
+        When I created container through docker pool
+         And docker connection broke
+        Then killing that container through docker pool fails with connection error
+         And that container is still running
+
+    Scenario: Route docker calls to daemon of the container
+        Given I created docker pool of 'fake://route-a,fake://route-b' with breaking connections
+        When I created 4 containers through docker pool
+        Then every docker daemon of the pool runs 2 containers
+         And new docker pool finds daemon of every container
+         And I removed every container through docker pool
+
+    Scenario: Save deferred writes of state engine to its own database
+        Given I created habibi api object with state engine and database file 'state-own.db'
+        When I created new farm named 'state-own-farm'
+         And other habibi api object connected to database file 'state-other.db'
+         And I closed habibi api object
+        Then database file 'state-own.db' keeps farms 'state-own-farm'
+         And database file 'state-other.db' keeps no farms
+
+    Scenario: Drop deferred writes, that failed all retries
+        Given I created write-behind queue, that fails to save items, with 2 retries
+        When I queued items 'a,b' and flushed them 2 times
+        Then write-behind queue keeps items 'a,b'
+        When I queued items 'c' and flushed them 1 times
+         And write-behind queue saves items again
+         And I queued items 'd' and flushed them 1 times
+        Then write-behind queue dropped items 'a,b,c' after 3 failures
+         And write-behind queue saved items 'd'
+
+    Scenario: Create entities after restore of JSON snapshot
+        Given I created habibi api object with database file 'json-snapshot.db'
+        When I created new farm named 'json-farm-1'
+         And I created new farm named 'json-farm-2'
+         And I saved JSON snapshot 'farms.json'
+         And I created habibi api object with database file 'json-restored.db'
+         And I restored JSON snapshot 'farms.json'
+         And I created new farm named 'json-farm-3'
+        Then farms 'json-farm-1,json-farm-2,json-farm-3' have ids 1,2,3
+
     Scenario: Remove infrastructure
 
         # When I remove farm_role from my farm
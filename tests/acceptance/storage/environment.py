@@ -0,0 +1,17 @@
+import os
+import tempfile
+import shutil
+
+from habibi import storage
+
+def before_scenario(ctx, scenario):
+    ctx.base_dir = tempfile.mkdtemp()
+    ctx.cgroup_mpoint = storage.cgroup_mpoint
+    ctx.cgroup_v2_device_helper = storage.cgroup_v2_device_helper
+    ctx.path = os.environ['PATH']
+
+def after_scenario(ctx, scenario):
+    storage.cgroup_mpoint = ctx.cgroup_mpoint
+    storage.cgroup_v2_device_helper = ctx.cgroup_v2_device_helper
+    os.environ['PATH'] = ctx.path
+    shutil.rmtree(ctx.base_dir)
@@ -0,0 +1,273 @@
+import os
+import stat
+import shutil
+
+import behave
+
+from habibi import storage
+from habibi.utils import chunked_image
+
+
+class FakeLvm2(object):
+    """Replacement for scalarizr.linux.lvm2, that keeps volume groups and logical volumes in memory."""
+
+    class NotFound(Exception):
+        pass
+
+    def __init__(self, volume_groups=()):
+        self.volume_groups = set(volume_groups)
+        self.logical_volumes = set()
+        self.removed = []
+
+    def vgs(self, name):
+        if name not in self.volume_groups:
+            raise self.NotFound(name)
+        return {name: name}
+
+    def vgremove(self, name):
+        self.vgs(name)
+        self.volume_groups.remove(name)
+        self.removed.append(name)
+
+    def lvremove(self, path):
+        if path not in self.logical_volumes:
+            raise self.NotFound(path)
+        self.logical_volumes.remove(path)
+        self.removed.append(path)
+
+
+FAKE_LOSETUP = """#!/bin/sh
+# Records calls, gives next loop device to '--find --show IMAGE'
+echo "$@" >> '{log}'
+if [ "$1" = --find ]; then
+    echo /dev/loop$(grep -c -- --find '{log}')
+fi
+"""
+
+
+@behave.given('I created lvm backend without volume group')
+def lvm_backend_without_vg(ctx):
+    ctx.lvm2 = FakeLvm2()
+    ctx.backend = storage.LvmBackend(lvm2=ctx.lvm2)
+
+@behave.given('I created lvm backend with volume group')
+def lvm_backend_with_vg(ctx):
+    ctx.lvm2 = FakeLvm2([storage.vg_name])
+    ctx.backend = storage.LvmBackend(lvm2=ctx.lvm2)
+
+@behave.when('I cleaned up the backend')
+def cleanup_backend(ctx):
+    ctx.backend.cleanup()
+
+@behave.when("I destroyed volume '{volume_id}', that was already removed")
+def destroy_removed_volume(ctx, volume_id):
+    ctx.backend.destroy_volume(dict(id=volume_id, host_path='/dev/{}/{}'.format(storage.vg_name, volume_id)))
+
+@behave.then('volume group was removed')
+def vg_removed(ctx):
+    assert [storage.vg_name] == ctx.lvm2.removed
+
+@behave.then('volume group was not removed')
+def vg_not_removed(ctx):
+    assert [] == ctx.lvm2.removed
+
+@behave.given("I created image of chunks '{chunks}' of {size:d}KB")
+def create_image(ctx, chunks, size):
+    ctx.image_path = os.path.join(ctx.base_dir, 'image')
+    ctx.image = ''
+    for kind in chunks.split(','):
+        if kind == 'zero':
+            ctx.image += '\0' * size * 1024
+        elif kind == 'data':
+            ctx.image += os.urandom(size * 1024)
+        elif kind == 'partial':
+            ctx.image += os.urandom(size * 1024 // 3)
+    with open(ctx.image_path, 'wb') as f:
+        f.write(ctx.image)
+
+@behave.when('I compressed the image in chunks of {size:d}KB')
+def compress_image(ctx, size):
+    ctx.snapshot_path = os.path.join(ctx.base_dir, 'snapshot')
+    stats = chunked_image.compress(ctx.image_path, ctx.snapshot_path, chunk_size=size * 1024, workers=2)
+    assert len(ctx.image) == stats['size']
+
+@behave.when('I restored compressed image to zeroed volume')
+def restore_to_zeroed_volume(ctx):
+    ctx.volume_path = os.path.join(ctx.base_dir, 'volume')
+    with open(ctx.volume_path, 'wb') as f:
+        f.truncate(len(ctx.image))
+    chunked_image.decompress(ctx.snapshot_path, ctx.volume_path, workers=2, skip_zero_chunks=True)
+
+@behave.when('I restored compressed image to volume with garbage')
+def restore_to_volume_with_garbage(ctx):
+    ctx.volume_path = os.path.join(ctx.base_dir, 'volume')
+    with open(ctx.volume_path, 'wb') as f:
+        f.write('\xff' * len(ctx.image))
+    chunked_image.decompress(ctx.snapshot_path, ctx.volume_path, workers=2)
+
+@behave.then('volume has the same data as the image')
+def volume_matches_image(ctx):
+    with open(ctx.volume_path, 'rb') as f:
+        assert ctx.image == f.read()
+
+@behave.then('compressed image stores {how_much:d} chunks')
+def stored_chunks(ctx, how_much):
+    with chunked_image.ChunkedImage(ctx.snapshot_path) as image:
+        assert how_much == len([length for _, length in image.index if length])
+        assert len(ctx.image) == image.size
+
+@behave.given("cgroup v{version:d} host runs container '{instance_id}'")
+def cgroup_host(ctx, version, instance_id):
+    storage.cgroup_mpoint = os.path.join(ctx.base_dir, 'cgroup')
+    if 2 == version:
+        ctx.cgroup_dir = os.path.join(storage.cgroup_mpoint, 'lxc', instance_id)
+        os.makedirs(ctx.cgroup_dir)
+        open(os.path.join(storage.cgroup_mpoint, 'cgroup.controllers'), 'w').close()
+    else:
+        ctx.cgroup_dir = os.path.join(storage.cgroup_mpoint, 'devices', 'lxc', instance_id + '-container')
+        os.makedirs(ctx.cgroup_dir)
+
+@behave.given("cgroup v2 device helper is '{helper}'")
+@behave.when("cgroup v2 device helper is '{helper}'")
+def set_device_helper(ctx, helper):
+    storage.cgroup_v2_device_helper = helper
+
+@behave.given("I created storage with volumes '{volume_ids}'")
+def create_storage(ctx, volume_ids):
+    ctx.storage = storage.StorageMgr('farm', backend='sparse')
+    for minor, volume_id in enumerate(volume_ids.split(',')):
+        ctx.storage.volumes[volume_id] = dict(id=volume_id, attached_to=None, maj=7, min=minor,
+                                              host_path='/dev/loop%s' % minor, size='1')
+
+@behave.when("I attached volumes '{volume_ids}' to '{instance_id}'")
+def attach_volumes(ctx, volume_ids, instance_id):
+    ctx.storage.attach_volumes(volume_ids.split(','), instance_id)
+
+@behave.when("I detached volumes '{volume_ids}' from '{instance_id}'")
+def detach_volumes(ctx, volume_ids, instance_id):
+    ctx.storage.detach_volumes(volume_ids.split(','), instance_id)
+
+@behave.when("container '{instance_id}' was removed")
+def remove_container(ctx, instance_id):
+    shutil.rmtree(ctx.cgroup_dir)
+
+@behave.when("server '{instance_id}' terminated")
+def server_terminated(ctx, instance_id):
+    ctx.storage._server_terminated(dict(id=instance_id))
+
+@behave.then("devices.{action} of '{instance_id}' got rules of volumes '{volume_ids}'")
+def device_rules_written(ctx, action, instance_id, volume_ids):
+    volumes = [ctx.storage.volumes[volume_id] for volume_id in volume_ids.split(',')]
+    with open(os.path.join(ctx.cgroup_dir, 'devices.' + action)) as f:
+        assert ['b %s:%s rwm\n' % (v['maj'], v['min']) for v in volumes] == f.readlines()
+
+@behave.then("volumes '{volume_ids}' are attached to '{instance_id}'")
+def volumes_attached(ctx, volume_ids, instance_id):
+    assert volume_ids.split(',') == [volume['id'] for volume in ctx.storage.attachments[instance_id]]
+    for volume_id in volume_ids.split(','):
+        assert instance_id == ctx.storage.volumes[volume_id]['attached_to']
+
+@behave.then("volumes '{volume_ids}' are not attached")
+def volumes_not_attached(ctx, volume_ids):
+    for volume_id in volume_ids.split(','):
+        assert ctx.storage.volumes[volume_id]['attached_to'] is None
+    assert not any(ctx.storage.attachments.values())
+
+@behave.then("attaching volumes '{volume_ids}' to '{instance_id}' fails without device helper")
+def attach_fails_without_helper(ctx, volume_ids, instance_id):
+    try:
+        ctx.storage.attach_volumes(volume_ids.split(','), instance_id)
+    except storage.StorageError as e:
+        assert 'cgroup_v2_device_helper' in str(e)
+    else:
+        raise AssertionError('Volumes were attached on cgroup v2 host without helper')
+
+@behave.given('I created sparse file backend with fake losetup')
+def sparse_backend(ctx):
+    bin_dir = os.path.join(ctx.base_dir, 'bin')
+    os.makedirs(bin_dir)
+    ctx.losetup_log = os.path.join(ctx.base_dir, 'losetup.log')
+    losetup = os.path.join(bin_dir, 'losetup')
+    with open(losetup, 'w') as f:
+        f.write(FAKE_LOSETUP.format(log=ctx.losetup_log))
+    os.chmod(losetup, stat.S_IRWXU)
+    os.environ['PATH'] = os.pathsep.join([bin_dir, os.environ['PATH']])
+    ctx.backend = storage.SparseFileBackend(os.path.join(ctx.base_dir, 'images'))
+    ctx.volumes = dict()
+    ctx.snapshot_dir = os.path.join(ctx.base_dir, 'snapshots')
+    os.makedirs(ctx.snapshot_dir)
+
+@behave.given('filesystem of images {does} support reflink')
+def reflink_supported(ctx, does):
+    os.makedirs(ctx.backend.directory)
+    src = os.path.join(ctx.backend.directory, 'probe')
+    with open(src, 'wb') as f:
+        f.write(os.urandom(4096))
+    supported = storage.reflink(src, src + '.clone')
+    os.remove(src)
+    os.remove(src + '.clone')
+    if supported != (does == 'does'):
+        ctx.scenario.skip('Filesystem of %s %s support reflink' % (
+            ctx.backend.directory, supported and 'does' or "doesn't"))
+
+@behave.when("I created sparse volume '{volume_id}' of {size:d}GB")
+def create_sparse_volume(ctx, volume_id, size):
+    ctx.volumes[volume_id] = dict(id=volume_id, host_path=ctx.backend.create_volume(volume_id, size))
+
+@behave.when("I created sparse volume '{volume_id}' of {size:d}GB from snapshot '{snapshot_id}'")
+def create_sparse_volume_from_snapshot(ctx, volume_id, size, snapshot_id):
+    snapshot_path = os.path.join(ctx.snapshot_dir, snapshot_id)
+    ctx.volumes[volume_id] = dict(id=volume_id,
+                                  host_path=ctx.backend.create_volume(volume_id, size, snapshot_path))
+
+@behave.when("I wrote data to volume '{volume_id}'")
+def write_volume(ctx, volume_id):
+    ctx.data = os.urandom(64 * 1024)
+    with open(ctx.backend._image_path(volume_id), 'r+b') as f:
+        f.seek(1024 ** 2)
+        f.write(ctx.data)
+
+@behave.when("I snapshotted volume '{volume_id}' to '{snapshot_id}'")
+def snapshot_sparse_volume(ctx, volume_id, snapshot_id):
+    ctx.backend.create_snapshot(ctx.volumes[volume_id], os.path.join(ctx.snapshot_dir, snapshot_id))
+
+@behave.when("I destroyed volumes '{volume_ids}'")
+def destroy_sparse_volumes(ctx, volume_ids):
+    for volume_id in volume_ids.split(','):
+        ctx.backend.destroy_volume(ctx.volumes[volume_id])
+
+@behave.then("volume '{volume_id}' has the same data as volume '{source_id}'")
+def sparse_volumes_match(ctx, volume_id, source_id):
+    with open(ctx.backend._image_path(volume_id), 'rb') as f, \
+            open(ctx.backend._image_path(source_id), 'rb') as source:
+        for chunk in iter(lambda: f.read(1024 ** 2), ''):
+            assert chunk == source.read(1024 ** 2)
+        assert '' == source.read(1)
+
+def assert_sparse(path):
+    image_stat = os.stat(path)
+    assert 1024 ** 3 == image_stat.st_size
+    # Allocated: written data, not the whole image
+    assert image_stat.st_blocks * 512 < 1024 ** 2, image_stat.st_blocks
+
+@behave.then("image of volume '{volume_id}' is sparse")
+def image_is_sparse(ctx, volume_id):
+    assert_sparse(ctx.backend._image_path(volume_id))
+
+@behave.then("snapshot '{snapshot_id}' is sparse")
+def snapshot_is_sparse(ctx, snapshot_id):
+    assert_sparse(os.path.join(ctx.snapshot_dir, snapshot_id))
+
+@behave.then("volumes '{volume_ids}' got their own loop devices")
+def own_loop_devices(ctx, volume_ids):
+    devices = [ctx.volumes[volume_id]['host_path'] for volume_id in volume_ids.split(',')]
+    assert devices == [ctx.backend.loop_devices[volume_id] for volume_id in volume_ids.split(',')]
+    assert len(set(devices)) == len(devices), devices
+
+@behave.then("loop devices of volumes '{volume_ids}' were detached and images removed")
+def loop_devices_detached(ctx, volume_ids):
+    with open(ctx.losetup_log) as f:
+        detached = [line.split()[1] for line in f if line.startswith('--detach')]
+    assert [ctx.volumes[volume_id]['host_path'] for volume_id in volume_ids.split(',')] == detached
+    assert {} == ctx.backend.loop_devices
+    assert [] == os.listdir(ctx.backend.directory)
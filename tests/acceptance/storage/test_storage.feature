@@ -0,0 +1,91 @@
+Feature: Habibi storage
+    Habibi storage creates volumes for servers, manages their snapshots
+    and gives containers access to volume devices.
+
+    Scenario: Clean up missing volume group
+        Given I created lvm backend without volume group
+        When I cleaned up the backend
+        Then volume group was not removed
+
+    Scenario: Clean up volume group
+        Given I created lvm backend with volume group
+        When I cleaned up the backend
+        Then volume group was removed
+
+    Scenario: Destroy removed logical volume
+        Given I created lvm backend with volume group
+        When I destroyed volume 'vol-1', that was already removed
+        Then volume group was not removed
+
+    Scenario: Restore compressed snapshot to zeroed volume
+        Given I created image of chunks 'data,zero,data,zero,partial' of 64KB
+        When I compressed the image in chunks of 64KB
+         And I restored compressed image to zeroed volume
+        Then volume has the same data as the image
+         And compressed image stores 3 chunks
+
+    Scenario: Restore compressed snapshot to volume with garbage
+        Given I created image of chunks 'zero,data,zero,partial' of 64KB
+        When I compressed the image in chunks of 64KB
+         And I restored compressed image to volume with garbage
+        Then volume has the same data as the image
+
+    Scenario: Restore snapshot of sparse file volume, copied without reflink
+        Given I created sparse file backend with fake losetup
+         And filesystem of images doesn't support reflink
+        When I created sparse volume 'vol-1' of 1GB
+         And I wrote data to volume 'vol-1'
+         And I snapshotted volume 'vol-1' to 'snap-1'
+         And I created sparse volume 'vol-2' of 1GB from snapshot 'snap-1'
+        Then snapshot 'snap-1' is sparse
+         And volume 'vol-2' has the same data as volume 'vol-1'
+         And image of volume 'vol-2' is sparse
+         And volumes 'vol-1,vol-2' got their own loop devices
+        When I destroyed volumes 'vol-1,vol-2'
+        Then loop devices of volumes 'vol-1,vol-2' were detached and images removed
+
+    Scenario: Restore snapshot of sparse file volume, copied with reflink
+        Given I created sparse file backend with fake losetup
+         And filesystem of images does support reflink
+        When I created sparse volume 'vol-1' of 1GB
+         And I wrote data to volume 'vol-1'
+         And I snapshotted volume 'vol-1' to 'snap-1'
+         And I created sparse volume 'vol-2' of 1GB from snapshot 'snap-1'
+        Then snapshot 'snap-1' is sparse
+         And volume 'vol-2' has the same data as volume 'vol-1'
+         And image of volume 'vol-2' is sparse
+         And volumes 'vol-1,vol-2' got their own loop devices
+        When I destroyed volumes 'vol-1,vol-2'
+        Then loop devices of volumes 'vol-1,vol-2' were detached and images removed
+
+    Scenario: Allow and deny devices of container on cgroup v1 host
+        Given cgroup v1 host runs container 'c-1'
+         And I created storage with volumes 'vol-1,vol-2'
+        When I attached volumes 'vol-1,vol-2' to 'c-1'
+        Then devices.allow of 'c-1' got rules of volumes 'vol-1,vol-2'
+        When I detached volumes 'vol-1' from 'c-1'
+        Then devices.deny of 'c-1' got rules of volumes 'vol-1'
+         And volumes 'vol-2' are attached to 'c-1'
+
+    Scenario: Detach volumes of terminated server
+        Given cgroup v1 host runs container 'c-1'
+         And I created storage with volumes 'vol-1,vol-2'
+        When I attached volumes 'vol-1,vol-2' to 'c-1'
+         And container 'c-1' was removed
+         And server 'c-1' terminated
+        Then volumes 'vol-1,vol-2' are not attached
+
+    Scenario: Refuse to attach volumes on cgroup v2 host without helper
+        Given cgroup v2 host runs container 'c-1'
+         And I created storage with volumes 'vol-1'
+        Then attaching volumes 'vol-1' to 'c-1' fails without device helper
+         And volumes 'vol-1' are not attached
+
+    Scenario: Detach volumes of terminated server, when device helper fails
+        Given cgroup v2 host runs container 'c-1'
+         And cgroup v2 device helper is 'true'
+         And I created storage with volumes 'vol-1'
+        When I attached volumes 'vol-1' to 'c-1'
+         And cgroup v2 device helper is 'false'
+         And server 'c-1' terminated
+        Then volumes 'vol-1' are not attached